@@ -0,0 +1,316 @@
+
+import json
+import looker_sdk
+import pandas as pd
+from concurrent.futures import ThreadPoolExecutor
+
+from check_user_dashboard_look_access import check_user_dashboard_look_access, get_group_ids, TestUserPool
+
+
+# Every user is in the All Users group, even if it isn't listed
+ALL_USERS_GROUP_ID = '1'
+
+
+class AccessEvaluator:
+    '''
+    Works out which dashboards / looks a set of groups can see from a single snapshot of folders,
+    folder access, groups, nested groups, roles (through groups or given to users directly) and
+    content, without changing any user.
+
+    Use AccessEvaluator.from_sdk(admin_sdk) to take the snapshot, then ask as many what-if questions
+    as you like. Only the permissions needed to see content are modelled (see_looks, see_user_dashboards,
+    see_lookml_dashboards and administer), use cross_check() to compare against the live sudo method.
+    '''
+    def __init__(self, snapshot: dict):
+        self.snapshot = snapshot
+        self.folders = snapshot['folders']
+        self.content_metadata = snapshot['content_metadata']
+        self.content_metadata_access = snapshot['content_metadata_access']
+        self.group_parents = snapshot['group_parents']
+        self.roles = snapshot['roles']
+        # {user id: ids of the roles given to the user directly}, only users with direct roles
+        self.user_role_ids = snapshot.get('user_role_ids', {})
+        self.dashboards = snapshot['dashboards']
+        self.looks = snapshot['looks']
+
+        # Which folders each group (and each user with direct access) can see, ignoring nesting
+        self._folders_by_group = {}
+        self._folders_by_user = {}
+        for folder_id, folder in self.folders.items():
+            access = self.content_metadata_access.get(self._effective_content_metadata_id(folder['content_metadata_id']), {})
+            for group_id in access.get('group_ids', []):
+                self._folders_by_group.setdefault(group_id, set()).add(folder_id)
+            for user_id in access.get('user_ids', []):
+                self._folders_by_user.setdefault(user_id, set()).add(folder_id)
+
+        self._content_by_folder = {'dashboards': {}, 'looks': {}}
+        for content_type in self._content_by_folder:
+            for content_id, content in getattr(self, content_type).items():
+                self._content_by_folder[content_type].setdefault(content['folder_id'], set()).add(content_id)
+
+    @classmethod
+    def from_sdk(cls, admin_sdk: looker_sdk.sdk.api31.methods.Looker31SDK, max_workers: int = 8):
+        return cls(take_access_snapshot(admin_sdk, max_workers=max_workers))
+
+    @classmethod
+    def load(cls, path: str):
+        with open(path) as f:
+            return cls(json.load(f))
+
+    def save(self, path: str) -> None:
+        with open(path, 'w') as f:
+            json.dump(self.snapshot, f)
+
+    def _effective_content_metadata_id(self, content_metadata_id: str) -> str:
+        '''
+        Follows content metadata that inherits access up to the one that defines it
+        '''
+        seen = set()
+        while content_metadata_id in self.content_metadata and content_metadata_id not in seen:
+            seen.add(content_metadata_id)
+            content_metadata = self.content_metadata[content_metadata_id]
+            if not content_metadata['inherits'] or content_metadata['parent_id'] is None:
+                break
+            content_metadata_id = content_metadata['parent_id']
+        return content_metadata_id
+
+    def effective_group_ids(self, group_ids: list, excluded_group_ids: set = frozenset()) -> set:
+        '''
+        Members of a nested group are members of every group it is nested in.
+        excluded_group_ids are treated as if they had been deleted.
+        '''
+        excluded_group_ids = {_to_id(group_id) for group_id in excluded_group_ids}
+        effective = set()
+        to_visit = [ALL_USERS_GROUP_ID] + [str(group_id) for group_id in group_ids]
+        while to_visit:
+            group_id = to_visit.pop()
+            if group_id not in effective and group_id not in excluded_group_ids:
+                effective.add(group_id)
+                to_visit.extend(self.group_parents.get(group_id, []))
+        return effective
+
+    def direct_role_ids(self, user_id: str) -> list:
+        '''
+        Roles given to a user directly, rather than through a group
+        '''
+        return self.user_role_ids.get(str(user_id), [])
+
+    def model_permissions(self, group_ids: list, excluded_group_ids: set = frozenset(), role_ids: list = ()) -> dict:
+        '''
+        Returns {permission: set of models}, where None in the set means every model.
+        role_ids are roles given to the user directly, on top of the roles of their groups.
+        '''
+        effective = self.effective_group_ids(group_ids, excluded_group_ids)
+        direct_role_ids = {_to_id(role_id) for role_id in role_ids}
+        permissions = {}
+        for role_id, role in self.roles.items():
+            if effective.isdisjoint(role['group_ids']) and role_id not in direct_role_ids:
+                continue
+            models = {None} if role['models'] is None else set(role['models'])
+            for permission in role['permissions']:
+                permissions.setdefault(permission, set()).update(models)
+        return permissions
+
+    def group_folder_ids(self, group_id: str) -> set:
+        '''
+        Folders a single group has access to, not counting the groups it is nested in
+        '''
+        return self._folders_by_group.get(str(group_id), set())
+
+    def user_folder_ids(self, user_id: str) -> set:
+        '''
+        Folders a user has been given access to directly, rather than through a group
+        '''
+        return self._folders_by_user.get(str(user_id), set())
+
+    def folder_content_ids(self, content_type: str, folder_id: str) -> set:
+        return self._content_by_folder[content_type].get(folder_id, set())
+
+    def visible_folder_ids(self, group_ids: list, user_id: str = None) -> set:
+        visible = set()
+        for group_id in self.effective_group_ids(group_ids):
+            visible |= self._folders_by_group.get(group_id, set())
+        if user_id is not None:
+            visible |= self._folders_by_user.get(str(user_id), set())
+        return visible
+
+    def visible_content(self, group_ids: list, user_id: str = None, role_ids: list = None) -> dict:
+        '''
+        Returns {'dashboards': set of ids, 'looks': set of ids} that a user with group_ids can see.
+        role_ids default to the user's direct roles in the snapshot when user_id is given.
+        '''
+        if role_ids is None:
+            role_ids = self.direct_role_ids(user_id) if user_id is not None else []
+        permissions = self.model_permissions(group_ids, role_ids=role_ids)
+        if 'administer' in permissions:
+            return {'dashboards': set(self.dashboards), 'looks': set(self.looks)}
+
+        def has_permission(permission, model=None):
+            models = permissions.get(permission, set())
+            return None in models or (model is not None and model in models) or (model is None and bool(models))
+
+        visible = {'dashboards': set(), 'looks': set()}
+        for folder_id in self.visible_folder_ids(group_ids, user_id):
+            if has_permission('see_user_dashboards'):
+                visible['dashboards'] |= self._content_by_folder['dashboards'].get(folder_id, set())
+            for look_id in self._content_by_folder['looks'].get(folder_id, set()):
+                if has_permission('see_looks', self.looks[look_id]['model']):
+                    visible['looks'].add(look_id)
+
+        # LookML dashboards aren't in folders, they need permission on their model
+        for dashboard_id in self.dashboards:
+            if '::' in dashboard_id and has_permission('see_lookml_dashboards', dashboard_id.split('::')[0]):
+                visible['dashboards'].add(dashboard_id)
+        return visible
+
+    def what_if(self, group_ids: list, group_ids_to_add: list = [], group_ids_to_remove: list = [], user_id: str = None, role_ids: list = None) -> dict:
+        '''
+        Compares the content visible with group_ids to the content visible after adding / removing groups.
+        role_ids are the user's direct roles, taken from the snapshot by user_id when not given.
+
+        returns {'dashboards': {'missing': set, 'new': set}, 'looks': {'missing': set, 'new': set}}
+        '''
+        new_group_ids = (set(map(str, group_ids)) - set(map(str, group_ids_to_remove))) | set(map(str, group_ids_to_add))
+        orig = self.visible_content(group_ids, user_id, role_ids)
+        new = self.visible_content(new_group_ids, user_id, role_ids)
+        return {
+            content_type: {'missing': orig[content_type] - new[content_type], 'new': new[content_type] - orig[content_type]}
+            for content_type in orig
+        }
+
+    def what_if_df(self, real_user: looker_sdk.models.User, group_ids_to_add: list = [], group_ids_to_remove: list = []):
+        '''
+        Same as what_if for a real user, but returns (changed_dashboards, changed_looks) in the same
+        format as check_user_dashboard_look_access
+        '''
+        changes = self.what_if(real_user.group_ids or [], group_ids_to_add, group_ids_to_remove, user_id=real_user.id,
+                               role_ids=real_user.role_ids or [])
+        results = []
+        for content_type, empty_message in [('dashboards', 'No Missing Dashboards'), ('looks', 'No Missing Looks')]:
+            content = getattr(self, content_type)
+            rows = [
+                {'id': content_id, 'title': content[content_id]['title'], 'user_id': real_user.id,
+                 'user_email': real_user.email, 'missing_or_new': missing_or_new}
+                for missing_or_new in ['missing', 'new']
+                for content_id in sorted(changes[content_type][missing_or_new])
+            ]
+            results.append(pd.DataFrame(rows) if rows else empty_message)
+        return tuple(results)
+
+
+def _to_id(value):
+    return None if value is None else str(value)
+
+
+def take_access_snapshot(admin_sdk: looker_sdk.sdk.api31.methods.Looker31SDK, max_workers: int = 8) -> dict:
+    '''
+    Takes everything the AccessEvaluator needs from the instance, using only the fields it needs
+    '''
+    folders = {
+        _to_id(folder.id): {
+            'parent_id': _to_id(folder.parent_id),
+            'content_metadata_id': _to_id(folder.content_metadata_id),
+        }
+        for folder in admin_sdk.all_folders(fields='id,parent_id,content_metadata_id')
+    }
+    groups = admin_sdk.all_groups(fields='id')
+    roles = admin_sdk.all_roles(fields='id,permission_set,model_set')
+    users = admin_sdk.all_users(fields='id,role_ids')
+
+    def get_content_metadata(content_metadata_id):
+        content_metadata = admin_sdk.content_metadata(content_metadata_id, fields='id,parent_id,inherits')
+        return content_metadata_id, {'parent_id': _to_id(content_metadata.parent_id), 'inherits': bool(content_metadata.inherits)}
+
+    def get_content_metadata_access(content_metadata_id):
+        accesses = admin_sdk.all_content_metadata_accesses(content_metadata_id, fields='group_id,user_id')
+        return content_metadata_id, {
+            'group_ids': sorted({_to_id(access.group_id) for access in accesses if access.group_id is not None}),
+            'user_ids': sorted({_to_id(access.user_id) for access in accesses if access.user_id is not None}),
+        }
+
+    def get_child_group_ids(group_id):
+        return group_id, [_to_id(child.id) for child in admin_sdk.all_group_groups(group_id, fields='id')]
+
+    def get_role_group_ids(role_id):
+        return role_id, [_to_id(group.id) for group in admin_sdk.role_groups(role_id, fields='id')]
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        content_metadata_ids = {folder['content_metadata_id'] for folder in folders.values() if folder['content_metadata_id']}
+        content_metadata = dict(executor.map(get_content_metadata, content_metadata_ids))
+        # Only content metadata that doesn't inherit has its own access list
+        defining_ids = [cm_id for cm_id, cm in content_metadata.items() if not cm['inherits'] or cm['parent_id'] is None]
+        content_metadata_access = dict(executor.map(get_content_metadata_access, defining_ids))
+        child_group_ids = dict(executor.map(get_child_group_ids, [group.id for group in groups]))
+        role_group_ids = dict(executor.map(get_role_group_ids, [role.id for role in roles]))
+        dashboards, looks = executor.map(lambda get: get(), [
+            lambda: admin_sdk.all_dashboards(fields='id,title,space_id,folder_id'),
+            lambda: admin_sdk.all_looks(fields='id,title,space_id,folder_id,model'),
+        ])
+
+    # all_group_groups lists the groups nested inside a group, the evaluator needs the other direction
+    group_parents = {}
+    for parent_id, child_ids in child_group_ids.items():
+        for child_id in child_ids:
+            group_parents.setdefault(child_id, []).append(_to_id(parent_id))
+
+    return {
+        'folders': folders,
+        'content_metadata': content_metadata,
+        'content_metadata_access': content_metadata_access,
+        'group_parents': group_parents,
+        'roles': {
+            _to_id(role.id): {
+                'permissions': list(role.permission_set.permissions or []) if role.permission_set else [],
+                'models': None if role.model_set is None or role.model_set.all_access else list(role.model_set.models or []),
+                'group_ids': role_group_ids[role.id],
+            }
+            for role in roles
+        },
+        'user_role_ids': {
+            _to_id(user.id): [_to_id(role_id) for role_id in user.role_ids]
+            for user in users if user.role_ids
+        },
+        'dashboards': {
+            _to_id(dashboard.id): {'title': dashboard.title, 'folder_id': _to_id(dashboard.folder_id or dashboard.space_id)}
+            for dashboard in dashboards
+        },
+        'looks': {
+            _to_id(look.id): {'title': look.title, 'folder_id': _to_id(look.folder_id or look.space_id),
+                              'model': look.model.id if look.model else None}
+            for look in looks
+        },
+    }
+
+
+def cross_check(evaluator: AccessEvaluator, admin_sdk: looker_sdk.sdk.api31.methods.Looker31SDK, group_df: pd.DataFrame, test_user_id: int, actual_user_email: str, group_names_to_add: list = [], group_names_to_remove: list = [], test_user_pool: TestUserPool = None) -> pd.DataFrame:
+    '''
+    Runs the same what-if question through the evaluator and the live sudo method
+    (check_user_dashboard_look_access), returns a df of every change they disagree on.
+    An empty df means the evaluator got it right.
+    '''
+    real_user = admin_sdk.search_users(email=actual_user_email)[0]
+    predicted = evaluator.what_if(
+        real_user.group_ids or [],
+        group_ids_to_add=get_group_ids(group_df, group_names_to_add),
+        group_ids_to_remove=get_group_ids(group_df, group_names_to_remove),
+        user_id=real_user.id,
+        role_ids=real_user.role_ids or []
+    )
+    live = check_user_dashboard_look_access(admin_sdk, group_df, test_user_id, actual_user_email, group_names_to_add, group_names_to_remove, test_user_pool)
+
+    disagreements = []
+    for content_type, live_df in zip(['dashboards', 'looks'], live):
+        for missing_or_new in ['missing', 'new']:
+            live_ids = set()
+            if isinstance(live_df, pd.DataFrame):
+                live_ids = set(live_df[live_df['missing_or_new'] == missing_or_new]['id'].map(_to_id))
+            predicted_ids = predicted[content_type][missing_or_new]
+            disagreements += [
+                {'content_type': content_type, 'id': content_id, 'missing_or_new': missing_or_new, 'found_by': 'live only'}
+                for content_id in sorted(live_ids - predicted_ids)
+            ]
+            disagreements += [
+                {'content_type': content_type, 'id': content_id, 'missing_or_new': missing_or_new, 'found_by': 'evaluator only'}
+                for content_id in sorted(predicted_ids - live_ids)
+            ]
+    return pd.DataFrame(disagreements, columns=['content_type', 'id', 'missing_or_new', 'found_by'])
@@ -0,0 +1,206 @@
+
+import gzip
+import json
+import looker_sdk
+import pandas as pd
+
+from access_evaluator import AccessEvaluator, ALL_USERS_GROUP_ID
+
+
+def get_signature(group_ids: list) -> tuple:
+    '''
+    Same idea as get_group_signature, for the string ids used by the AccessEvaluator
+    '''
+    return tuple(sorted(set(map(str, group_ids)) - {ALL_USERS_GROUP_ID}))
+
+
+def _iter_bits(bits: int):
+    '''
+    Yields the index of every set bit, lowest first
+    '''
+    while bits:
+        lowest_bit = bits & -bits
+        yield lowest_bit.bit_length() - 1
+        bits ^= lowest_bit
+
+
+class AccessMatrix:
+    '''
+    Precomputed access of every user to every dashboard / look, for audits like
+    "who loses access to what if group X is retired".
+
+    Users with the same groups (and the same folders and roles given to them directly, usually none) share
+    a row, keyed by (group signature, direct folder ids, direct role ids). Each row is a bitset (a python int) with one bit per
+    dashboard / look in self.columns, so what-if questions are answered with bitwise set operations
+    over all rows at once instead of diffing DataFrames user by user.
+    '''
+    def __init__(self, evaluator: AccessEvaluator, users: dict, rows: dict = None):
+        '''
+        users: dict - {user_id: {'email': str, 'group_ids': list, 'role_ids': list}}, role_ids are the roles
+        given to the user directly and default to the ones in the evaluator's snapshot
+        rows: dict - {(group signature, direct folder ids, direct role ids): bitset}, computed from the
+        evaluator if not given
+        '''
+        self.evaluator = evaluator
+        self.users = users
+        self.columns = [('dashboards', dashboard_id) for dashboard_id in sorted(evaluator.dashboards)] + \
+            [('looks', look_id) for look_id in sorted(evaluator.looks)]
+        column_index = {column: i for i, column in enumerate(self.columns)}
+
+        # Bitsets that the permission checks pick from
+        self._all_bits = (1 << len(self.columns)) - 1
+        self._user_dashboard_bits = 0
+        self._lookml_dashboard_bits_by_model = {}
+        self._look_bits_by_model = {}
+        for content_type, content_id in self.columns:
+            bit = 1 << column_index[(content_type, content_id)]
+            if content_type == 'looks':
+                model = evaluator.looks[content_id]['model']
+                self._look_bits_by_model[model] = self._look_bits_by_model.get(model, 0) | bit
+            elif '::' in content_id:
+                model = content_id.split('::')[0]
+                self._lookml_dashboard_bits_by_model[model] = self._lookml_dashboard_bits_by_model.get(model, 0) | bit
+            else:
+                self._user_dashboard_bits |= bit
+
+        self._column_index = column_index
+        # Content in the folders each group can see directly, filled as groups come up
+        self._group_bits = {}
+
+        self.user_row_keys = {
+            user_id: (
+                get_signature(user['group_ids']),
+                tuple(sorted(evaluator.user_folder_ids(user_id))),
+                tuple(sorted(map(str, user.get('role_ids', evaluator.direct_role_ids(user_id))))),
+            )
+            for user_id, user in users.items()
+        }
+        if rows is None:
+            rows = {row_key: self._row_bits(row_key) for row_key in set(self.user_row_keys.values())}
+        self.rows = rows
+
+    @classmethod
+    def from_sdk(cls, admin_sdk: looker_sdk.sdk.api31.methods.Looker31SDK, evaluator: AccessEvaluator = None):
+        if evaluator is None:
+            evaluator = AccessEvaluator.from_sdk(admin_sdk)
+        users = {
+            str(user.id): {
+                'email': user.email,
+                'group_ids': [str(group_id) for group_id in user.group_ids or []],
+                'role_ids': [str(role_id) for role_id in user.role_ids or []],
+            }
+            for user in admin_sdk.all_users(fields='id,email,group_ids,role_ids')
+        }
+        return cls(evaluator, users)
+
+    @classmethod
+    def load(cls, path: str):
+        with gzip.open(path, 'rt') as f:
+            saved = json.load(f)
+        rows = {
+            (tuple(signature), tuple(folder_ids), tuple(role_ids)): int(bits, 16)
+            for signature, folder_ids, role_ids, bits in saved['rows']
+        }
+        return cls(AccessEvaluator(saved['snapshot']), saved['users'], rows)
+
+    def save(self, path: str) -> None:
+        '''
+        Saves the snapshot, users and rows as gzipped json, bitsets are stored as hex
+        '''
+        with gzip.open(path, 'wt') as f:
+            json.dump({
+                'snapshot': self.evaluator.snapshot,
+                'users': self.users,
+                'rows': [[list(signature), list(folder_ids), list(role_ids), format(bits, 'x')]
+                         for (signature, folder_ids, role_ids), bits in self.rows.items()],
+            }, f)
+
+    def _bits_for_folders(self, folder_ids) -> int:
+        bits = 0
+        for folder_id in folder_ids:
+            for content_type in ['dashboards', 'looks']:
+                for content_id in self.evaluator.folder_content_ids(content_type, folder_id):
+                    bits |= 1 << self._column_index[(content_type, content_id)]
+        return bits
+
+    def _bits_for_group(self, group_id: str) -> int:
+        if group_id not in self._group_bits:
+            self._group_bits[group_id] = self._bits_for_folders(self.evaluator.group_folder_ids(group_id))
+        return self._group_bits[group_id]
+
+    def _row_bits(self, row_key: tuple, excluded_group_ids: set = frozenset()) -> int:
+        signature, direct_folder_ids, direct_role_ids = row_key
+        permissions = self.evaluator.model_permissions(signature, excluded_group_ids, direct_role_ids)
+        if 'administer' in permissions:
+            return self._all_bits
+
+        folder_bits = self._bits_for_folders(direct_folder_ids)
+        for group_id in self.evaluator.effective_group_ids(signature, excluded_group_ids):
+            folder_bits |= self._bits_for_group(group_id)
+
+        def bits_for_models(permission, bits_by_model):
+            models = permissions.get(permission, set())
+            if None in models:
+                return sum(bits_by_model.values())
+            bits = sum(bits_by_model.get(model, 0) for model in models)
+            if models:
+                # content without a model needs the permission on any model, like in AccessEvaluator
+                bits |= bits_by_model.get(None, 0)
+            return bits
+
+        allowed_bits = bits_for_models('see_looks', self._look_bits_by_model)
+        if permissions.get('see_user_dashboards'):
+            allowed_bits |= self._user_dashboard_bits
+        return (folder_bits & allowed_bits) | bits_for_models('see_lookml_dashboards', self._lookml_dashboard_bits_by_model)
+
+    def user_content(self, user_id: str) -> dict:
+        '''
+        Returns {'dashboards': set of ids, 'looks': set of ids} that a user can see
+        '''
+        visible = {'dashboards': set(), 'looks': set()}
+        for i in _iter_bits(self.rows[self.user_row_keys[str(user_id)]]):
+            content_type, content_id = self.columns[i]
+            visible[content_type].add(content_id)
+        return visible
+
+    def what_if(self, group_ids_to_add: list = [], group_ids_to_remove: list = [], retire_group_ids: list = []) -> pd.DataFrame:
+        '''
+        Adds / removes groups for every user at once, retired groups are removed from every user and
+        from every group they're nested in. Folders shared with a user directly and roles given to them
+        directly stay theirs.
+        Returns a df with one row per piece of content each user would lose or gain: id, title,
+        content_type ('dashboards' / 'looks'), user_id, user_email and missing_or_new ('missing' / 'new').
+        '''
+        group_ids_to_add = set(map(str, group_ids_to_add))
+        group_ids_to_remove = set(map(str, group_ids_to_remove)) | set(map(str, retire_group_ids))
+        excluded_group_ids = set(map(str, retire_group_ids))
+
+        changed_bits = {}
+        for (signature, direct_folder_ids, direct_role_ids), bits in self.rows.items():
+            new_signature = get_signature((set(signature) - group_ids_to_remove) | group_ids_to_add)
+            if new_signature == signature and excluded_group_ids.isdisjoint(self.evaluator.effective_group_ids(signature)):
+                continue
+            new_bits = self._row_bits((new_signature, direct_folder_ids, direct_role_ids), excluded_group_ids)
+            if new_bits != bits:
+                changed_bits[(signature, direct_folder_ids, direct_role_ids)] = (bits & ~new_bits, new_bits & ~bits)
+
+        changed_content = {'id': [], 'title': [], 'content_type': [], 'user_id': [], 'user_email': [], 'missing_or_new': []}
+        for user_id, row_key in self.user_row_keys.items():
+            if row_key not in changed_bits:
+                continue
+            for missing_or_new, bits in zip(['missing', 'new'], changed_bits[row_key]):
+                for i in _iter_bits(bits):
+                    content_type, content_id = self.columns[i]
+                    changed_content['id'].append(content_id)
+                    changed_content['title'].append(getattr(self.evaluator, content_type)[content_id]['title'])
+                    changed_content['content_type'].append(content_type)
+                    changed_content['user_id'].append(user_id)
+                    changed_content['user_email'].append(self.users[user_id]['email'])
+                    changed_content['missing_or_new'].append(missing_or_new)
+        return pd.DataFrame(changed_content)
+
+    def retire_group(self, group_id: str) -> pd.DataFrame:
+        '''
+        Who loses access to what if group_id is deleted
+        '''
+        return self.what_if(retire_group_ids=[group_id])
@@ -0,0 +1,343 @@
+'''
+Declarative groups, nested groups, roles, model sets, permission sets and group memberships.
+
+The desired state is a json file, everything in it is keyed by name:
+    {
+        "model_sets": {"Marketing": ["marketing"]},
+        "permission_sets": {"Viewer": ["access_data", "see_looks", "see_user_dashboards"]},
+        "groups": {"Marketing Viewer": {"groups": ["Marketing Explorer"], "users": ["12", "13"]}},
+        "roles": {"Marketing Viewer": {"base_role": "Viewer", "model_set": "Marketing", "groups": ["Marketing Viewer"]}},
+        "prune": false
+    }
+"groups" of a group are the groups nested in it. A role takes its permission_set / model_set from
+base_role when they're left out, like create_new_role in user_assignment_from_api.ipynb. Groups without
+"groups" / "users" keys don't have their nesting / members touched. Child groups, members and role groups
+that aren't listed are only removed with "prune": true.
+
+The current state is read once into name -> id indexes, the plan holds only the differences, and the
+steps run in parallel, phase by phase, so creates finish before anything uses their ids.
+
+    python access_reconciler.py business-units --name Marketing --name Sales --output access.json
+    python access_reconciler.py plan --state access.json
+    python access_reconciler.py apply --state access.json --workers 16
+'''
+
+import json
+from typing import List
+
+import click
+import looker_sdk
+
+from bulk_api import AdaptiveRateLimiter, BackoffSDK, run_concurrently
+from group_assignment import group_member_ids, plan_changes
+from looker_session import mount_connection_pool
+from sdk_listing import fetch_raw
+
+
+PHASES = [
+    ['create_model_set', 'update_model_set', 'create_permission_set', 'update_permission_set', 'create_group'],
+    ['create_role', 'update_role', 'add_group_group', 'delete_group_from_group', 'add_group_user', 'delete_group_user'],
+    ['set_role_groups'],
+]
+
+# The hierarchy create_new_groups builds, each group is nested in the one before it
+BUSINESS_UNIT_LEVELS = ['Viewer', 'Explorer', 'Developer']
+
+
+def _to_id(value) -> str:
+    return None if value is None else str(value)
+
+
+def business_unit_state(base_name: str, model_set: str = None, nest_groups: bool = True) -> dict:
+    '''
+    Desired state for one business unit: Viewer, Explorer and Developer groups, nested like
+    create_new_groups does, and a role per group based on the Viewer, Explorer and Developer roles
+    '''
+    names = [f'{base_name} {level}' for level in BUSINESS_UNIT_LEVELS]
+    groups = {name: {} for name in names}
+    if nest_groups:
+        for parent, child in zip(names, names[1:]):
+            groups[parent]['groups'] = [child]
+    roles = {}
+    for name, level in zip(names, BUSINESS_UNIT_LEVELS):
+        roles[name] = {'base_role': level, 'groups': [name]}
+        if model_set:
+            roles[name]['model_set'] = model_set
+    return {'groups': groups, 'roles': roles}
+
+
+def merge_states(states: List[dict]) -> dict:
+    merged = {'model_sets': {}, 'permission_sets': {}, 'groups': {}, 'roles': {}}
+    for state in states:
+        for key in merged:
+            merged[key].update(state.get(key, {}))
+        if 'prune' in state:
+            merged['prune'] = state['prune']
+    return merged
+
+
+class AccessSnapshot:
+    '''
+    Name -> id indexes of the groups, roles, model sets and permission sets on the instance, plus the
+    nesting, members and role groups of the groups and roles named in the desired state
+    '''
+    def __init__(self, sdk: looker_sdk.methods40.Looker40SDK, desired: dict, max_workers: int = 8):
+        self.groups = {group['name']: _to_id(group['id']) for group in fetch_raw(sdk, '/groups', ['id', 'name'])}
+        self.roles = {
+            role['name']: {
+                'id': _to_id(role['id']),
+                'permission_set_id': _to_id((role.get('permission_set') or {}).get('id')),
+                'model_set_id': _to_id((role.get('model_set') or {}).get('id')),
+            }
+            for role in fetch_raw(sdk, '/roles', ['id', 'name', 'permission_set(id)', 'model_set(id)'])
+        }
+        self.model_sets = {
+            model_set['name']: {'id': _to_id(model_set['id']), 'models': set(model_set.get('models') or [])}
+            for model_set in fetch_raw(sdk, '/model_sets', ['id', 'name', 'models'])
+        }
+        self.permission_sets = {
+            permission_set['name']: {'id': _to_id(permission_set['id']),
+                                     'permissions': set(permission_set.get('permissions') or [])}
+            for permission_set in fetch_raw(sdk, '/permission_sets', ['id', 'name', 'permissions'])
+        }
+
+        reads = []
+        for name, group in desired.get('groups', {}).items():
+            if name in self.groups:
+                if 'groups' in group:
+                    reads.append(('group_groups', name))
+                if 'users' in group:
+                    reads.append(('group_users', name))
+        reads += [('role_groups', name) for name in desired.get('roles', {}) if name in self.roles]
+
+        def read(item):
+            kind, name = item
+            if kind == 'group_groups':
+                return {_to_id(group['id']) for group in fetch_raw(sdk, f'/groups/{self.groups[name]}/groups', ['id'])}
+            if kind == 'group_users':
+                return group_member_ids(sdk, self.groups[name])
+            return {_to_id(group['id']) for group in fetch_raw(sdk, f"/roles/{self.roles[name]['id']}/groups", ['id'])}
+
+        self.group_groups, self.group_users, self.role_groups = {}, {}, {}
+        for (kind, name), ids, error in run_concurrently(read, reads, max_workers):
+            if error is not None:
+                raise error
+            getattr(self, kind)[name] = ids
+
+
+class _Planner:
+    def __init__(self, desired: dict, snapshot: AccessSnapshot):
+        self.desired = desired
+        self.snapshot = snapshot
+        self.prune = desired.get('prune', False)
+        self.steps = []
+
+    def _add(self, step: dict) -> None:
+        step['step'] = len(self.steps)
+        self.steps.append(step)
+
+    def _ref(self, kind: str, name: str, existing: dict):
+        '''
+        The id of an existing object, or a placeholder for the one the plan creates
+        '''
+        if name in existing:
+            value = existing[name]
+            return value['id'] if isinstance(value, dict) else value
+        if name not in self.desired.get(f'{kind}s', {}):
+            raise ValueError(f'{kind} {name!r} is neither on the instance nor in the desired state')
+        return {'ref': f'{kind}:{name}'}
+
+    def _plan_sets(self, kind: str, items_key: str, existing: dict) -> None:
+        for name, items in self.desired.get(f'{kind}s', {}).items():
+            if name not in existing:
+                self._add({'op': f'create_{kind}', 'ref': f'{kind}:{name}', 'body': {'name': name, items_key: items}})
+            elif set(items) != existing[name][items_key]:
+                self._add({'op': f'update_{kind}', 'id': existing[name]['id'], 'body': {items_key: items}})
+
+    def _plan_groups(self) -> None:
+        snapshot = self.snapshot
+        for name, group in self.desired.get('groups', {}).items():
+            if name not in snapshot.groups:
+                self._add({'op': 'create_group', 'ref': f'group:{name}', 'body': {'name': name}})
+            group_id = self._ref('group', name, snapshot.groups)
+            if 'groups' in group:
+                current = snapshot.group_groups.get(name, set())
+                child_ids = [self._ref('group', child, snapshot.groups) for child in group['groups']]
+                for child_id in child_ids:
+                    if isinstance(child_id, dict) or child_id not in current:
+                        self._add({'op': 'add_group_group', 'id': group_id, 'body': {'group_id': child_id}})
+                if self.prune:
+                    for child_id in sorted(current - {child_id for child_id in child_ids if isinstance(child_id, str)}):
+                        self._add({'op': 'delete_group_from_group', 'id': group_id, 'body': {'group_id': child_id}})
+            if 'users' in group:
+                current = {name: snapshot.group_users.get(name, set())}
+                desired = {name: {_to_id(user_id) for user_id in group['users']}}
+                for action, _, user_id in plan_changes(current, desired, exact=self.prune):
+                    op = 'add_group_user' if action == 'add' else 'delete_group_user'
+                    self._add({'op': op, 'id': group_id, 'body': {'user_id': user_id}})
+
+    def _plan_roles(self) -> None:
+        snapshot = self.snapshot
+        for name, role in self.desired.get('roles', {}).items():
+            base_role = snapshot.roles.get(role['base_role']) if role.get('base_role') else None
+            if role.get('base_role') and base_role is None:
+                raise ValueError(f"Base role {role['base_role']!r} of {name!r} isn't on the instance")
+            body = {}
+            for kind in ['permission_set', 'model_set']:
+                if role.get(kind):
+                    body[f'{kind}_id'] = self._ref(kind, role[kind], getattr(snapshot, f'{kind}s'))
+                elif base_role:
+                    body[f'{kind}_id'] = base_role[f'{kind}_id']
+            existing = snapshot.roles.get(name)
+            if existing is None:
+                self._add({'op': 'create_role', 'ref': f'role:{name}', 'body': dict(body, name=name)})
+            else:
+                changed = {key: value for key, value in body.items() if value != existing[key]}
+                if changed:
+                    self._add({'op': 'update_role', 'id': existing['id'], 'body': changed})
+
+            if 'groups' in role:
+                current = snapshot.role_groups.get(name, set())
+                group_ids = [self._ref('group', group, snapshot.groups) for group in role['groups']]
+                listed = {group_id for group_id in group_ids if isinstance(group_id, str)}
+                new_refs = [group_id for group_id in group_ids if not isinstance(group_id, str)]
+                keep = sorted(listed if self.prune else current | listed, key=int)
+                if new_refs or set(keep) != current:
+                    self._add({'op': 'set_role_groups', 'id': self._ref('role', name, snapshot.roles),
+                               'body': {'group_ids': keep + new_refs}})
+
+    def plan(self) -> List[dict]:
+        self._plan_sets('model_set', 'models', self.snapshot.model_sets)
+        self._plan_sets('permission_set', 'permissions', self.snapshot.permission_sets)
+        self._plan_groups()
+        self._plan_roles()
+        return self.steps
+
+
+def make_plan(sdk: looker_sdk.methods40.Looker40SDK, desired: dict, max_workers: int = 8) -> List[dict]:
+    '''
+    Steps that bring the instance to the desired state, empty when it's already there
+    '''
+    return _Planner(desired, AccessSnapshot(sdk, desired, max_workers)).plan()
+
+
+def _resolve(value, refs: dict):
+    '''
+    Swaps {"ref": ...} placeholders, also inside lists, for the ids of the objects created for them
+    '''
+    if isinstance(value, list):
+        return [_resolve(item, refs) for item in value]
+    if isinstance(value, dict) and set(value) == {'ref'}:
+        return refs[value['ref']]
+    return value
+
+
+def _run_step(api, step: dict, refs: dict) -> str:
+    '''
+    Makes one change, returns the id of the object it created, if any
+    '''
+    op = step['op']
+    body = {key: _resolve(value, refs) for key, value in step['body'].items()}
+    if op.startswith('create_'):
+        return _to_id(getattr(api, op)(body).id)
+    target_id = _resolve(step['id'], refs)
+    if op.startswith('update_') or op == 'add_group_group' or op == 'add_group_user':
+        getattr(api, op)(target_id, body)
+    elif op == 'delete_group_from_group':
+        api.delete_group_from_group(target_id, body['group_id'])
+    elif op == 'delete_group_user':
+        api.delete_group_user(target_id, body['user_id'])  # Note that this uses the user.id, not body!
+    elif op == 'set_role_groups':
+        api.set_role_groups(target_id, body['group_ids'])
+    else:
+        raise ValueError(f'Unknown step {op}')
+    return None
+
+
+def apply_plan(sdk: looker_sdk.methods40.Looker40SDK, steps: List[dict], workers: int = 16,
+               rate_limit: float = 20) -> List[dict]:
+    '''
+    Makes the changes in a plan, each phase in parallel. Returns the steps that failed, steps that
+    use the id of a failed create fail too. Planning and applying again picks up what's left.
+    '''
+    api = BackoffSDK(sdk, AdaptiveRateLimiter(rate_limit))
+    if workers > 10:
+        mount_connection_pool(sdk, workers)
+    refs = {}
+    failed = []
+    try:
+        for ops in PHASES:
+            pending = [step for step in steps if step['op'] in ops]
+            done_count = 0
+            for step, new_id, error in run_concurrently(lambda step: _run_step(api, step, refs), pending, workers):
+                if error is not None:
+                    click.echo(f"Step {step['step']} {step['op']} {step.get('ref', step.get('id', ''))}: "
+                               f"failed with {error!r}")
+                    failed.append(step)
+                    continue
+                if 'ref' in step:
+                    refs[step['ref']] = new_id
+                done_count += 1
+            if pending:
+                click.echo(f"{', '.join(ops)}: {done_count} of {len(pending)} steps done")
+    finally:
+        api.detach()
+    return failed
+
+
+def _describe(step: dict) -> str:
+    target = step.get('ref') or step.get('id')
+    target = target['ref'] if isinstance(target, dict) else target
+    return f"{step['op']} {target} {json.dumps(step['body'])}"
+
+
+@click.group()
+def cli() -> None:
+    pass
+
+
+@cli.command('business-units')
+@click.option('--name', 'names', required=True, multiple=True, help='Base name of a business unit, repeatable.')
+@click.option('--model-set', default=None, type=str, help='Model set of the roles, the base roles\' when not set.')
+@click.option('--output', default='access.json', type=str)
+def business_units(names: List[str], model_set: str, output: str) -> None:
+    state = merge_states([business_unit_state(name, model_set) for name in names])
+    with open(output, 'w') as f:
+        json.dump(state, f, indent=2)
+    click.echo(f"Wrote {len(state['groups'])} groups and {len(state['roles'])} roles to {output}")
+
+
+@cli.command()
+@click.option('--state', 'state_path', required=True, type=str, help='Desired state json file.')
+@click.option('--workers', default=8, type=int, help='Number of reads made at the same time.')
+def plan(state_path: str, workers: int) -> None:
+    with open(state_path) as f:
+        desired = json.load(f)
+    steps = make_plan(looker_sdk.init40(), desired, workers)
+    for step in steps:
+        click.echo(_describe(step))
+    click.echo(f"{len(steps)} changes")
+
+
+@cli.command()
+@click.option('--state', 'state_path', required=True, type=str, help='Desired state json file.')
+@click.option('--workers', default=16, type=int, help='Number of changes made at the same time.')
+@click.option('--rate-limit', default=20, type=float, help='Starting API calls per second, lowered when throttled.')
+@click.option('--dryrun', is_flag=True, default=False)
+def apply(state_path: str, workers: int, rate_limit: float, dryrun: bool) -> None:
+    with open(state_path) as f:
+        desired = json.load(f)
+    sdk = looker_sdk.init40()
+    steps = make_plan(sdk, desired, min(workers, 8))
+    click.echo(f"{len(steps)} changes")
+    if dryrun:
+        for step in steps:
+            click.echo(_describe(step) + " (Dry Run)")
+        return
+    failed = apply_plan(sdk, steps, workers, rate_limit)
+    if failed:
+        click.echo(f"Failed steps: {[step['step'] for step in failed]}")
+
+
+if __name__ == "__main__":
+    cli()
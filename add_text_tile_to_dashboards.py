@@ -10,26 +10,34 @@ Recommend using Ctrl + F to find these in the script and update them.
 from __future__ import absolute_import
 
 import click
+import copy
+import functools
 import looker_sdk
-import json
 from typing import List
 
+from bulk_api import run_concurrently
+from look_results import stream_look_rows
+from looker_session import mount_connection_pool
+
 
 sdk = looker_sdk.init40()
 
+# Dashboards are checked and updated this many at a time in bulk mode, with progress reported after each batch
+BULK_BATCH_SIZE = 500
+
 
-def _get_dashboard_list(look_id: int) -> List[int]:
+def _get_dashboard_list(look_id: int) -> List[str]:
     """Get a list of dashboards from a look."""
-    look_data = sdk.run_look(look_id=look_id, result_format="json", apply_vis=True)
-    return [v for d in json.loads(look_data) for _, v in d.items()]
+    return [value for row in stream_look_rows(sdk, look_id, apply_vis=True) for value in row.values()
+            if value is not None]
 
 
-def add_legal_text_tile(dashboard_num: int, dashboard_list_initial: List[int], is_dryrun: bool) -> None:
+def add_legal_text_tile(dashboard_num: int, dashboard_list_initial: List[str], is_dryrun: bool) -> None:
     """Add a text tile to dashboards, if they don't have already have it.
     Assumes the text tile is created in at least one dashboard - this will be used to add to additional dashboards. """
 
-    # create empty list of dashboards to remove from list
-    dashboard_list_with_text_tile = []
+    # create empty set of dashboards to remove from list
+    dashboard_list_with_text_tile = set()
 
     # check if dashboards already have the text tile
     for dashboard_id in dashboard_list_initial:
@@ -38,7 +46,7 @@ def add_legal_text_tile(dashboard_num: int, dashboard_list_initial: List[int], i
             if body['dashboard_elements'][element]['type'] == 'text':
                 title_text = body['dashboard_elements'][element]['title_text'] or ''
                 if title_text == 'ADD_TITLE_HERE' or title_text.startswith('ADD MORE HERE IF NEEDED'):
-                    dashboard_list_with_text_tile.append(dashboard_id)
+                    dashboard_list_with_text_tile.add(dashboard_id)
                 else:
                     continue
 
@@ -67,6 +75,61 @@ def add_legal_text_tile(dashboard_num: int, dashboard_list_initial: List[int], i
     click.echo(f"Text tiles were added to the following dashboards: {dashboard_list_final}")
 
 
+def _has_text_tile(elements: list) -> bool:
+    """Whether any of a dashboard's elements is the text tile."""
+    for element in elements:
+        if element.type == 'text':
+            title_text = element.title_text or ''
+            if title_text == 'ADD_TITLE_HERE' or title_text.startswith('ADD MORE HERE IF NEEDED'):
+                return True
+    return False
+
+
+def add_legal_text_tile_bulk(dashboard_num: int, dashboard_list_initial: List[str], is_dryrun: bool,
+                             workers: int = 16) -> None:
+    """Same as add_legal_text_tile for thousands of dashboards. Only the type and title_text of each dashboard's
+    elements are fetched, `workers` dashboards at a time, and the missing text tiles are created in parallel,
+    BULK_BATCH_SIZE dashboards per batch."""
+    if workers > 10:
+        # requests only keeps 10 connections open by default
+        mount_connection_pool(sdk, workers)
+
+    # Load in the text tile
+    text_tile = None
+    for element in sdk.dashboard_dashboard_elements(str(dashboard_num)):
+        if element.type == 'text' and element.title_text == 'Data Disclaimer':
+            text_tile = element
+    if text_tile is None:
+        raise click.ClickException(f"Dashboard {dashboard_num} does not have the 'Data Disclaimer' text tile")
+
+    def add_text_tile(dashboard_id):
+        if _has_text_tile(sdk.dashboard_dashboard_elements(str(dashboard_id), fields='type,title_text')):
+            return False
+        if not is_dryrun:
+            text_tile_body = copy.copy(text_tile)
+            text_tile_body.dashboard_id = dashboard_id
+            sdk.create_dashboard_element(text_tile_body)
+        return True
+
+    dashboard_list_final = []
+    failed_dashboard_list = []
+    for start in range(0, len(dashboard_list_initial), BULK_BATCH_SIZE):
+        batch = dashboard_list_initial[start:start + BULK_BATCH_SIZE]
+        for dashboard_id, added, error in run_concurrently(add_text_tile, batch, workers):
+            if error is not None:
+                click.echo(f"Dashboard {dashboard_id}: failed with {error!r}")
+                failed_dashboard_list.append(dashboard_id)
+            elif added:
+                if is_dryrun:
+                    click.echo(f"Updating Dashboard {dashboard_id} to include {text_tile}")
+                dashboard_list_final.append(dashboard_id)
+        click.echo(f"Checked {start + len(batch)} of {len(dashboard_list_initial)} dashboards")
+
+    click.echo(f"Text tiles were added to the following dashboards: {dashboard_list_final}")
+    if failed_dashboard_list:
+        click.echo(f"Failed dashboards: {failed_dashboard_list}")
+
+
 @click.group()
 def cli() -> None:
     pass
@@ -75,24 +138,28 @@ def cli() -> None:
 @cli.command()
 @click.option('--prod', is_flag=True, default=False)
 @click.option('--dryrun', is_flag=True, default=False)
-def add_legal_tile(prod: bool, dryrun: bool) -> None:
+@click.option('--bulk', is_flag=True, default=False,
+              help='Check and update dashboards concurrently, fetching only the element fields needed.')
+@click.option('--workers', default=16, type=int, help='Number of dashboards handled at the same time with --bulk.')
+def add_legal_tile(prod: bool, dryrun: bool, bulk: bool, workers: int) -> None:
     # look id that returns a list of dashboards that meet criteria
     look_id = ''
     # dashboard number that has the sample text tile that will be added to additional dashboards
     dashboard_num = ''
+    add_text_tile = functools.partial(add_legal_text_tile_bulk, workers=workers) if bulk else add_legal_text_tile
 
     if prod:
         dashboards = _get_dashboard_list(look_id)
         cont = input(f"Continue updating {len(dashboards)} dashboards? (y/n)")  # nosec
         if cont == "y":
-            add_legal_text_tile(
+            add_text_tile(
                 dashboard_num=dashboard_num,
                 dashboard_list_initial=dashboards,
                 is_dryrun=dryrun
             )
     else:
         dashboard_list_initial = ['####', '####']
-        add_legal_text_tile(
+        add_text_tile(
             dashboard_num=dashboard_num,
             dashboard_list_initial=dashboard_list_initial,
             is_dryrun=dryrun
@@ -0,0 +1,106 @@
+'''
+Benchmarks the raw json listing path in sdk_listing against the SDK's model structuring
+on a large synthetic all_dashboards response. No Looker instance is needed.
+
+    python bench_sdk_listing.py --rows 50000
+'''
+
+import json
+import time
+import types
+from typing import Sequence
+
+import click
+from looker_sdk.rtl import transport, serialize
+from looker_sdk.sdk.api40 import methods, models
+
+import sdk_listing
+
+
+class _StubAuth:
+    settings = types.SimpleNamespace(base_url='https://localhost:19999')
+
+    def authenticate(self, transport_options):
+        return {}
+
+
+class _StubTransport(transport.Transport):
+    '''
+    Answers every request with the same canned json body
+    '''
+    def __init__(self, body: bytes):
+        self.body = body
+
+    @classmethod
+    def configure(cls, settings):
+        raise NotImplementedError
+
+    def request(self, method, path, query_params=None, body=None, authenticator=None, transport_options=None):
+        return transport.Response(ok=True, value=self.body, response_mode=transport.ResponseMode.STRING)
+
+
+def _synthetic_dashboards(rows: int) -> bytes:
+    return json.dumps([
+        {
+            'id': str(i),
+            'title': f'Dashboard {i}',
+            'description': 'Synthetic dashboard used for benchmarking ' * 3,
+            'folder_id': str(i % 500),
+            'content_favorite_id': None,
+            'content_metadata_id': str(i),
+            'hidden': False,
+            'query_timezone': 'UTC',
+            'readonly': False,
+            'refresh_interval': None,
+            'user_id': str(i % 2000),
+            'slug': f'slug{i}',
+            'preferred_viewer': 'dashboards-next',
+            'folder': {'id': str(i % 500), 'name': f'Folder {i % 500}', 'parent_id': '1', 'content_metadata_id': str(i % 500)},
+            'can': {'index': True, 'show': True, 'copy': True},
+        }
+        for i in range(rows)
+    ]).encode('utf-8')
+
+
+def _time(fn, repeat: int):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fn()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+
+@click.command()
+@click.option('--rows', default=20000, type=int, help='Number of dashboards in the synthetic response.')
+@click.option('--repeat', default=3, type=int, help='Runs per path, the fastest is reported.')
+def bench(rows: int, repeat: int) -> None:
+    sdk = methods.Looker40SDK(_StubAuth(), serialize.deserialize40, serialize.serialize40,
+                              _StubTransport(_synthetic_dashboards(rows)), '4.0')
+    fields = ['id', 'title']
+
+    def model_path():
+        # What the scripts did before: structure every dashboard into a model, then flatten it back to columns
+        columns = {}
+        for item in sdk.get('/dashboards', Sequence[models.DashboardBase]):
+            for key in item.__dict__.keys():
+                columns.setdefault(key, []).append(item[key])
+        return columns
+
+    def records_path():
+        return sdk_listing.fetch_records(sdk, '/dashboards', fields)
+
+    def columns_path():
+        return sdk_listing.fetch_columns(sdk, '/dashboards', fields)
+
+    click.echo(f'{rows} dashboards, json decoder: {sdk_listing._json_loads.__module__}')
+    baseline, _ = _time(model_path, repeat)
+    click.echo(f'SDK models + flatten:   {baseline:8.3f}s')
+    for name, fn in [('fetch_records', records_path), ('fetch_columns', columns_path)]:
+        elapsed, _ = _time(fn, repeat)
+        click.echo(f'{name + ":":<24}{elapsed:8.3f}s  ({baseline / elapsed:5.1f}x faster)')
+
+
+if __name__ == "__main__":
+    bench()
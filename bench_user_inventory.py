@@ -0,0 +1,154 @@
+'''
+Benchmarks user_inventory against the inactive_looker_users notebook's original pipeline on a large
+synthetic all_users response, reporting runtime and peak memory. No Looker instance is needed.
+
+    python bench_user_inventory.py --rows 50000
+'''
+
+import json
+import re
+import time
+import tracemalloc
+from typing import Sequence
+
+import click
+import pandas as pd
+from looker_sdk.rtl import serialize, transport
+from looker_sdk.sdk.api40 import methods, models
+
+import user_inventory
+from bench_sdk_listing import _StubAuth
+
+
+class _ProjectingTransport(transport.Transport):
+    '''
+    Answers every request with the same users, keeping only the fields (and nested fields) in the
+    fields query parameter like the API does
+    '''
+    def __init__(self, users: list):
+        self.users = users
+
+    @classmethod
+    def configure(cls, settings):
+        raise NotImplementedError
+
+    def request(self, method, path, query_params=None, body=None, authenticator=None, transport_options=None):
+        users = self.users
+        if query_params and query_params.get('fields'):
+            fields = re.findall(r'(\w+)(?:\(([^)]*)\))?', query_params['fields'])
+            users = [
+                {key: _project(user.get(key), nested.split(',') if nested else None) for key, nested in fields}
+                for user in users
+            ]
+        return transport.Response(ok=True, value=json.dumps(users).encode('utf-8'),
+                                  response_mode=transport.ResponseMode.STRING)
+
+
+def _project(value, nested_fields: list):
+    if nested_fields is None or not isinstance(value, dict):
+        return value
+    return {field: value.get(field) for field in nested_fields}
+
+
+def _credentials(i: int, email: str, days_ago: int) -> dict:
+    return {
+        'email': email,
+        'created_at': '2019-01-01T00:00:00.000+00:00',
+        'logged_in_at': (pd.Timestamp('2023-01-01', tz='UTC') - pd.Timedelta(days=days_ago)).isoformat(),
+        'is_disabled': False,
+        'type': 'email',
+        'url': f'https://localhost:19999/api/4.0/users/{i}/credentials_email',
+        'user_url': f'https://localhost:19999/api/4.0/users/{i}',
+        'can': {'show_password_reset_url': True},
+    }
+
+
+def _synthetic_users(rows: int) -> list:
+    return [
+        {
+            'id': str(i),
+            'display_name': f'User {i}',
+            'first_name': 'User',
+            'last_name': str(i),
+            'email': f'user{i}@example.com',
+            'is_disabled': i % 17 == 0,
+            'presumed_looker_employee': i % 101 == 0,
+            'verified_looker_employee': False,
+            'locale': 'en',
+            'home_folder_id': str(i),
+            'personal_folder_id': str(i),
+            'group_ids': [str(i % 50), str(i % 7)],
+            'role_ids': [str(i % 5)],
+            'credentials_email': _credentials(i, f'user{i}@example.com', i % 700),
+            'credentials_saml': _credentials(i, f'User{i}@example.com', i % 400) if i % 3 == 0 else None,
+            'credentials_looker_openid': _credentials(i, f'user{i}@looker.com', i % 30) if i % 250 == 0 else None,
+            'credentials_google': None,
+            'credentials_ldap': None,
+            'credentials_oidc': None,
+            'credentials_api3': [],
+            'credentials_embed': [],
+            'sessions': [],
+            'can': {'show': True, 'index': True, 'show_details': True, 'sudo': True},
+        }
+        for i in range(rows)
+    ]
+
+
+def _notebook_pipeline(sdk) -> pd.DataFrame:
+    # The notebook's cells before user_inventory, run as they were
+    all_users = sdk.get('/users', Sequence[models.User])
+    user_shell_lists = {k: [] for k in models.User().__dict__}
+    for user in all_users:
+        for key in user_shell_lists.keys():
+            try:
+                user_shell_lists[key].append(user[key].__dict__)
+            except Exception:
+                user_shell_lists[key].append(user[key])
+    user_df = pd.DataFrame(user_shell_lists)
+    for col in user_df.columns:
+        if any(type(user_df[col].iloc[i]) == dict for i in range(len(user_df[col]))):
+            user_df = pd.concat([user_df.drop([col], axis=1), user_df[col].apply(pd.Series).add_prefix(f'{col}_')],
+                                axis=1)
+    user_df['id'] = user_df['id'].astype(int)
+    user_df = user_df.set_index('id').sort_index()
+    logged_in_columns = user_df.columns[user_df.columns.str.contains('logged_in_at')]
+    user_df[logged_in_columns] = user_df[logged_in_columns].apply(lambda x: pd.to_datetime(x, utc=True))
+    user_df['last_login_date'] = user_df[logged_in_columns].apply(lambda x: x.max(), axis=1)
+    user_df['is_looker_employee'] = user_df[['presumed_looker_employee', 'verified_looker_employee']].apply(
+        lambda x: x.max(), axis=1)
+    user_df['email'] = user_df[['credentials_email_email', 'credentials_looker_openid_email',
+                                'credentials_saml_email']].fillna('~').apply(lambda x: x.min(), axis=1)
+    return user_df
+
+
+def _measure(fn):
+    tracemalloc.start()
+    start = time.perf_counter()
+    result = fn()
+    elapsed = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return elapsed, peak, result
+
+
+@click.command()
+@click.option('--rows', default=20000, type=int, help='Number of users in the synthetic response.')
+def bench(rows: int) -> None:
+    sdk = methods.Looker40SDK(_StubAuth(), serialize.deserialize40, serialize.serialize40,
+                              _ProjectingTransport(_synthetic_users(rows)), '4.0')
+
+    click.echo(f'{rows} users')
+    baseline, baseline_peak, old_df = _measure(lambda: _notebook_pipeline(sdk))
+    click.echo(f'notebook pipeline:  {baseline:8.3f}s  peak {baseline_peak / 2 ** 20:8.1f} MiB')
+    elapsed, peak, new_df = _measure(lambda: user_inventory.build_user_inventory(sdk))
+    click.echo(f'user_inventory:     {elapsed:8.3f}s  peak {peak / 2 ** 20:8.1f} MiB  '
+               f'({baseline / elapsed:5.1f}x faster, {baseline_peak / peak:5.1f}x less memory)')
+
+    # both pipelines have to agree on the derived columns
+    assert (pd.to_datetime(old_df['last_login_date'], utc=True) == new_df['last_login_date']).all()
+    assert (old_df['email'].where(old_df['email'] != '~').fillna('') == new_df['email'].fillna('')).all()
+    assert (old_df['is_looker_employee'].astype(bool) == new_df['is_looker_employee']).all()
+
+
+if __name__ == "__main__":
+    bench()
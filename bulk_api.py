@@ -0,0 +1,173 @@
+
+import functools
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Iterable, Iterator, Tuple
+
+from looker_sdk.error import SDKError
+
+
+# Responses that mean the server is overloaded or throttling us, calls that get them are retried
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+
+def backoff_delay(attempt: int, retry_after: str = None, base_delay: float = 1.0, max_delay: float = 60.0) -> float:
+    '''
+    Seconds to wait before retry number `attempt` (from 0): the Retry-After header when the server
+    sent one, an exponential, jittered delay otherwise
+    '''
+    if retry_after and retry_after.isdigit():
+        return min(max_delay, float(retry_after))
+    return min(max_delay, base_delay * 2 ** attempt) * random.uniform(0.5, 1.0)
+
+
+class RateLimiter:
+    '''
+    Token bucket shared by every thread making API calls, allows `calls_per_second` on average
+    with bursts of up to `burst` calls
+    '''
+    def __init__(self, calls_per_second: float, burst: float = None):
+        self.calls_per_second = calls_per_second
+        self.burst = burst or max(1.0, calls_per_second)
+        self._tokens = self.burst
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def wait(self) -> None:
+        '''
+        Blocks until a call is allowed
+        '''
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.calls_per_second)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                delay = (1 - self._tokens) / self.calls_per_second
+            time.sleep(delay)
+
+
+class RateLimitedSDK:
+    '''
+    Wraps an SDK client so that every API method waits for the rate limiter first, everything
+    else is passed straight through. Use it in place of the client.
+    '''
+    def __init__(self, sdk, limiter: RateLimiter):
+        self._sdk = sdk
+        self._limiter = limiter
+
+    def __getattr__(self, name: str):
+        attr = getattr(self._sdk, name)
+        if name.startswith('_') or not callable(attr):
+            return attr
+
+        @functools.wraps(attr)
+        def call(*args, **kwargs):
+            self._limiter.wait()
+            return attr(*args, **kwargs)
+        return call
+
+
+class AdaptiveRateLimiter(RateLimiter):
+    '''
+    RateLimiter whose rate adapts to the server: it's halved when calls are throttled or fail with a
+    5xx (at most once per `cooldown` seconds, since calls in flight get pushed back together), and
+    grows back by `increase` calls per second after every successful call, up to `max_rate`
+    '''
+    def __init__(self, calls_per_second: float, min_rate: float = 1.0, max_rate: float = None,
+                 increase: float = 1.0, cooldown: float = 1.0):
+        super().__init__(calls_per_second)
+        self.min_rate = min_rate
+        self.max_rate = max_rate or calls_per_second
+        self.increase = increase
+        self.cooldown = cooldown
+        self._decreased = 0.0
+
+    def record(self, status_code: int) -> None:
+        with self._lock:
+            now = time.monotonic()
+            if status_code in RETRY_STATUSES:
+                if now - self._decreased >= self.cooldown:
+                    self.calls_per_second = max(self.min_rate, self.calls_per_second / 2)
+                    self._tokens = min(self._tokens, 1.0)
+                    self._decreased = now
+            elif status_code < 400:
+                self.calls_per_second = min(self.max_rate, self.calls_per_second + self.increase)
+
+
+class BackoffSDK(RateLimitedSDK):
+    '''
+    RateLimitedSDK that also retries calls answered with 429 / 5xx, waiting for the Retry-After header
+    or an exponential, jittered delay, and feeds every response status to an AdaptiveRateLimiter so all
+    threads slow down together while the server is pushing back.
+
+    The SDK doesn't put the status code on SDKError, so it's read from a response hook on the client's
+    session, which runs on the thread making the call.
+    '''
+    def __init__(self, sdk, limiter: RateLimiter, retries: int = 5, base_delay: float = 1.0, max_delay: float = 60.0):
+        super().__init__(sdk, limiter)
+        self._retries = retries
+        self._base_delay = base_delay
+        self._max_delay = max_delay
+        self._last_response = threading.local()
+        sdk.transport.session.hooks['response'].append(self._record_response)
+
+    def detach(self) -> None:
+        '''
+        Removes the response hook from the client's session once the wrapper isn't needed anymore
+        '''
+        hooks = self._sdk.transport.session.hooks['response']
+        if self._record_response in hooks:
+            hooks.remove(self._record_response)
+
+    def _record_response(self, response, *args, **kwargs):
+        self._last_response.status_code = response.status_code
+        self._last_response.retry_after = response.headers.get('Retry-After')
+        if isinstance(self._limiter, AdaptiveRateLimiter):
+            self._limiter.record(response.status_code)
+
+    def _delay(self, attempt: int) -> float:
+        return backoff_delay(attempt, getattr(self._last_response, 'retry_after', None), self._base_delay,
+                             self._max_delay)
+
+    def __getattr__(self, name: str):
+        attr = getattr(self._sdk, name)
+        if name.startswith('_') or not callable(attr):
+            return attr
+
+        @functools.wraps(attr)
+        def call(*args, **kwargs):
+            for attempt in range(self._retries + 1):
+                self._limiter.wait()
+                self._last_response.status_code = None
+                try:
+                    return attr(*args, **kwargs)
+                except SDKError:
+                    if self._last_response.status_code not in RETRY_STATUSES or attempt == self._retries:
+                        raise
+                time.sleep(self._delay(attempt))
+        return call
+
+
+def run_concurrently(fn: Callable, items: Iterable, max_workers: int = 8) -> Iterator[Tuple]:
+    '''
+    Calls fn(item) for every item on `max_workers` threads.
+
+    Yields (item, result, error) in the order of items as they finish, error is the exception fn
+    raised (result is None then), so one failing item doesn't stop the others.
+    '''
+    items = list(items)
+
+    def call(item):
+        try:
+            return fn(item), None
+        except Exception as e:
+            return None, e
+
+    with ThreadPoolExecutor(max_workers=max(1, max_workers)) as executor:
+        for item, (result, error) in zip(items, executor.map(call, items)):
+            yield item, result, error
@@ -3,7 +3,14 @@ from __future__ import absolute_import
 import looker_sdk
 from looker_sdk import models as ml
 import click
-from typing import List
+from typing import List, Optional
+
+from bulk_api import RateLimitedSDK, RateLimiter, run_concurrently
+from dashboard_snapshot import snapshot_before_change
+from explore_index import ExploreIndex
+from explore_migration_plan import PHASES, make_plan
+from looker_session import mount_connection_pool
+from query_clone_cache import QueryCloneCache
 
 
 sdk = looker_sdk.init40()
@@ -19,181 +26,170 @@ NEW_EXPLORE = ''
 
 
 def _change_dashboard_filters_explore(dashboard_num: str, old_model: str,
-                                      old_explore: str, new_model: str, new_explore: str, is_dryrun: bool) -> None:
-    """Change the model and/or explore of filters of a dashboard."""
-    filters = sdk.dashboard_dashboard_filters(dashboard_num)
+                                      old_explore: str, new_model: str, new_explore: str,
+                                      api: looker_sdk.methods40.Looker40SDK = sdk) -> List[str]:
+    """Change the model and/or explore of filters of a dashboard, returns the messages to report."""
+    filters = api.dashboard_dashboard_filters(dashboard_num)
     filter_list = []
+    messages = []
 
     for filter_num in range(0, len(filters)):
         if filters[filter_num].model == old_model and filters[filter_num].explore == old_explore:
             filter_id = filters[filter_num].id
             filters[filter_num].model = new_model
             filters[filter_num].explore = new_explore
-            if is_dryrun:
-                click.echo(f"Updating Dashboard Filter {filter_id} to include {filters[filter_num]}")
-            else:
-                sdk.update_dashboard_filter(filter_id, filters[filter_num])
+            api.update_dashboard_filter(filter_id, filters[filter_num])
             filter_list.append(filter_id)
         else:
             continue
     if len(filters) == 0:
-        click.echo("This dashboard does not exist or does not have any filters")
+        messages.append("This dashboard does not exist or does not have any filters")
     else:
-        click.echo(f"Dashboard ID {dashboard_num}: changed model/explore of {len(filter_list)} filters")
+        messages.append(f"Dashboard ID {dashboard_num}: changed model/explore of {len(filter_list)} filters")
+    return messages
 
 
 # Assumes view and field names are the same
-def _change_dashboard_explore(dashboard_list: List[str], old_model: str,
-                              old_explore: str, new_model: str, new_explore: str, is_dryrun: bool) -> None:
-    """Change the model and/or explore of tiles and filters on a given list of dashboards."""
-    click.echo(f"Changing dashboard list {dashboard_list}")
-    for dashboard_num in dashboard_list:
-        # change the explore/model of the dashboard filters
-        _change_dashboard_filters_explore(
-                            dashboard_num=dashboard_num,
-                            old_model=old_model,
-                            old_explore=old_explore,
-                            new_model=new_model,
-                            new_explore=new_explore,
-                            is_dryrun=is_dryrun
-                            )
-
-        tile_counter = 0
-        response_dashboard_elements = sdk.dashboard_dashboard_elements(dashboard_num)
-        if len(response_dashboard_elements) == 0:
-            click.echo("This dashboard does not exist or does not have query tiles")
-            continue
-
-        for index in range(0, len(response_dashboard_elements)):
-            # Check if it's a non-text tile AND is in target model/explore
-            if response_dashboard_elements[index].type != 'text':
-                # Look-linked tile - get query id of look
-                if 'look_id' in response_dashboard_elements[index]:
-                    if (response_dashboard_elements[index].look
-                        and response_dashboard_elements[index].look.query.model == old_model
-                            and response_dashboard_elements[index].look.query.view == old_explore):
-                        query_id = response_dashboard_elements[index].look.query_id
-                        look_id = response_dashboard_elements[index].look_id
-                    else:
-                        continue
-                # merged query tile - get query ids & change source query
-                elif 'merge_result_id' in response_dashboard_elements[index]:
-                    merge_id = response_dashboard_elements[index].merge_result_id
-                    merge_query = sdk.merge_query(merge_id)
-                    change_tile_flag = 0
-                    for source_query in merge_query.source_queries:
-                        source_query_id = source_query.query_id
-                        query = sdk.query(source_query_id)
+def _change_single_dashboard_explore(dashboard_num: str, old_model: str, old_explore: str, new_model: str,
+                                     new_explore: str, query_cache: QueryCloneCache,
+                                     api: looker_sdk.methods40.Looker40SDK = sdk) -> List[str]:
+    """Change the model and/or explore of tiles and filters on one dashboard, returns the messages to report."""
+    # change the explore/model of the dashboard filters
+    messages = _change_dashboard_filters_explore(
+                        dashboard_num=dashboard_num,
+                        old_model=old_model,
+                        old_explore=old_explore,
+                        new_model=new_model,
+                        new_explore=new_explore,
+                        api=api
+                        )
+
+    tile_counter = 0
+    response_dashboard_elements = api.dashboard_dashboard_elements(dashboard_num)
+    if len(response_dashboard_elements) == 0:
+        messages.append("This dashboard does not exist or does not have query tiles")
+        return messages
+
+    for index in range(0, len(response_dashboard_elements)):
+        # Check if it's a non-text tile AND is in target model/explore
+        if response_dashboard_elements[index].type != 'text':
+            # Look-linked tile - get query id of look
+            if 'look_id' in response_dashboard_elements[index]:
+                if (response_dashboard_elements[index].look
+                    and response_dashboard_elements[index].look.query.model == old_model
+                        and response_dashboard_elements[index].look.query.view == old_explore):
+                    query_id = response_dashboard_elements[index].look.query_id
+                    look_id = response_dashboard_elements[index].look_id
+                else:
+                    continue
+            # merged query tile - get query ids & change source query
+            elif 'merge_result_id' in response_dashboard_elements[index]:
+                merge_id = response_dashboard_elements[index].merge_result_id
+                merge_query = api.merge_query(merge_id)
+                change_tile_flag = 0
+                for source_query in merge_query.source_queries:
+                    source_query_id = source_query.query_id
+                    # source queries that were cloned already are known to be on the target model/explore
+                    new_query_id = query_cache.cached(source_query_id)
+                    if new_query_id is None:
+                        query = api.query(source_query_id)
                         if (query
                                 and query.model == old_model
                                 and query.view == old_explore):
-                            query_id = query.id
-                            change_tile_flag = 1
-
-                            # create a new query
-                            new_query_body = ml.WriteQuery(
-                                model=new_model,
-                                view=new_explore,
-                                fields=query.fields,
-                                pivots=query.pivots,
-                                fill_fields=query.fill_fields,
-                                filters=query.filters,
-                                filter_expression=query.filter_expression,
-                                sorts=query.sorts,
-                                limit=query.limit,
-                                column_limit=query.column_limit,
-                                total=query.total,
-                                row_total=query.row_total,
-                                subtotals=query.subtotals,
-                                vis_config=query.vis_config,
-                                filter_config=query.filter_config,
-                                visible_ui_sections=query.visible_ui_sections,
-                                dynamic_fields=query.dynamic_fields,
-                                query_timezone=query.query_timezone
-                            )
-                            new_query = sdk.create_query(new_query_body)
-                            source_query['query_id'] = new_query.id
-
-                    # if there are no queries from the target model/explore, skip element
-                    if change_tile_flag == 0:
-                        continue
-                else:
-                    # Normal query tile - get query id of tile
-                    if (response_dashboard_elements[index].query
-                        and response_dashboard_elements[index].query.model == old_model
-                            and response_dashboard_elements[index].query.view == old_explore):
-                        query_id = response_dashboard_elements[index].query_id
-                    else:
-                        continue
-            # if it's not a query tile, go back to top of loop
+                            new_query_id = query_cache.clone(source_query_id, query)
+                    if new_query_id is not None:
+                        change_tile_flag = 1
+                        source_query['query_id'] = new_query_id
+
+                # if there are no queries from the target model/explore, skip element
+                if change_tile_flag == 0:
+                    continue
             else:
-                continue
-
-            element_id = response_dashboard_elements[index].id
-            tile_counter += 1
-            # Merge queries
-            if 'merge_result_id' in response_dashboard_elements[index]:
-                # create new merge query body
-                merge_query_body = ml.WriteMergeQuery(
-                    column_limit=merge_query.column_limit,
-                    dynamic_fields=merge_query.dynamic_fields,
-                    pivots=merge_query.pivots,
-                    sorts=merge_query.sorts,
-                    total=merge_query.total,
-                    vis_config=merge_query.vis_config,
-                    source_queries=merge_query.source_queries
-                )
-
-                new_merge_query = sdk.create_merge_query(merge_query_body)
-                response_dashboard_elements[index].merge_result_id = new_merge_query.id
-                if is_dryrun:
-                    click.echo(f"Updating Dashboard Element {element_id} to include new merge result query "
-                               f"{response_dashboard_elements[index].merge_result_id}")
+                # Normal query tile - get query id of tile
+                if (response_dashboard_elements[index].query
+                    and response_dashboard_elements[index].query.model == old_model
+                        and response_dashboard_elements[index].query.view == old_explore):
+                    query_id = response_dashboard_elements[index].query_id
                 else:
-                    sdk.update_dashboard_element(element_id, response_dashboard_elements[index])
-            # non-Merge queries
+                    continue
+        # if it's not a query tile, go back to top of loop
+        else:
+            continue
+
+        element_id = response_dashboard_elements[index].id
+        tile_counter += 1
+        # Merge queries
+        if 'merge_result_id' in response_dashboard_elements[index]:
+            # create new merge query body
+            merge_query_body = ml.WriteMergeQuery(
+                column_limit=merge_query.column_limit,
+                dynamic_fields=merge_query.dynamic_fields,
+                pivots=merge_query.pivots,
+                sorts=merge_query.sorts,
+                total=merge_query.total,
+                vis_config=merge_query.vis_config,
+                source_queries=merge_query.source_queries
+            )
+
+            new_merge_query = api.create_merge_query(merge_query_body)
+            response_dashboard_elements[index].merge_result_id = new_merge_query.id
+            api.update_dashboard_element(element_id, response_dashboard_elements[index])
+        # non-Merge queries
+        else:
+            # clone the query onto the new model/explore, or reuse an earlier clone
+            new_query_id = query_cache.clone(query_id)
+            # update query id in dashboard
+            if 'look_id' in response_dashboard_elements[index]:
+                response_dashboard_elements[index].look.query_id = new_query_id
+                api.update_look(look_id, {'query_id': new_query_id})
             else:
-                # get query response
-                query = sdk.query(query_id)
-
-                # create a new query
-                new_query_body = ml.WriteQuery(
-                    model=new_model,
-                    view=new_explore,
-                    fields=query.fields,
-                    pivots=query.pivots,
-                    fill_fields=query.fill_fields,
-                    filters=query.filters,
-                    filter_expression=query.filter_expression,
-                    sorts=query.sorts,
-                    limit=query.limit,
-                    column_limit=query.column_limit,
-                    total=query.total,
-                    row_total=query.row_total,
-                    subtotals=query.subtotals,
-                    vis_config=query.vis_config,
-                    filter_config=query.filter_config,
-                    visible_ui_sections=query.visible_ui_sections,
-                    dynamic_fields=query.dynamic_fields,
-                    query_timezone=query.query_timezone
-                )
-                new_query = sdk.create_query(new_query_body)
-                # update query id in dashboard
-                if 'look_id' in response_dashboard_elements[index]:
-                    response_dashboard_elements[index].look.query_id = new_query.id
-                    if is_dryrun:
-                        click.echo(f"Updating Look {look_id} to include Explore: {new_query.view}"
-                                   f" & Model: {new_query.model}")
-                    else:
-                        sdk.update_look(look_id, {'query_id': new_query.id})
-                else:
-                    response_dashboard_elements[index].query_id = new_query.id
-                    if is_dryrun:
-                        click.echo(f"Updating Dashboard Element {element_id} to include Explore: {new_query.view}"
-                                   f" & Model: {new_query.model}")
-                    else:
-                        sdk.update_dashboard_element(element_id, response_dashboard_elements[index])
-        click.echo(f"Dashboard ID {dashboard_num}: changed model/explore of {tile_counter} tiles")
+                response_dashboard_elements[index].query_id = new_query_id
+                api.update_dashboard_element(element_id, response_dashboard_elements[index])
+    messages.append(f"Dashboard ID {dashboard_num}: changed model/explore of {tile_counter} tiles")
+    return messages
+
+
+def _change_dashboard_explore(dashboard_list: List[str], old_model: str,
+                              old_explore: str, new_model: str, new_explore: str,
+                              query_cache_path: Optional[str] = None, workers: int = 1,
+                              rate_limit: Optional[float] = None) -> None:
+    """Change the model and/or explore of tiles and filters on a given list of dashboards.
+
+    Each distinct query is cloned onto the new model/explore once, see QueryCloneCache. With query_cache_path the
+    clones are kept in that file, so re-runs reuse them. For a dry run, use make_plan from explore_migration_plan.
+
+    Dashboards are migrated by `workers` threads, while the filters and elements of each dashboard are still changed
+    one after another. rate_limit caps the API calls per second across all workers. The messages of each dashboard
+    are reported together, in the order of dashboard_list, and a failing dashboard doesn't stop the others."""
+    click.echo(f"Changing dashboard list {dashboard_list}")
+    if workers > 10:
+        # requests only keeps 10 connections open by default
+        mount_connection_pool(sdk, workers)
+    api = RateLimitedSDK(sdk, RateLimiter(rate_limit)) if rate_limit else sdk
+    query_cache = QueryCloneCache(api, new_model, new_explore, query_cache_path)
+
+    def change_dashboard(dashboard_num):
+        return _change_single_dashboard_explore(
+            dashboard_num=dashboard_num,
+            old_model=old_model,
+            old_explore=old_explore,
+            new_model=new_model,
+            new_explore=new_explore,
+            query_cache=query_cache,
+            api=api
+        )
+
+    failed_dashboards = []
+    for dashboard_num, messages, error in run_concurrently(change_dashboard, dashboard_list, workers):
+        if error is not None:
+            click.echo(f"Dashboard ID {dashboard_num}: failed with {error!r}")
+            failed_dashboards.append(dashboard_num)
+            continue
+        for message in messages:
+            click.echo(message)
+    click.echo(f"Created {query_cache.created_count} new queries, reused {query_cache.reused_count}")
+    if failed_dashboards:
+        click.echo(f"Failed dashboards: {failed_dashboards}")
 
 
 @click.group()
@@ -203,11 +199,33 @@ def cli() -> None:
 
 @cli.command()
 @click.option('--prod', is_flag=True, default=False)
-@click.option('--dryrun', is_flag=True, default=False)
-def change_dashboard_explore(prod: bool, dryrun: bool) -> None:
+@click.option('--dryrun', is_flag=True, default=False,
+              help='Plan the changes with explore_migration_plan and report them, without changing anything.')
+@click.option('--query-cache', 'query_cache_path', default=None, type=str,
+              help='File to keep cloned query ids in, so re-runs reuse them.')
+@click.option('--workers', default=1, type=int, help='Number of dashboards migrated at the same time.')
+@click.option('--rate-limit', default=None, type=float, help='Maximum API calls per second across all workers.')
+@click.option('--from-index', 'index_path', default=None, type=str,
+              help='Refresh this explore index and migrate every dashboard on the old model/explore in it, '
+                   'instead of the dashboard lists.')
+@click.option('--snapshot', 'snapshot_store', default=None, type=str,
+              help='Snapshot the dashboards into this store first, so they can be restored with dashboard_snapshot.py.')
+def change_dashboard_explore(prod: bool, dryrun: bool, query_cache_path: Optional[str], workers: int,
+                             rate_limit: Optional[float], index_path: Optional[str],
+                             snapshot_store: Optional[str]) -> None:
     dashboard_list = DEV_DASH_LIST
     if prod:
         dashboard_list = PROD_DASH_LIST
+    if index_path:
+        dashboard_list = ExploreIndex.refreshed(index_path, sdk).dashboard_ids(OLD_MODEL, OLD_EXPLORE)
+    if dryrun:
+        steps = make_plan(sdk, dashboard_list, [], OLD_MODEL, OLD_EXPLORE, NEW_MODEL, NEW_EXPLORE, workers)
+        for ops in PHASES:
+            click.echo(f"{', '.join(ops)}: {len([step for step in steps if step['op'] in ops])} steps")
+        click.echo("Dry run, nothing changed. Use explore_migration_plan.py plan / apply to write and run the plan.")
+        return
+    if snapshot_store:
+        snapshot_before_change(snapshot_store, sdk, dashboard_list)
 
     _change_dashboard_explore(
         dashboard_list=dashboard_list,
@@ -215,7 +233,9 @@ def change_dashboard_explore(prod: bool, dryrun: bool) -> None:
         old_explore=OLD_EXPLORE,
         new_model=NEW_MODEL,
         new_explore=NEW_EXPLORE,
-        is_dryrun=dryrun
+        query_cache_path=query_cache_path,
+        workers=workers,
+        rate_limit=rate_limit
     )
 
 
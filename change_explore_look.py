@@ -1,10 +1,17 @@
 from __future__ import absolute_import
 
+import functools
 import looker_sdk
 from looker_sdk import models as ml
 from looker_sdk.error import SDKError
 import click
-from typing import List
+from typing import List, Optional, Tuple
+
+from bulk_api import run_concurrently
+from explore_index import ExploreIndex
+from looker_session import mount_connection_pool
+from query_clone_cache import QueryCloneCache
+from sdk_listing import iter_content
 
 
 PROD_LOOKS = []
@@ -17,46 +24,29 @@ NEW_EXPLORE = ''
 
 sdk = looker_sdk.init40()
 
+# Only what's needed to tell which model / explore a Look is on
+LOOK_SCAN_FIELDS = ['id', 'query_id', 'deleted', 'query(model,view)']
+LOOK_SCAN_PAGE_SIZE = 1000
+
 
 def _change_look_explore(look_list: List[str], old_model: str, old_explore: str, new_model: str, new_explore: str,
-                         is_dryrun: bool) -> None:
+                         is_dryrun: bool, query_cache_path: Optional[str] = None) -> None:
     """Change the model and/or explore of a Look"""
     completed_look_list = []
+    query_cache = QueryCloneCache(sdk, new_model, new_explore, query_cache_path, dry_run=is_dryrun)
     for look_id in look_list:
         try:
             look = sdk.look(look_id)
             if look.query.model == old_model and look.query.view == old_explore:
-                query = look.query
-
-            # create a new query
-                new_query_body = ml.WriteQuery(
-                    model=new_model,
-                    view=new_explore,
-                    fields=query.fields,
-                    pivots=query.pivots,
-                    fill_fields=query.fill_fields,
-                    filters=query.filters,
-                    filter_expression=query.filter_expression,
-                    sorts=query.sorts,
-                    limit=query.limit,
-                    column_limit=query.column_limit,
-                    total=query.total,
-                    row_total=query.row_total,
-                    subtotals=query.subtotals,
-                    vis_config=query.vis_config,
-                    filter_config=query.filter_config,
-                    visible_ui_sections=query.visible_ui_sections,
-                    dynamic_fields=query.dynamic_fields,
-                    query_timezone=query.query_timezone
-                )
-                new_query = sdk.create_query(new_query_body)
-
-                look.query_id = new_query.id
+                # clone the query onto the new model/explore, or reuse an earlier clone
+                new_query_id = query_cache.clone(look.query_id, look.query)
+
+                look.query_id = new_query_id
                 if is_dryrun:
-                    click.echo(f"Updating Look {look_id} to include Explore: {new_query.view}"
-                               f" & Model: {new_query.model}")
+                    click.echo(f"Updating Look {look_id} to include Explore: {new_explore}"
+                               f" & Model: {new_model}")
                 else:
-                    sdk.update_look(look_id, {'query_id': new_query.id})
+                    sdk.update_look(look_id, {'query_id': new_query_id})
                 completed_look_list.append(look_id)
 
             else:
@@ -65,6 +55,68 @@ def _change_look_explore(look_list: List[str], old_model: str, old_explore: str,
             click.echo(f" Look {look_id} does not exist")
             continue
     click.echo(f"Changed explores of the following Looks: {completed_look_list}")
+    click.echo(f"Created {query_cache.created_count} new queries, reused {query_cache.reused_count}")
+
+
+def _scan_looks(look_list: List[str], old_model: str, old_explore: str) -> Tuple[dict, List[str], List[str]]:
+    """Page through all Looks, the trashed ones too, with a minimal projection. Returns ({look_id: query_id} of
+    the Looks in look_list that are on the old model/explore, ids in look_list that don't exist, ids in look_list
+    that are soft deleted)."""
+    wanted = {str(look_id) for look_id in look_list}
+    found = set()
+    soft_deleted = set()
+    matches = {}
+    for look in iter_content(sdk, 'looks', LOOK_SCAN_FIELDS, page_size=LOOK_SCAN_PAGE_SIZE):
+        look_id = str(look.id)
+        if look_id not in wanted:
+            continue
+        found.add(look_id)
+        if look.deleted:
+            soft_deleted.add(look_id)
+        elif look.query and look.query.model == old_model and look.query.view == old_explore:
+            matches[look_id] = str(look.query_id)
+    not_found = [str(look_id) for look_id in look_list if str(look_id) not in found]
+    return matches, not_found, [str(look_id) for look_id in look_list if str(look_id) in soft_deleted]
+
+
+def _change_look_explore_bulk(look_list: List[str], old_model: str, old_explore: str, new_model: str,
+                              new_explore: str, is_dryrun: bool, query_cache_path: Optional[str] = None,
+                              workers: int = 8) -> None:
+    """Same as _change_look_explore for thousands of Looks: one paged scan finds the matching Looks, then only those
+    are updated, `workers` at a time. Each distinct query is fetched and cloned once."""
+    matches, not_found, soft_deleted = _scan_looks(look_list, old_model, old_explore)
+    click.echo(f"Found {len(matches)} of {len(look_list)} Looks on Explore: {old_explore} & Model: {old_model}")
+    if workers > 10:
+        # requests only keeps 10 connections open by default
+        mount_connection_pool(sdk, workers)
+    query_cache = QueryCloneCache(sdk, new_model, new_explore, query_cache_path, dry_run=is_dryrun)
+
+    def change_look(look_id):
+        # clone the query onto the new model/explore, or reuse an earlier clone
+        new_query_id = query_cache.clone(matches[look_id])
+        if not is_dryrun:
+            sdk.update_look(look_id, {'query_id': new_query_id})
+        return new_query_id
+
+    completed_look_list = []
+    failed_look_list = []
+    for look_id, new_query_id, error in run_concurrently(change_look, matches, workers):
+        if error is not None:
+            click.echo(f"Look {look_id}: failed with {error!r}")
+            failed_look_list.append(look_id)
+            continue
+        if is_dryrun:
+            click.echo(f"Updating Look {look_id} to include Explore: {new_explore}"
+                       f" & Model: {new_model}")
+        completed_look_list.append(look_id)
+    click.echo(f"Changed explores of the following Looks: {completed_look_list}")
+    click.echo(f"Created {query_cache.created_count} new queries, reused {query_cache.reused_count}")
+    if not_found:
+        click.echo(f"The following Looks do not exist: {not_found}")
+    if soft_deleted:
+        click.echo(f"The following Looks are in the trash and were not changed: {soft_deleted}")
+    if failed_look_list:
+        click.echo(f"Failed Looks: {failed_look_list}")
 
 
 @click.group()
@@ -75,17 +127,30 @@ def cli() -> None:
 @cli.command()
 @click.option('--prod', is_flag=True, default=False)
 @click.option('--dryrun', is_flag=True, default=False)
-def change_look_explore(prod: bool, dryrun: bool) -> None:
+@click.option('--query-cache', 'query_cache_path', default=None, type=str,
+              help='File to keep cloned query ids in, so re-runs reuse them.')
+@click.option('--from-index', 'index_path', default=None, type=str,
+              help='Refresh this explore index and migrate every Look on the old model/explore in it, '
+                   'instead of the Look lists.')
+@click.option('--bulk', is_flag=True, default=False,
+              help='Find the Looks to change with one paged scan and update them concurrently.')
+@click.option('--workers', default=8, type=int, help='Number of Looks updated at the same time with --bulk.')
+def change_look_explore(prod: bool, dryrun: bool, query_cache_path: Optional[str], index_path: Optional[str],
+                        bulk: bool, workers: int) -> None:
     look_list = DEV_LOOKS
     if prod:
         look_list = PROD_LOOKS
-    _change_look_explore(
+    if index_path:
+        look_list = ExploreIndex.refreshed(index_path, sdk).look_ids(OLD_MODEL, OLD_EXPLORE)
+    change_explore = functools.partial(_change_look_explore_bulk, workers=workers) if bulk else _change_look_explore
+    change_explore(
         look_list=look_list,
         old_model=OLD_MODEL,
         old_explore=OLD_EXPLORE,
         new_model=NEW_MODEL,
         new_explore=NEW_EXPLORE,
         is_dryrun=dryrun,
+        query_cache_path=query_cache_path,
     )
 
 
@@ -2,6 +2,14 @@
 import looker_sdk
 import pandas as pd
 import os
+import configparser
+import contextlib
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from looker_session import get_sdk
+from sdk_listing import content_df
 
 
 def get_user_groups(user_id: int, admin_sdk: looker_sdk.sdk.api31.methods.Looker31SDK):
@@ -26,28 +34,6 @@ def test_user_set_initial_groups(admin_sdk: looker_sdk.sdk.api31.methods.Looker3
             admin_sdk.add_group_user(group_id, body)
 
 
-def df_from_sdk_all(all_api_endpoint):
-    '''
-    Generates a pandas DataFrame from a looker_sdk API endpoint
-    '''
-    all_dict = {}
-    for item in all_api_endpoint:
-        for key in item.__dict__.keys():
-            try:
-                all_dict[key]
-            # No value in all_dict[key] yet
-            except KeyError:
-                all_dict[key] = []
-            try:
-                all_dict[key].append(item[key])
-            # No value in item[key]
-            except KeyError:
-                all_dict[key].append(None)
-    
-    df = pd.DataFrame(all_dict)
-    return df
-
-
 def get_group_ids(group_df: pd.DataFrame, group_names: list):
     '''
     Returns a list of group_ids from a list of group names
@@ -55,358 +41,496 @@ def get_group_ids(group_df: pd.DataFrame, group_names: list):
     return group_df[group_df['name'].isin(group_names)].id.tolist()
 
 
-def append_or_create_changed_group_content_df(real_user: looker_sdk.models.User, current_group_name: str, orig_df: pd.DataFrame, new_df: pd.DataFrame, changed_content_df: pd.DataFrame, create_new: bool, add_or_remove: str): 
-    if add_or_remove == 'remove':
-        temp_df_missing = orig_df[~orig_df['id'].isin(new_df['id'])][['id', 'title']]
-        temp_df_missing['user_id'] = real_user.id
-        temp_df_missing['user_email'] = real_user.email
-        temp_df_missing['group_name_changed'] = current_group_name
-        temp_df_missing['add_or_remove'] = 'remove'
-        temp_df_missing['missing_or_new'] = 'missing'
-        temp_df_new = new_df[~new_df['id'].isin(orig_df['id'])][['id', 'title']]
-        temp_df_new['user_id'] = real_user.id
-        temp_df_new['user_email'] = real_user.email
-        temp_df_new['group_name_changed'] = current_group_name
-        temp_df_new['add_or_remove'] = 'remove'
-        temp_df_new['missing_or_new'] = 'new'
-    else:
-        temp_df_missing = orig_df[~orig_df['id'].isin(new_df['id'])][['id', 'title']]
-        temp_df_missing['user_id'] = real_user.id
-        temp_df_missing['user_email'] = real_user.email
-        temp_df_missing['group_name_changed'] = current_group_name
-        temp_df_missing['add_or_remove'] = 'add'
-        temp_df_missing['missing_or_new'] = 'missing'
-        temp_df_new = new_df[~new_df['id'].isin(orig_df['id'])][['id', 'title']]
-        temp_df_new['user_id'] = real_user.id
-        temp_df_new['user_email'] = real_user.email
-        temp_df_new['group_name_changed'] = current_group_name
-        temp_df_new['add_or_remove'] = 'add'
-        temp_df_new['missing_or_new'] = 'new'
-
-    if create_new:
-        # changed_content df doesn't exist yet
-        changed_content = pd.concat([temp_df_missing, temp_df_new], ignore_index=True)
-        changed_content.reset_index()
-        return changed_content
-
-    else:
-        # Concatenate the temp df to the existing df
-        changed_content = pd.concat([changed_content_df, temp_df_missing, temp_df_new], ignore_index=True)
-        changed_content.reset_index()
-        return changed_content
+GROUP_CHANGED_CONTENT_COLUMNS = ['id', 'title', 'user_id', 'user_email', 'group_name_changed', 'add_or_remove', 'missing_or_new']
+USER_CHANGED_CONTENT_COLUMNS = ['id', 'title', 'user_id', 'user_email', 'missing_or_new']
 
 
-def check_group_dashboard_look_access(admin_sdk: looker_sdk.sdk.api31.methods.Looker31SDK, group_df: pd.DataFrame, test_user_id: int, user_group_to_test: int, group_names_to_add: list = [], group_names_to_remove: list = []):
+class ChangedContentBuilder:
     '''
-    Checks access for all members of a group, returns df of members whose dashboard / look access has changed along with the dashboards/looks that changed for them. Starting point for debugging.
-
-    user_group_to_test: int - should be an individual integer, iterate through list of group_ids and append df to get all results
+    Collects changed dashboards / looks one column chunk at a time and only builds the df once, at the end.
 
+    stream_path: str - also append every chunk to this .csv or .parquet file as it comes in
+    keep_in_memory: bool - set to False with a stream_path to keep memory flat on big audits, to_df()
+    then returns stream_path instead of a df. Streaming to .parquet needs pyarrow.
     '''
-    # Setting variables
-    test_user = admin_sdk.user(test_user_id)
-    users_in_group = admin_sdk.all_group_users(user_group_to_test)
-    
-    # Iterate through each user in the current group
-    for real_user in users_in_group:
-        if real_user.id == 141: # we don't want to include the test_user in this, or it will throw errors
-            continue
+    def __init__(self, columns: list, empty_message: str, stream_path: str = None, keep_in_memory: bool = True):
+        if not keep_in_memory and not stream_path:
+            raise ValueError('keep_in_memory=False needs a stream_path, or the changed content would be lost')
+        if stream_path and stream_path.endswith('.parquet'):
+            # fail before the audit starts rather than on its first changed chunk
+            try:
+                import pyarrow
+            except ImportError:
+                raise ImportError(f'Streaming to {stream_path} needs pyarrow, install it or stream to a .csv')
+        self.columns = columns
+        self.empty_message = empty_message
+        self.stream_path = stream_path
+        self.keep_in_memory = keep_in_memory
+        self.row_count = 0
+        self._chunks = {column: [] for column in columns}
+        self._parquet_writer = None
+        if stream_path and os.path.exists(stream_path):
+            os.remove(stream_path)
+
+    def add(self, orig_df: pd.DataFrame, new_df: pd.DataFrame, **constant_columns) -> None:
+        '''
+        Adds the content in orig_df but not new_df as 'missing', and the content in new_df but not orig_df as 'new'.
+        constant_columns fill in the remaining columns, e.g. user_id=real_user.id
+        '''
+        for missing_or_new, from_df, other_df in [('missing', orig_df, new_df), ('new', new_df, orig_df)]:
+            changed = from_df[~from_df['id'].isin(other_df['id'])]
+            if changed.empty:
+                continue
+            chunk = {'id': changed['id'].tolist(), 'title': changed['title'].tolist(), 'missing_or_new': [missing_or_new] * len(changed)}
+            for column, value in constant_columns.items():
+                chunk[column] = [value] * len(changed)
+            self._add_chunk(chunk)
+
+    def _add_chunk(self, chunk: dict) -> None:
+        self.row_count += len(chunk['id'])
+        if self.keep_in_memory:
+            for column in self.columns:
+                self._chunks[column].extend(chunk[column])
+        if self.stream_path:
+            self._stream(pd.DataFrame(chunk, columns=self.columns))
+
+    def _stream(self, chunk_df: pd.DataFrame) -> None:
+        if self.stream_path.endswith('.parquet'):
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+            table = pa.Table.from_pandas(chunk_df.astype(str), preserve_index=False)
+            if self._parquet_writer is None:
+                self._parquet_writer = pq.ParquetWriter(self.stream_path, table.schema)
+            self._parquet_writer.write_table(table)
         else:
-            # Extracting group information
-            original_groups = get_user_groups(real_user.id, admin_sdk)
+            chunk_df.to_csv(self.stream_path, mode='a', header=not os.path.exists(self.stream_path), index=False)
 
-        # Remove groups individually from each of these users
-        if group_names_to_remove:
-            for group_name in group_names_to_remove:
+    def to_df(self):
+        if self._parquet_writer is not None:
+            self._parquet_writer.close()
+            self._parquet_writer = None
+        if self.row_count == 0:
+            return self.empty_message
+        if not self.keep_in_memory:
+            return self.stream_path
+        return pd.DataFrame(self._chunks, columns=self.columns)
 
-                print('##############################################')
-                print(f'Gathering Data from User {real_user.id}')
 
-                # Setting the test_user's groups equal to the real_user's groups
-                test_user_set_initial_groups(admin_sdk=admin_sdk, test_user=test_user, real_user=real_user)
-                if sorted(admin_sdk.user(test_user_id).group_ids) != sorted(original_groups):
-                    raise Exception("The Test User's groups aren't the same as the actual_user's groups")
+def get_group_signature(group_ids: list) -> tuple:
+    '''
+    Returns a canonical, hashable signature for a set of group_ids. Users with the same signature
+    have the same dashboard / look access. Group 1 (All Users) is ignored, every user has it.
+    '''
+    return tuple(sorted(set(group_ids) - {1}))
 
-                # Create the list of group_ids to remove from our test_user
-                group_ids_to_remove = get_group_ids(group_df, [group_name])
 
-                # Sudo as the new user (must have API keys set up in 'looker_sudo.ini' folder in same folder as the script)
-                if 'looker_sudo.ini' not in os.listdir('.'):
-                    raise Exception('Must have looker_sudo.ini file containing API keys in same directory as this script!')
+class TestUserGroups:
+    '''
+    Keeps the test user's groups in memory, so moving the test user from one set of groups to
+    the next only adds / removes the groups that differ. Group 1 (All Users) is never touched.
+    '''
+    def __init__(self, admin_sdk: looker_sdk.sdk.api31.methods.Looker31SDK, test_user_id: int):
+        self.admin_sdk = admin_sdk
+        self.test_user_id = test_user_id
+        self.group_ids = set(get_user_groups(test_user_id, admin_sdk))
+
+    def add(self, group_id: int) -> None:
+        self.admin_sdk.add_group_user(group_id, {'user_id': self.test_user_id})
+        self.group_ids.add(group_id)
+
+    def remove(self, group_id: int) -> None:
+        self.admin_sdk.delete_group_user(group_id, self.test_user_id) # Note that this uses the user.id, not body!
+        self.group_ids.discard(group_id)
+
+    def sync(self, group_ids: list) -> None:
+        '''
+        Applies only the difference between the test user's current groups and group_ids
+        '''
+        target_group_ids = set(group_ids)
+        for group_id in self.group_ids - target_group_ids - {1}:
+            self.remove(group_id)
+        for group_id in target_group_ids - self.group_ids - {1}:
+            self.add(group_id)
+
+    def verify(self, group_ids: list) -> None:
+        '''
+        Checks the test user's groups against group_ids with a single read
+        '''
+        actual_group_ids = get_user_groups(self.test_user_id, self.admin_sdk)
+        if sorted(actual_group_ids) != sorted(group_ids):
+            # Someone else changed the test user, start over from what's actually there
+            self.group_ids = set(actual_group_ids)
+            raise Exception("The Test User's groups aren't the same as the actual_user's groups")
+
+
+def order_by_group_similarity(items: list, get_group_ids) -> list:
+    '''
+    Orders items by group signature, so items with the same groups are next to each other and items
+    sharing their lowest group ids are close together, which keeps the number of group changes needed
+    by TestUserGroups.sync low. A sort, so it stays cheap with thousands of distinct signatures.
 
-                sdk_sudo = looker_sdk.init31('looker_sudo.ini')
+    get_group_ids: function - returns the group ids of an item
+    '''
+    return sorted(items, key=lambda item: get_group_signature(get_group_ids(item)))
 
-                print('Generating original dashboard and look access')
 
-                # Get all dashboards from user's current group permissions
-                dashboard_orig_df = df_from_sdk_all(sdk_sudo.all_dashboards())
+class SudoTestUser:
+    '''
+    A test user whose groups get changed to simulate real users. The API keys used to sudo
+    as this user live in their own section of config_file.
+    '''
+    def __init__(self, user_id: int, config_file: str = 'looker_sudo.ini', section: str = 'Looker'):
+        self.user_id = user_id
+        self.config_file = config_file
+        self.section = section
+        # Held while the test user's groups are being changed, two workers must never share a test user
+        self.lock = threading.Lock()
+        self._groups = None
+
+    def groups(self, admin_sdk: looker_sdk.sdk.api31.methods.Looker31SDK) -> TestUserGroups:
+        '''
+        The test user's groups, read from Looker the first time only
+        '''
+        if self._groups is None:
+            self._groups = TestUserGroups(admin_sdk, self.user_id)
+        return self._groups
+
+    def init_sudo_sdk(self):
+        # Sudo as the new user (must have API keys set up in 'looker_sudo.ini' folder in same folder as the script)
+        # The client is created once per test user and reused, so it only logs in again when its token expires
+        return get_sdk(self.config_file, self.section, api_version='3.1')
+
+
+class TestUserPool:
+    '''
+    A pool of test users, so several users can be simulated at once. Each test user needs
+    its own section in the config file with its own API keys and a test_user_id, e.g.
+
+    [TestUser1]
+    base_url = https://[COMPANY_NAME].looker.com:19999
+    client_id = TEST_USER_1_CLIENT_ID
+    client_secret = TEST_USER_1_CLIENT_SECRET
+    test_user_id = 141
+    '''
+    def __init__(self, test_users: list):
+        if not test_users:
+            raise Exception('A TestUserPool needs at least one test user!')
+        self.test_users = test_users
+        self._available = queue.Queue()
+        for test_user in test_users:
+            self._available.put(test_user)
+
+    @classmethod
+    def from_config(cls, config_file: str = 'looker_sudo.ini'):
+        '''
+        Creates one test user per section of config_file that has a test_user_id
+        '''
+        parser = configparser.ConfigParser()
+        parser.read(config_file)
+        return cls([
+            SudoTestUser(int(parser[section]['test_user_id']), config_file, section)
+            for section in parser.sections() if 'test_user_id' in parser[section]
+        ])
+
+    def __len__(self):
+        return len(self.test_users)
+
+    def user_ids(self) -> set:
+        return {test_user.user_id for test_user in self.test_users}
+
+    @contextlib.contextmanager
+    def checkout(self):
+        '''
+        Blocks until a test user is free, and holds it until the with block exits
+        '''
+        test_user = self._available.get()
+        try:
+            with test_user.lock:
+                yield test_user
+        finally:
+            self._available.put(test_user)
 
-                # Get all looks from user's current group permissions
-                looks_orig_df = df_from_sdk_all(sdk_sudo.all_looks())
 
-                # body to be used in group assignment
-                body = {
-                    'user_id': test_user.id
-                }
+def simulate_group_change(admin_sdk: looker_sdk.sdk.api31.methods.Looker31SDK, sudo_test_user: SudoTestUser, real_user: looker_sdk.models.User, original_groups: list, group_name: str, group_ids_to_change: list, add_or_remove: str):
+    '''
+    Gives the test user the groups of real_user, then adds or removes group_ids_to_change.
 
-                print(f'Removing group {group_name} from test_user')
+    returns the dashboard / look access from before and after the change as
+    (dashboard_orig_df, dashboard_new_df, looks_orig_df, looks_new_df)
+    '''
+    test_user_groups = sudo_test_user.groups(admin_sdk)
 
-                # Deleting deprecated groups (if any)
-                if group_ids_to_remove:
-                    for group_id in group_ids_to_remove:
-                        admin_sdk.delete_group_user(group_id, test_user.id)
+    print('##############################################')
+    print(f'Gathering Data from User {real_user.id} with test user {sudo_test_user.user_id}')
 
-                print('Generating new dashboard and look access')
+    # Setting the test_user's groups equal to the real_user's groups
+    test_user_groups.sync(original_groups)
+    test_user_groups.verify(original_groups)
 
-                # Get all dashboards from user's updated group permissions
-                dashboard_new_df = df_from_sdk_all(sdk_sudo.all_dashboards())
+    sdk_sudo = sudo_test_user.init_sudo_sdk()
 
-                # Get all looks from user's updated group permissions
-                looks_new_df = df_from_sdk_all(sdk_sudo.all_looks())
+    print('Generating original dashboard and look access')
 
-                print('------------------RESULTS---------------------')
+    # Get all dashboards from user's current group permissions
+    dashboard_orig_df = content_df(sdk_sudo, 'dashboards', raw=True)
 
-                # Check that dashboard access is the same
-                if list(dashboard_orig_df['id']) == list(dashboard_new_df['id']):
-                    print('Dashboard access is the same!')
-                else:
-                    print('WARNING: Dashboard access is not the same, storing results')
-                    try:
-                        changed_dashboards = append_or_create_changed_group_content_df(real_user, group_name, dashboard_orig_df, dashboard_new_df, changed_dashboards, create_new=False, add_or_remove='remove')
+    # Get all looks from user's current group permissions
+    looks_orig_df = content_df(sdk_sudo, 'looks', raw=True)
 
-                    # If we get here, it means that changed_dashboards hasn't been defined yet.
-                    except UnboundLocalError:
-                        changed_dashboards = append_or_create_changed_group_content_df(real_user, group_name, dashboard_orig_df, dashboard_new_df, changed_content_df=None, create_new=True, add_or_remove='remove')
+    if add_or_remove == 'remove':
+        print(f'Removing group {group_name} from test_user')
+        for group_id in group_ids_to_change:
+            test_user_groups.remove(group_id)
+    else:
+        print(f'Adding group {group_name} to test_user')
+        for group_id in group_ids_to_change:
+            test_user_groups.add(group_id)
 
-                # Check that Look access is the same
-                if list(looks_orig_df['id']) == list(looks_new_df['id']):
-                    print('Look access is the same!')
-                else:
-                    print('WARNING: Look access is not the same, storing results')
-                    try:
-                        changed_looks = append_or_create_changed_group_content_df(real_user, group_name, looks_orig_df, looks_new_df, changed_content_df=changed_looks, create_new=False, add_or_remove='remove')
-      
-                    # If we get here, it means that changed_dashboards hasn't been defined yet.
-                    except UnboundLocalError:
-                        changed_looks = append_or_create_changed_group_content_df(real_user, group_name, looks_orig_df, looks_new_df, changed_content_df=None, create_new=True, add_or_remove='remove')
+    print('Generating new dashboard and look access')
 
+    # Get all dashboards from user's updated group permissions
+    dashboard_new_df = content_df(sdk_sudo, 'dashboards', raw=True)
 
-        if group_names_to_add:
-            for group_name in group_names_to_add:
+    # Get all looks from user's updated group permissions
+    looks_new_df = content_df(sdk_sudo, 'looks', raw=True)
 
-                # Setting variables
-                test_user = admin_sdk.user(test_user_id)
-                users_in_group = get_group_ids(group_df, group_names_to_add)
+    return dashboard_orig_df, dashboard_new_df, looks_orig_df, looks_new_df
 
-                print('##############################################')
-                print(f'Gathering Data from User {real_user.id}')
 
-                # Extracting group information
-                original_groups = get_user_groups(real_user.id, admin_sdk)
+def _simulate_group_change_with_pool(admin_sdk: looker_sdk.sdk.api31.methods.Looker31SDK, test_user_pool: TestUserPool, simulation_kwargs: dict) -> tuple:
+    '''
+    Runs simulate_group_change with whichever test user in the pool is free first.
 
-                # Setting the test_user's groups equal to the real_user's groups
-                test_user_set_initial_groups(admin_sdk=admin_sdk, test_user=test_user, real_user=real_user)
-                if sorted(admin_sdk.user(test_user_id).group_ids) != sorted(original_groups):
-                    raise Exception("The Test User's groups aren't the same as the actual_user's groups")
+    returns (result, None), or (None, error) if the simulation failed. The test user's groups are then
+    put back the way they were before the simulation, so the next simulation starts from a known state.
+    '''
+    with test_user_pool.checkout() as sudo_test_user:
+        test_user_groups = sudo_test_user.groups(admin_sdk)
+        groups_before = set(test_user_groups.group_ids)
+        try:
+            return simulate_group_change(admin_sdk=admin_sdk, sudo_test_user=sudo_test_user, **simulation_kwargs), None
+        except Exception as e:
+            try:
+                # the failure may have left the groups half changed, start from what's actually there
+                test_user_groups.group_ids = set(get_user_groups(sudo_test_user.user_id, admin_sdk))
+                test_user_groups.sync(groups_before)
+            except Exception as restore_error:
+                print(f'ERROR: could not restore the groups of test user {sudo_test_user.user_id}: {restore_error}')
+            return None, e
 
-                # Create the list of group_ids to remove from our test_user
-                group_ids_to_add = get_group_ids(group_df, [group_name])
 
-                # Sudo as the new user (must have API keys set up in 'looker_sudo.ini' folder in same folder as the script)
-                if 'looker_sudo.ini' not in os.listdir('.'):
-                    raise Exception('Must have looker_sudo.ini file containing API keys in same directory as this script!')
+def check_group_dashboard_look_access(admin_sdk: looker_sdk.sdk.api31.methods.Looker31SDK, group_df: pd.DataFrame, test_user_id: int, user_group_to_test: int, group_names_to_add: list = [], group_names_to_remove: list = [], dedupe_group_signatures: bool = False, test_user_pool: TestUserPool = None, changed_dashboards_path: str = None, changed_looks_path: str = None, keep_results_in_memory: bool = True):
+    '''
+    Checks access for all members of a group, returns df of members whose dashboard / look access has changed along with the dashboards/looks that changed for them. Starting point for debugging.
 
-                sdk_sudo = looker_sdk.init31('looker_sudo.ini')
+    user_group_to_test: int - should be an individual integer, iterate through list of group_ids and append df to get all results
 
-                print('Generating original dashboard and look access')
+    dedupe_group_signatures: bool - members with exactly the same groups see exactly the same content, so only
+    simulate each change once per distinct set of groups and reuse the result for every matching member
 
-                # Get all dashboards from user's current group permissions
-                dashboard_orig_df = df_from_sdk_all(sdk_sudo.all_dashboards())
+    test_user_pool: TestUserPool - simulate several members at once, one per test user in the pool. Each
+    simulation runs on whichever test user is free next. When a pool is given test_user_id is ignored, it
+    defaults to a pool with only test_user_id in it
 
-                # Get all looks from user's current group permissions
-                looks_orig_df = df_from_sdk_all(sdk_sudo.all_looks())
+    A simulation that fails (e.g. someone else changed the test user) is reported and left out of the
+    results, the others carry on
 
-                # body to be used in group assignment
-                body = {
-                    'user_id': test_user.id
-                }
+    changed_dashboards_path / changed_looks_path: str - stream results to these .csv / .parquet files as they come in.
+    With keep_results_in_memory=False the paths are returned instead of dfs
 
-                print(f'Adding group {group_name} to test_user')
+    '''
+    if test_user_pool is None:
+        test_user_pool = TestUserPool([SudoTestUser(test_user_id)])
 
-                # Deleting deprecated groups (if any)
-                if group_ids_to_add:
-                    for group_id in group_ids_to_add:
-                        admin_sdk.add_group_user(group_id, body)
+    # Setting variables
+    users_in_group = admin_sdk.all_group_users(user_group_to_test)
 
-                print('Generating new dashboard and look access')
+    # Removals are checked before additions for every user
+    group_changes = [(group_name, 'remove') for group_name in group_names_to_remove] + \
+        [(group_name, 'add') for group_name in group_names_to_add]
 
-                # Get all dashboards from user's updated group permissions
-                dashboard_new_df = df_from_sdk_all(sdk_sudo.all_dashboards())
+    # Every (user, group change) to report on, and the simulations needed to cover them. A simulation is
+    # keyed by (group signature, group_name, add_or_remove) when deduping, otherwise by user
+    results_to_report = []
+    simulations = {}
 
-                # Get all looks from user's updated group permissions
-                looks_new_df = df_from_sdk_all(sdk_sudo.all_looks())
+    # Iterate through each user in the current group
+    for real_user in users_in_group:
+        if real_user.id in test_user_pool.user_ids(): # we don't want to include the test users in this, or it will throw errors
+            continue
 
-                print('------------------RESULTS---------------------')
+        # Extracting group information
+        original_groups = get_user_groups(real_user.id, admin_sdk)
+        simulation_user_key = get_group_signature(original_groups) if dedupe_group_signatures else real_user.id
+
+        for group_name, add_or_remove in group_changes:
+            simulation_key = (simulation_user_key, group_name, add_or_remove)
+            results_to_report.append((real_user, group_name, add_or_remove, simulation_key))
+            if simulation_key not in simulations:
+                simulations[simulation_key] = dict(
+                    real_user=real_user,
+                    original_groups=original_groups,
+                    group_name=group_name,
+                    # Create the list of group_ids to add / remove from our test_user
+                    group_ids_to_change=get_group_ids(group_df, [group_name]),
+                    add_or_remove=add_or_remove
+                )
+
+    # Order the simulations so similar sets of groups run close together, then run them as many at once as
+    # there are test users, each on whichever test user is free
+    ordered_simulations = order_by_group_similarity(list(simulations.items()), lambda simulation: simulation[1]['original_groups'])
+    simulated_access = {}
+    failed_simulations = {}
+    with ThreadPoolExecutor(max_workers=len(test_user_pool)) as executor:
+        futures = [
+            (simulation_key, executor.submit(_simulate_group_change_with_pool, admin_sdk, test_user_pool, simulation_kwargs))
+            for simulation_key, simulation_kwargs in ordered_simulations
+        ]
+        for simulation_key, future in futures:
+            result, error = future.result()
+            if error is None:
+                simulated_access[simulation_key] = result
+            else:
+                failed_simulations[simulation_key] = error
+
+    changed_dashboards = ChangedContentBuilder(GROUP_CHANGED_CONTENT_COLUMNS, 'No Missing Dashboards', changed_dashboards_path, keep_results_in_memory)
+    changed_looks = ChangedContentBuilder(GROUP_CHANGED_CONTENT_COLUMNS, 'No Missing Looks', changed_looks_path, keep_results_in_memory)
+
+    for real_user, group_name, add_or_remove, simulation_key in results_to_report:
+        if simulation_key in failed_simulations:
+            print(f'ERROR: User {real_user.id}, {add_or_remove} group {group_name} could not be checked: '
+                  f'{failed_simulations[simulation_key]}')
+            continue
+        dashboard_orig_df, dashboard_new_df, looks_orig_df, looks_new_df = simulated_access[simulation_key]
+        changed_columns = dict(user_id=real_user.id, user_email=real_user.email, group_name_changed=group_name, add_or_remove=add_or_remove)
 
-                # Check that dashboard access is the same
-                if list(dashboard_orig_df['id']) == list(dashboard_new_df['id']):
-                    print('Dashboard access is the same!')
-                else:
-                    print('WARNING: Dashboard access is not the same, storing results')
-                    try:
-                        changed_dashboards = append_or_create_changed_group_content_df(real_user, group_name, dashboard_orig_df, dashboard_new_df, changed_dashboards, create_new=False, add_or_remove='add')
+        print('##############################################')
+        print(f'User {real_user.id}, {add_or_remove} group {group_name}')
+        print('------------------RESULTS---------------------')
 
-                    # If we get here, it means that changed_dashboards hasn't been defined yet.
-                    except UnboundLocalError:
-                        changed_dashboards = append_or_create_changed_group_content_df(real_user, group_name, dashboard_orig_df, dashboard_new_df, changed_content_df=None, create_new=True, add_or_remove='add')
+        # Check that dashboard access is the same
+        if list(dashboard_orig_df['id']) == list(dashboard_new_df['id']):
+            print('Dashboard access is the same!')
+        else:
+            print('WARNING: Dashboard access is not the same, storing results')
+            changed_dashboards.add(dashboard_orig_df, dashboard_new_df, **changed_columns)
 
-                # Check that Look access is the same
-                if list(looks_orig_df['id']) == list(looks_new_df['id']):
-                    print('Look access is the same!')
-                else:
-                    print('WARNING: Look access is not the same, storing results')
-                    try:
-                        changed_looks = append_or_create_changed_group_content_df(real_user, group_name, looks_orig_df, looks_new_df, changed_content_df=changed_looks, create_new=False, add_or_remove='add')
+        # Check that Look access is the same
+        if list(looks_orig_df['id']) == list(looks_new_df['id']):
+            print('Look access is the same!')
+        else:
+            print('WARNING: Look access is not the same, storing results')
+            changed_looks.add(looks_orig_df, looks_new_df, **changed_columns)
 
-                    # If we get here, it means that changed_dashboards hasn't been defined yet.
-                    except UnboundLocalError:
-                        changed_looks = append_or_create_changed_group_content_df(real_user, group_name, looks_orig_df, looks_new_df, changed_content_df=None, create_new=True, add_or_remove='add')
+        print('##############################################')
 
-                print('##############################################')
+    if failed_simulations:
+        print(f'WARNING: {len(failed_simulations)} of {len(simulations)} simulations failed, see the errors above')
 
-    try:
-        changed_dashboards.iloc[0]
-    except UnboundLocalError:
-        changed_dashboards = 'No Missing Dashboards'
+    return changed_dashboards.to_df(), changed_looks.to_df()
 
-    try:
-        changed_looks.iloc[0]
-    except UnboundLocalError:
-        changed_looks = 'No Missing Looks'
 
-    return changed_dashboards, changed_looks
+def check_user_dashboard_look_access(admin_sdk: looker_sdk.sdk.api31.methods.Looker31SDK, group_df: pd.DataFrame, test_user_id: int, actual_user_email: str, group_names_to_add: list = [], group_names_to_remove: list = [], test_user_pool: TestUserPool = None):
+    '''
+    Checks how a single user's dashboard / look access changes when groups are added / removed.
 
+    test_user_pool: TestUserPool - simulate with whichever test user in the pool is free, test_user_id is
+    ignored when a pool is given
+    '''
+    if test_user_pool is None:
+        test_user_pool = TestUserPool([SudoTestUser(test_user_id)])
 
-def create_or_append_changed_user_content_df(real_user: looker_sdk.models.User, orig_df: pd.DataFrame, new_df: pd.DataFrame, changed_content_df: pd.DataFrame, create_new: bool): 
-    temp_df_missing = orig_df[~orig_df['id'].isin(new_df['id'])][['id', 'title']]
-    temp_df_missing['user_id'] = real_user.id
-    temp_df_missing['user_email'] = real_user.email
-    temp_df_missing['missing_or_new'] = 'missing'
-    temp_df_new = new_df[~new_df['id'].isin(orig_df['id'])][['id', 'title']]
-    temp_df_new['user_id'] = real_user.id
-    temp_df_new['user_email'] = real_user.email
-    temp_df_new['missing_or_new'] = 'new'
+    with test_user_pool.checkout() as sudo_test_user:
+        return _check_user_dashboard_look_access(admin_sdk, group_df, sudo_test_user, actual_user_email, group_names_to_add, group_names_to_remove)
 
-    if create_new:
-        # changed_content df doesn't exist yet
-        changed_content = pd.concat([temp_df_missing, temp_df_new], ignore_index=True)
-        changed_content.reset_index()
-        return changed_content
 
-    else:
-        # Concatenate the temp df to the existing df
-        changed_content = pd.concat([changed_content_df, temp_df_missing, temp_df_new], ignore_index=True)
-        changed_content.reset_index()
-        return changed_content
+def check_users_dashboard_look_access(admin_sdk: looker_sdk.sdk.api31.methods.Looker31SDK, group_df: pd.DataFrame, test_user_pool: TestUserPool, actual_user_emails: list, group_names_to_add: list = [], group_names_to_remove: list = []):
+    '''
+    Runs check_user_dashboard_look_access for several users at once, one per test user in the pool.
 
+    returns the changed dashboards / looks of all users concatenated, in the order of actual_user_emails
+    '''
+    with ThreadPoolExecutor(max_workers=len(test_user_pool)) as executor:
+        futures = [
+            executor.submit(check_user_dashboard_look_access, admin_sdk, group_df, None, actual_user_email,
+                            group_names_to_add, group_names_to_remove, test_user_pool)
+            for actual_user_email in actual_user_emails
+        ]
+        results = [future.result() for future in futures]
+
+    # Single users with no changes return a message instead of a df
+    changed_dashboards = [dashboards for dashboards, _ in results if isinstance(dashboards, pd.DataFrame)]
+    changed_looks = [looks for _, looks in results if isinstance(looks, pd.DataFrame)]
+    changed_dashboards = pd.concat(changed_dashboards, ignore_index=True) if changed_dashboards else 'No Missing Dashboards'
+    changed_looks = pd.concat(changed_looks, ignore_index=True) if changed_looks else 'No Missing Looks'
+    return changed_dashboards, changed_looks
 
-def check_user_dashboard_look_access(admin_sdk: looker_sdk.sdk.api31.methods.Looker31SDK, group_df: pd.DataFrame, test_user_id: int, actual_user_email: str, group_names_to_add: list = [], group_names_to_remove: list = []):
+
+def _check_user_dashboard_look_access(admin_sdk: looker_sdk.sdk.api31.methods.Looker31SDK, group_df: pd.DataFrame, sudo_test_user: SudoTestUser, actual_user_email: str, group_names_to_add: list, group_names_to_remove: list):
 
     # Setting variables
-    test_user = admin_sdk.user(test_user_id)
+    test_user_groups = sudo_test_user.groups(admin_sdk)
     real_user = admin_sdk.search_users(email=actual_user_email)[0]
 
     print('##############################################')
     print(f'Gathering Data from User {real_user.id}')
 
     # Extracting group information
-    original_groups = get_user_groups(real_user.id, admin_sdk)
+    original_groups = real_user.group_ids
 
     # Setting the test_user's groups equal to the real_user's groups
-    test_user_set_initial_groups(admin_sdk=admin_sdk, test_user=test_user, real_user=real_user)
-    if sorted(admin_sdk.user(test_user_id).group_ids) != sorted(original_groups):
-        raise Exception("The Test User's groups aren't the same as the actual_user's groups")
+    test_user_groups.sync(original_groups)
+    test_user_groups.verify(original_groups)
 
     # Create the lists of group_ids to add / remove from our test_user
     group_ids_to_add = get_group_ids(group_df, group_names_to_add)
     group_ids_to_remove = get_group_ids(group_df, group_names_to_remove)
 
-    # Sudo as the new user (must have API keys set up in 'looker_sudo.ini' folder in same folder as the script)
-    if 'looker_sudo.ini' not in os.listdir('.'):
-        raise Exception('Must have looker_sudo.ini file containing API keys in same directory as this script!')
-
-    sdk_sudo = looker_sdk.init31('looker_sudo.ini')
+    sdk_sudo = sudo_test_user.init_sudo_sdk()
 
     print('Generating original dashboard and look access')
 
     # Get all dashboards from user's current group permissions
-    dashboard_orig_df = df_from_sdk_all(sdk_sudo.all_dashboards())
+    dashboard_orig_df = content_df(sdk_sudo, 'dashboards', raw=True)
 
     # Get all looks from user's current group permissions
-    looks_orig_df = df_from_sdk_all(sdk_sudo.all_looks())
-
-    # body to be used in group assignment
-    body = {
-        'user_id': test_user.id
-    }
+    looks_orig_df = content_df(sdk_sudo, 'looks', raw=True)
 
     # Deleting deprecated groups (if any)
-    if group_ids_to_remove:
-        for group_id in group_ids_to_remove:
-            admin_sdk.delete_group_user(group_id, test_user.id)
+    for group_id in group_ids_to_remove:
+        test_user_groups.remove(group_id)
 
     # Adding new groups (if any)
-    if group_ids_to_add:
-        for group_id in group_ids_to_add:
-            admin_sdk.add_group_user(group_id, body)
+    for group_id in group_ids_to_add:
+        test_user_groups.add(group_id)
 
     print('Generating new dashboard and look access')
 
     # Get all dashboards from user's updated group permissions
-    dashboard_new_df = df_from_sdk_all(sdk_sudo.all_dashboards())
+    dashboard_new_df = content_df(sdk_sudo, 'dashboards', raw=True)
 
     # Get all looks from user's updated group permissions
-    looks_new_df = df_from_sdk_all(sdk_sudo.all_looks())
+    looks_new_df = content_df(sdk_sudo, 'looks', raw=True)
 
     print('------------------RESULTS---------------------')
 
+    changed_dashboards = ChangedContentBuilder(USER_CHANGED_CONTENT_COLUMNS, 'No Missing Dashboards')
+    changed_looks = ChangedContentBuilder(USER_CHANGED_CONTENT_COLUMNS, 'No Missing Looks')
+
     # Check that dashboard access is the same
     if list(dashboard_orig_df['id']) == list(dashboard_new_df['id']):
         print('Dashboard access is the same!')
     else:
         print('WARNING: Dashboard access is not the same, storing results')
-
-        try:
-            # if changed_dashboards:
-            changed_dashboards = create_or_append_changed_user_content_df(real_user, dashboard_orig_df, dashboard_new_df, changed_dashboards, create_new=False)
-
-        # If we get here, it means that changed_dashboards hasn't been defined yet.
-        except UnboundLocalError:
-            changed_dashboards = create_or_append_changed_user_content_df(real_user, dashboard_orig_df, dashboard_new_df, changed_content_df=None, create_new=True)
+        changed_dashboards.add(dashboard_orig_df, dashboard_new_df, user_id=real_user.id, user_email=real_user.email)
 
     # Check that Look access is the same
     if list(looks_orig_df['id']) == list(looks_new_df['id']):
         print('Look access is the same!')
     else:
         print('WARNING: Look access is not the same, storing results')
-        try:
-            changed_looks = create_or_append_changed_user_content_df(real_user, looks_orig_df, looks_new_df, changed_looks, create_new=False)
-
-        # If we get here, it means that changed_dashboards hasn't been defined yet.
-        except UnboundLocalError:
-            changed_looks = create_or_append_changed_user_content_df(real_user, looks_orig_df, looks_new_df, changed_content_df=None, create_new=True)
-
+        changed_looks.add(looks_orig_df, looks_new_df, user_id=real_user.id, user_email=real_user.email)
 
     print('##############################################')
 
-    try:
-        changed_dashboards.iloc[0]
-    except UnboundLocalError:
-        changed_dashboards = 'No Missing Dashboards'
-
-    try:
-        changed_looks.iloc[0]
-    except UnboundLocalError:
-        changed_looks = 'No Missing Looks'
-
-    return changed_dashboards, changed_looks
+    return changed_dashboards.to_df(), changed_looks.to_df()
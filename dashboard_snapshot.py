@@ -0,0 +1,427 @@
+'''
+Local snapshots of dashboards (attributes, elements, filters, layouts, the queries of their tiles and
+the query each linked Look shows), taken before destructive changes so they can be rolled back without going through the trash.
+
+    python dashboard_snapshot.py snapshot --store dashboard_snapshots --dashboards 1,2,3
+    python dashboard_snapshot.py list --store dashboard_snapshots
+    python dashboard_snapshot.py restore --store dashboard_snapshots --name <snapshot name>
+
+The store is content addressed: every dashboard, element, filter, layout and query is saved once as a
+gzipped json object named after the sha256 of its content, so identical queries and tiles are shared
+within and across snapshots. A snapshot is a small manifest of dashboard id -> object.
+'''
+
+import datetime
+import gzip
+import hashlib
+import json
+import os
+import threading
+import typing
+from typing import List, Optional
+
+import attr
+import click
+import looker_sdk
+from looker_sdk.error import SDKError
+from looker_sdk.rtl import serialize
+from looker_sdk.rtl.model import EXPLICIT_NULL, Model
+from looker_sdk.sdk.api40 import models
+
+from bulk_api import run_concurrently
+from sdk_listing import fetch_raw
+
+
+# Fields written back on restore, the rest of the snapshot is kept for reference only
+DASHBOARD_RESTORE_FIELDS = [
+    'title', 'description', 'hidden', 'query_timezone', 'refresh_interval', 'preferred_viewer', 'folder_id',
+    'alert_sync_with_dashboard_filter_enabled', 'background_color', 'crossfilter_enabled', 'filters_bar_collapsed',
+    'load_configuration', 'show_filters_bar', 'show_title', 'text_tile_text_color', 'tile_background_color',
+    'tile_text_color', 'title_color', 'appearance'
+]
+ELEMENT_RESTORE_FIELDS = [
+    'type', 'title', 'title_hidden', 'title_text', 'subtitle_text', 'body_text', 'note_display', 'note_state',
+    'note_text', 'refresh_interval', 'look_id', 'query_id', 'merge_result_id'
+]
+FILTER_RESTORE_FIELDS = [
+    'name', 'title', 'type', 'default_value', 'model', 'explore', 'dimension', 'row', 'listens_to_filters',
+    'allow_multiple_values', 'required', 'ui_config'
+]
+LAYOUT_COMPONENT_FIELDS = ['row', 'column', 'width', 'height']
+
+
+def _strip_can(value):
+    '''
+    Drops the 'can' permission maps the API adds to every object, they change per user and aren't content
+    '''
+    if isinstance(value, dict):
+        return {key: _strip_can(item) for key, item in value.items() if key != 'can'}
+    if isinstance(value, list):
+        return [_strip_can(item) for item in value]
+    return value
+
+
+class SnapshotStore:
+    '''
+    Content addressed store of dashboard snapshots in a local directory:
+
+        objects/ab/abcdef....json.gz - one object per distinct dashboard / element / filter / layout / query
+        snapshots/<name>.json        - {dashboard id: object id} for each snapshot
+    '''
+    def __init__(self, path: str):
+        self.path = path
+        self.raw_bytes = 0
+        self.stored_bytes = 0
+        self._lock = threading.Lock()
+        os.makedirs(os.path.join(path, 'objects'), exist_ok=True)
+        os.makedirs(os.path.join(path, 'snapshots'), exist_ok=True)
+
+    def _object_path(self, object_id: str) -> str:
+        return os.path.join(self.path, 'objects', object_id[:2], f'{object_id}.json.gz')
+
+    def put(self, value) -> str:
+        '''
+        Saves value unless an identical value is saved already, returns its object id
+        '''
+        data = json.dumps(value, sort_keys=True, separators=(',', ':')).encode('utf-8')
+        object_id = hashlib.sha256(data).hexdigest()
+        path = self._object_path(object_id)
+        if not os.path.exists(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            compressed = gzip.compress(data)
+            # write to a temporary file first, so other threads never see half an object
+            temp_path = f'{path}.{threading.get_ident()}.tmp'
+            with open(temp_path, 'wb') as f:
+                f.write(compressed)
+            os.replace(temp_path, path)
+            with self._lock:
+                self.stored_bytes += len(compressed)
+        return object_id
+
+    def get(self, object_id: str):
+        with gzip.open(self._object_path(object_id), 'rb') as f:
+            return json.loads(f.read())
+
+    def _put_element(self, element: dict) -> str:
+        element = dict(element)
+        # the Look of a Look-linked tile isn't part of the dashboard, but the query it shows can be changed
+        # along with it (e.g. change_explore_look), so its query_id is kept to restore
+        look = element.pop('look', None)
+        if look:
+            element['look'] = {'id': look.get('id'), 'query_id': look.get('query_id')}
+        if element.get('query'):
+            element['query'] = {'object': self.put(element['query'])}
+        if element.get('result_maker') and element['result_maker'].get('query'):
+            result_maker_query_id = self.put(element['result_maker']['query'])
+            element['result_maker'] = dict(element['result_maker'], query={'object': result_maker_query_id})
+        return self.put(element)
+
+    def _get_element(self, object_id: str) -> dict:
+        element = self.get(object_id)
+        if element.get('query'):
+            element['query'] = self.get(element['query']['object'])
+        if element.get('result_maker') and element['result_maker'].get('query'):
+            element['result_maker']['query'] = self.get(element['result_maker']['query']['object'])
+        return element
+
+    def put_dashboard(self, dashboard: dict) -> str:
+        dashboard = _strip_can(dashboard)
+        elements = dashboard.get('dashboard_elements') or []
+        filters = dashboard.get('dashboard_filters') or []
+        layouts = dashboard.get('dashboard_layouts') or []
+        return self.put({
+            'attributes': {key: value for key, value in dashboard.items()
+                           if key not in ('dashboard_elements', 'dashboard_filters', 'dashboard_layouts')},
+            'dashboard_elements': [self._put_element(element) for element in elements],
+            'dashboard_filters': [self.put(dashboard_filter) for dashboard_filter in filters],
+            'dashboard_layouts': [self.put(layout) for layout in layouts],
+        })
+
+    def get_dashboard(self, object_id: str) -> dict:
+        stored = self.get(object_id)
+        return dict(
+            stored['attributes'],
+            dashboard_elements=[self._get_element(element_id) for element_id in stored['dashboard_elements']],
+            dashboard_filters=[self.get(filter_id) for filter_id in stored['dashboard_filters']],
+            dashboard_layouts=[self.get(layout_id) for layout_id in stored['dashboard_layouts']],
+        )
+
+    def snapshot(self, sdk: looker_sdk.methods40.Looker40SDK, dashboard_ids: List[str], name: Optional[str] = None,
+                 max_workers: int = 16) -> str:
+        '''
+        Exports the dashboards `max_workers` at a time and saves them as a new snapshot, returns its name.
+        Dashboards that don't exist are left out, any other error stops the snapshot.
+        '''
+        name = name or datetime.datetime.now().strftime('%Y%m%d-%H%M%S-%f')
+
+        def export(dashboard_id):
+            try:
+                data = sdk.get(f'/dashboards/{dashboard_id}', str)
+            except SDKError:
+                return None
+            with self._lock:
+                self.raw_bytes += len(data)
+            return self.put_dashboard(json.loads(data))
+
+        dashboards = {}
+        for dashboard_id, object_id, error in run_concurrently(export, [str(i) for i in dashboard_ids], max_workers):
+            if error is not None:
+                raise error
+            if object_id is None:
+                click.echo(f"Dashboard {dashboard_id} does not exist, not in the snapshot")
+                continue
+            dashboards[dashboard_id] = object_id
+
+        manifest = {'name': name, 'created_at': datetime.datetime.now().isoformat(), 'dashboards': dashboards}
+        path = os.path.join(self.path, 'snapshots', f'{name}.json')
+        with open(f'{path}.tmp', 'w') as f:
+            json.dump(manifest, f)
+        os.replace(f'{path}.tmp', path)
+        return name
+
+    def snapshots(self) -> List[dict]:
+        '''
+        The manifests of every snapshot, oldest first
+        '''
+        manifests = []
+        for file_name in os.listdir(os.path.join(self.path, 'snapshots')):
+            if file_name.endswith('.json'):
+                with open(os.path.join(self.path, 'snapshots', file_name)) as f:
+                    manifests.append(json.load(f))
+        return sorted(manifests, key=lambda manifest: manifest['created_at'])
+
+    def manifest(self, name: str) -> dict:
+        with open(os.path.join(self.path, 'snapshots', f'{name}.json')) as f:
+            return json.load(f)
+
+    def restore(self, sdk: looker_sdk.methods40.Looker40SDK, name: str, dashboard_ids: Optional[List[str]] = None,
+                max_workers: int = 8) -> dict:
+        '''
+        Puts the dashboards back the way they were in the snapshot, `max_workers` dashboards at a time.
+        Returns {dashboard id: (messages, error)}.
+        '''
+        dashboards = self.manifest(name)['dashboards']
+        if dashboard_ids is not None:
+            dashboards = {str(i): dashboards[str(i)] for i in dashboard_ids}
+        return {
+            dashboard_id: (messages, error)
+            for dashboard_id, messages, error in run_concurrently(
+                lambda dashboard_id: restore_dashboard(sdk, self.get_dashboard(dashboards[dashboard_id])),
+                dashboards, max_workers)
+        }
+
+
+def _changed(current: dict, snapshot: dict, fields: List[str]) -> bool:
+    '''
+    Whether any of the fields differ between the live object and its snapshot
+    '''
+    return any(current.get(field) != snapshot.get(field) for field in fields)
+
+
+def _nested_model(field_type):
+    '''
+    The SDK model a field holds (e.g. the write model of an element's result_maker), None for plain values
+    '''
+    return next((arg for arg in typing.get_args(field_type) if isinstance(arg, type) and issubclass(arg, Model)), None)
+
+
+def _unsupported_fields(body: dict, model_type, prefix: str = '') -> List[str]:
+    '''
+    Dotted names of the fields in body that the installed SDK's write model doesn't have, and would be
+    dropped without a word when the body is converted (e.g. result_maker.filterables on looker_sdk 22)
+    '''
+    field_types = {field.name: field.type for field in attr.fields(attr.resolve_types(model_type))}
+    unsupported = []
+    for field, value in body.items():
+        if field not in field_types:
+            unsupported.append(prefix + field)
+        elif isinstance(value, dict) and _nested_model(field_types[field]) is not None:
+            unsupported += _unsupported_fields(value, _nested_model(field_types[field]), f'{prefix}{field}.')
+    return unsupported
+
+
+def _write_model(body: dict, model_type):
+    '''
+    body as an SDK write model, with an explicit null for every field that was empty in the snapshot, so
+    values set after the snapshot are cleared rather than left as they are. Nested objects (e.g. appearance)
+    can't be sent as an explicit null, those are left out. Fields the installed SDK's model doesn't have
+    can't be sent at all, they're reported so the restore isn't taken as complete.
+    '''
+    unsupported = _unsupported_fields(body, model_type)
+    if unsupported:
+        click.echo(f"WARNING: the installed looker_sdk's {model_type.__name__} has no {', '.join(unsupported)}, "
+                   f"those aren't restored. Upgrade looker_sdk to restore them.")
+    write_obj = serialize.converter40.structure({field: value for field, value in body.items() if value is not None},
+                                                model_type)
+    field_types = {field.name: field.type for field in attr.fields(attr.resolve_types(model_type))}
+    for field, value in body.items():
+        if value is None and field in field_types and _nested_model(field_types[field]) is None:
+            setattr(write_obj, field, EXPLICIT_NULL)
+    return write_obj
+
+
+def _restore_looks(sdk: looker_sdk.methods40.Looker40SDK, dashboard: dict) -> List[str]:
+    '''
+    Points the Looks linked from the dashboard's tiles back at the queries they showed in the snapshot
+    '''
+    messages = []
+    look_query_ids = {
+        element['look']['id']: element['look']['query_id'] for element in dashboard['dashboard_elements']
+        if element.get('look') and element['look'].get('query_id')
+    }
+    for look_id, query_id in look_query_ids.items():
+        try:
+            current_look = fetch_raw(sdk, f'/looks/{look_id}', ['query_id'])
+        except SDKError:
+            messages.append(f"Dashboard {dashboard['id']}: look {look_id} no longer exists, not restored")
+            continue
+        if str(current_look['query_id']) != str(query_id):
+            sdk.update_look(look_id, models.WriteLookWithQuery(query_id=query_id))
+            messages.append(f"Dashboard {dashboard['id']}: look {look_id} query restored")
+    return messages
+
+
+def _element_body(element: dict) -> dict:
+    body = {field: element.get(field) for field in ELEMENT_RESTORE_FIELDS}
+    if element.get('result_maker'):
+        # which dashboard filters the tile listens to
+        body['result_maker'] = {'filterables': element['result_maker'].get('filterables')}
+    return body
+
+
+def restore_dashboard(sdk: looker_sdk.methods40.Looker40SDK, dashboard: dict) -> List[str]:
+    '''
+    Makes a dashboard match its snapshot, writing only what differs. Elements are matched by id and filters
+    by name, the way overwrite_dashboard keeps them, and linked Looks get their snapshot query back.
+    Returns the messages to report.
+    '''
+    dashboard_id = dashboard['id']
+    messages = []
+    # also takes it out of the trash
+    sdk.update_dashboard(dashboard_id, _write_model(
+        dict({field: dashboard.get(field) for field in DASHBOARD_RESTORE_FIELDS}, deleted=False),
+        models.WriteDashboard))
+    messages += _restore_looks(sdk, dashboard)
+    current = fetch_raw(sdk, f'/dashboards/{dashboard_id}',
+                        ['dashboard_elements', 'dashboard_filters', 'dashboard_layouts'])
+
+    current_filters = {dashboard_filter['name']: dashboard_filter for dashboard_filter in current['dashboard_filters']}
+    for dashboard_filter in dashboard['dashboard_filters']:
+        body = {field: dashboard_filter.get(field) for field in FILTER_RESTORE_FIELDS}
+        current_filter = current_filters.get(dashboard_filter['name'])
+        if current_filter is None:
+            sdk.create_dashboard_filter(_write_model(dict(body, dashboard_id=dashboard_id),
+                                                     models.WriteCreateDashboardFilter))
+            messages.append(f"Dashboard {dashboard_id}: filter {dashboard_filter['name']} restored")
+        elif _changed(current_filter, body, FILTER_RESTORE_FIELDS):
+            sdk.update_dashboard_filter(current_filter['id'], _write_model(body, models.WriteDashboardFilter))
+            messages.append(f"Dashboard {dashboard_id}: filter {dashboard_filter['name']} updated")
+
+    current_elements = {element['id']: element for element in current['dashboard_elements']}
+    # snapshot element id -> id of the element it is now
+    element_id_map = {}
+    for element in dashboard['dashboard_elements']:
+        body = _element_body(element)
+        current_element = current_elements.get(element['id'])
+        if current_element is None:
+            new_element = sdk.create_dashboard_element(_write_model(dict(body, dashboard_id=dashboard_id),
+                                                                    models.WriteDashboardElement))
+            element_id_map[element['id']] = str(new_element.id)
+            messages.append(f"Dashboard {dashboard_id}: element {element['id']} restored as {new_element.id}")
+        else:
+            element_id_map[element['id']] = element['id']
+            if _element_body(current_element) != body:
+                sdk.update_dashboard_element(element['id'], _write_model(body, models.WriteDashboardElement))
+                messages.append(f"Dashboard {dashboard_id}: element {element['id']} updated")
+
+    # layout components of restored elements only exist once the elements do
+    if set(element_id_map.values()) - set(current_elements):
+        current = fetch_raw(sdk, f'/dashboards/{dashboard_id}', ['dashboard_layouts'])
+    current_layouts = {layout['id']: layout for layout in current['dashboard_layouts']}
+    for layout in dashboard['dashboard_layouts']:
+        current_layout = current_layouts.get(layout['id']) or next(iter(current_layouts.values()), None)
+        if current_layout is None:
+            continue
+        current_components = {
+            component['dashboard_element_id']: component for component in current_layout['dashboard_layout_components']
+        }
+        for component in layout['dashboard_layout_components']:
+            current_component = current_components.get(element_id_map.get(component['dashboard_element_id']))
+            if current_component is not None and _changed(current_component, component, LAYOUT_COMPONENT_FIELDS):
+                sdk.update_dashboard_layout_component(current_component['id'], _write_model(
+                    {field: component[field] for field in LAYOUT_COMPONENT_FIELDS},
+                    models.WriteDashboardLayoutComponent))
+
+    # remove what was added after the snapshot, last so the dashboard is never left without its tiles
+    snapshot_filter_names = {dashboard_filter['name'] for dashboard_filter in dashboard['dashboard_filters']}
+    for element_id in set(current_elements) - set(element_id_map.values()):
+        sdk.delete_dashboard_element(element_id)
+        messages.append(f"Dashboard {dashboard_id}: element {element_id} deleted")
+    for name, dashboard_filter in current_filters.items():
+        if name not in snapshot_filter_names:
+            sdk.delete_dashboard_filter(dashboard_filter['id'])
+            messages.append(f"Dashboard {dashboard_id}: filter {name} deleted")
+
+    messages.append(f"Dashboard {dashboard_id} restored")
+    return messages
+
+
+def snapshot_before_change(store_path: str, sdk: looker_sdk.methods40.Looker40SDK, dashboard_ids: List[str]) -> str:
+    '''
+    Hook for scripts that change dashboards: snapshots them and tells the user how to roll back
+    '''
+    store = SnapshotStore(store_path)
+    name = store.snapshot(sdk, dashboard_ids)
+    click.echo(f"Snapshot {name} of {len(dashboard_ids)} dashboards saved in {store_path}, roll back with: "
+               f"python dashboard_snapshot.py restore --store {store_path} --name {name}")
+    return name
+
+
+@click.group()
+def cli() -> None:
+    pass
+
+
+@cli.command()
+@click.option('--store', 'store_path', default='dashboard_snapshots', type=str)
+@click.option('--dashboards', required=True, type=str, help='Comma separated dashboard ids.')
+@click.option('--name', default=None, type=str, help='Defaults to the current time.')
+@click.option('--workers', default=16, type=int, help='Number of dashboards exported at the same time.')
+def snapshot(store_path: str, dashboards: str, name: Optional[str], workers: int) -> None:
+    sdk = looker_sdk.init40()
+    store = SnapshotStore(store_path)
+    dashboard_ids = [dashboard_id for dashboard_id in dashboards.split(',') if dashboard_id]
+    name = store.snapshot(sdk, dashboard_ids, name, workers)
+    click.echo(f"Snapshot {name}: {len(dashboard_ids)} dashboards, {store.raw_bytes} bytes of json, "
+               f"{store.stored_bytes} bytes of new objects")
+
+
+@cli.command(name='list')
+@click.option('--store', 'store_path', default='dashboard_snapshots', type=str)
+def list_snapshots(store_path: str) -> None:
+    for manifest in SnapshotStore(store_path).snapshots():
+        click.echo(f"{manifest['name']}: {len(manifest['dashboards'])} dashboards, taken {manifest['created_at']}")
+
+
+@cli.command()
+@click.option('--store', 'store_path', default='dashboard_snapshots', type=str)
+@click.option('--name', required=True, type=str)
+@click.option('--dashboards', default=None, type=str, help='Comma separated dashboard ids, defaults to all of them.')
+@click.option('--workers', default=8, type=int, help='Number of dashboards restored at the same time.')
+def restore(store_path: str, name: str, dashboards: Optional[str], workers: int) -> None:
+    sdk = looker_sdk.init40()
+    dashboard_ids = [dashboard_id for dashboard_id in dashboards.split(',') if dashboard_id] if dashboards else None
+    failed = []
+    for dashboard_id, (messages, error) in SnapshotStore(store_path).restore(sdk, name, dashboard_ids, workers).items():
+        if error is not None:
+            click.echo(f"Dashboard {dashboard_id}: failed with {error!r}")
+            failed.append(dashboard_id)
+            continue
+        for message in messages:
+            click.echo(message)
+    if failed:
+        raise click.ClickException(f"Failed to restore dashboards {failed}")
+
+
+if __name__ == "__main__":
+    cli()
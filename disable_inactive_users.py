@@ -1,19 +1,36 @@
 import looker_sdk
 import click
-from typing import List
+import datetime
+import itertools
 import json
+from typing import Iterable, Iterator, List
+
+from bulk_api import AdaptiveRateLimiter, BackoffSDK, run_concurrently
+from login_state_store import refreshed_store
+from look_results import look_column
+from looker_session import mount_connection_pool
+from sdk_listing import iter_content
 
 
 sdk = looker_sdk.init40()
 
+# Page size of the search_users listing of already disabled users
+USER_PAGE_SIZE = 1000
+# Users taken from the stream and disabled concurrently at a time in bulk mode
+BULK_BATCH_SIZE = 500
+
+
+def _iter_user_ids(look_id: int) -> Iterator[int]:
+    """Stream the User IDs from a look as its results download."""
+    return look_column(sdk, look_id, "ID", type=int, apply_vis=True)
+
 
 def _get_user_list(look_id: int) -> List[int]:
     """Get a list of users from a look."""
-    look_data = sdk.run_look(look_id=look_id, result_format="json", apply_vis=True)
-    return [v for d in json.loads(look_data) for k, v in d.items() if k == "ID"]
+    return list(_iter_user_ids(look_id))
 
 
-def _disable_inactive_users(user_id_list: List[int], is_dry_run: bool) -> None:
+def _disable_inactive_users(user_id_list: Iterable[int], is_dry_run: bool) -> None:
     """Disable users given a list of User IDs."""
     for user_id in user_id_list:
         user = sdk.user(user_id=str(user_id))
@@ -25,6 +42,68 @@ def _disable_inactive_users(user_id_list: List[int], is_dry_run: bool) -> None:
             click.echo(f"Disabled {user.email} with ID {str(user.id)}")
 
 
+def _disabled_user_ids() -> set:
+    """IDs of every user that is already disabled, from one projected search_users listing."""
+    return {str(user.id) for user in iter_content(sdk, 'users', ['id'], page_size=USER_PAGE_SIZE, is_disabled=True)}
+
+
+def _disable_inactive_users_bulk(user_id_list: Iterable[int], is_dry_run: bool, workers: int = 16,
+                                 rate_limit: float = 20, report_path: str = None) -> dict:
+    """Disable users concurrently, sending only is_disabled in the update and skipping users that are
+    already disabled. user_id_list is consumed BULK_BATCH_SIZE users at a time, so users are disabled while
+    a streamed list is still downloading. Returns a report of what was disabled, skipped and failed, also
+    written to report_path."""
+    already_disabled = _disabled_user_ids()
+    click.echo(f"{len(already_disabled)} users already disabled")
+
+    api = BackoffSDK(sdk, AdaptiveRateLimiter(rate_limit))
+    if workers > 10:
+        mount_connection_pool(sdk, workers)
+
+    def disable(user_id):
+        if is_dry_run:
+            return None
+        return api.update_user(user_id=user_id, body={'is_disabled': True}, fields='id,email').email
+
+    report = {
+        'run_at': datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        'dry_run': is_dry_run,
+        'disabled': [],
+        'already_disabled': [],
+        'failed': [],
+    }
+    seen = set()
+    user_ids = (str(user_id) for user_id in user_id_list)
+    try:
+        while True:
+            batch = list(itertools.islice(user_ids, BULK_BATCH_SIZE))
+            if not batch:
+                break
+            to_disable = []
+            for user_id in batch:
+                if user_id in seen:
+                    continue
+                seen.add(user_id)
+                if user_id in already_disabled:
+                    report['already_disabled'].append(user_id)
+                else:
+                    to_disable.append(user_id)
+            for user_id, email, error in run_concurrently(disable, to_disable, workers):
+                if error is not None:
+                    click.echo(f"Error disabling user with ID {user_id}: {error}")
+                    report['failed'].append({'id': user_id, 'error': str(error).strip()})
+                else:
+                    click.echo(f"Disabled {email or ''} with ID {user_id}" + (" (Dry Run)" if is_dry_run else ""))
+                    report['disabled'].append({'id': user_id, 'email': email})
+    finally:
+        api.detach()
+
+    if report_path:
+        with open(report_path, 'w') as f:
+            json.dump(report, f, indent=2)
+    return report
+
+
 @click.group()
 @click.option('--prod', is_flag=True, default=False, help='Run against prod (not dev) inputs.')
 @click.option('--dry-run', is_flag=True, default=False,
@@ -38,18 +117,44 @@ def cli(ctx, prod, dry_run) -> None:
 
 DEV_USER_ID_LIST = ['869', '1001']
 LOOK_ID = '10284'
+# Same threshold as the look, used when reading inactive users from a login state store
+INACTIVE_DAYS = 180
 
 
 @cli.command()
+@click.option('--bulk', is_flag=True, default=False,
+              help='Disable users concurrently with a sparse update, skipping users that are already disabled.')
+@click.option('--workers', default=16, type=int, help='Number of users disabled at the same time in bulk mode.')
+@click.option('--rate-limit', default=20, type=float,
+              help='Starting API calls per second in bulk mode, lowered automatically when throttled.')
+@click.option('--report', default='disable_inactive_users_report.json', type=str,
+              help='Where bulk mode writes its json report.')
+@click.option('--from-store', default=None, type=str,
+              help='With prod, refresh this login state store and take the inactive users from it instead of the Look.')
 @click.pass_context
-def disable_inactive_users(ctx) -> None:
+def disable_inactive_users(ctx, bulk, workers, rate_limit, report, from_store) -> None:
     """Disable users given a list of User IDs. When running prod option,
     pulls from a Look identifying users that have been inactive for 180 days."""
     print(f"this is prod: {ctx.obj['prod']}")
     print(f"this is a dry run: {ctx.obj['dry_run']}")
     user_id_list = DEV_USER_ID_LIST
-    if ctx.obj['prod']:
-        user_id_list = _get_user_list(look_id=LOOK_ID)
+    if ctx.obj['prod'] and from_store:
+        store = refreshed_store(from_store, sdk, recheck_days=INACTIVE_DAYS)
+        user_id_list = store.inactive_user_ids(days=INACTIVE_DAYS)
+        store.close()
+    elif ctx.obj['prod']:
+        user_id_list = _iter_user_ids(look_id=LOOK_ID)
+    if bulk:
+        result = _disable_inactive_users_bulk(
+            user_id_list=user_id_list,
+            is_dry_run=ctx.obj['dry_run'],
+            workers=workers,
+            rate_limit=rate_limit,
+            report_path=report
+        )
+        click.echo(f"Disabled {len(result['disabled'])}, already disabled {len(result['already_disabled'])}, "
+                   f"failed {len(result['failed'])}. Report written to {report}")
+        return
     _disable_inactive_users(
         user_id_list=user_id_list,
         is_dry_run=ctx.obj['dry_run']
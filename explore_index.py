@@ -0,0 +1,297 @@
+'''
+Index of which dashboard elements, dashboard filters, merge result source queries and looks are built
+on each model / explore, so migrations can find their targets without opening every dashboard.
+
+    python explore_index.py refresh --index explore_index.json
+    python explore_index.py show --model my_model --explore my_explore
+'''
+
+import json
+import os
+
+import click
+import looker_sdk
+from looker_sdk.error import SDKError
+
+from bulk_api import run_concurrently
+from sdk_listing import iter_content
+
+
+# Nested field projections, only what's needed to tell which model / explore each piece of content is on
+DASHBOARD_FIELDS = ('id,title,dashboard_filters(id,model,explore),'
+                    'dashboard_elements(id,type,query_id,look_id,merge_result_id,query(model,view))')
+LOOK_FIELDS = ['id', 'title', 'updated_at', 'query_id', 'query(model,view)']
+PAGE_SIZE = 1000
+# More changed looks than this are read with one paged listing rather than one by one
+MAX_LOOK_READS = PAGE_SIZE
+
+TARGET_TYPES = ['dashboard_elements', 'dashboard_filters', 'merge_sources', 'looks']
+
+
+def _to_id(value):
+    return None if value is None else str(value)
+
+
+def _id_sort_key(content_id: str) -> tuple:
+    # numeric ids in numeric order, then string ids like LookML dashboards' model::name
+    return (0, int(content_id), '') if content_id.isdigit() else (1, 0, content_id)
+
+
+def _look_entry(look) -> dict:
+    return {
+        'title': look.title,
+        'updated_at': str(look.updated_at),
+        'query_id': _to_id(look.query_id),
+        'model': look.query.model if look.query else None,
+        'explore': look.query.view if look.query else None,
+    }
+
+
+class ExploreIndex:
+    '''
+    Inverted index from (model, explore) to the content built on it.
+
+    The snapshot is plain json. refresh() only re-reads new dashboards and looks and the ones whose
+    updated_at changed, and queries / merge queries are only read once since they never change after
+    they're created. Look-linked dashboard elements are resolved through the looks when the index is
+    built, so a look moved to another explore moves its tiles without re-reading their dashboards.
+
+    Dashboards are listed with search_dashboards, which leaves out LookML dashboards, so the index never
+    covers them.
+    '''
+    def __init__(self, snapshot: dict = None):
+        self.snapshot = snapshot or {'dashboards': {}, 'looks': {}, 'merge_queries': {}, 'queries': {}}
+        self.dashboards = self.snapshot['dashboards']
+        self.looks = self.snapshot['looks']
+        self.merge_queries = self.snapshot['merge_queries']
+        self.queries = self.snapshot['queries']
+        self._build()
+
+    @classmethod
+    def load(cls, path: str):
+        with open(path) as f:
+            return cls(json.load(f))
+
+    def save(self, path: str) -> None:
+        with open(path, 'w') as f:
+            json.dump(self.snapshot, f)
+
+    @classmethod
+    def refreshed(cls, path: str, sdk: looker_sdk.methods40.Looker40SDK, max_workers: int = 8):
+        '''
+        Loads the index at path (or starts a new one), refreshes it and saves it again
+        '''
+        index = cls.load(path) if os.path.exists(path) else cls()
+        index.refresh(sdk, max_workers)
+        index.save(path)
+        return index
+
+    def _build(self) -> None:
+        self._by_explore = {}
+
+        def add(model, explore, target_type, target):
+            targets = self._by_explore.setdefault((model, explore), {target_type: [] for target_type in TARGET_TYPES})
+            targets[target_type].append(target)
+
+        for dashboard_id, dashboard in self.dashboards.items():
+            for dashboard_filter in dashboard['filters']:
+                add(dashboard_filter['model'], dashboard_filter['explore'], 'dashboard_filters',
+                    {'dashboard_id': dashboard_id, 'filter_id': dashboard_filter['id']})
+            for element in dashboard['elements']:
+                if element['merge_result_id']:
+                    for query_id in self.merge_queries.get(element['merge_result_id'], []):
+                        model, explore = self.queries.get(query_id, [None, None])
+                        add(model, explore, 'merge_sources', {
+                            'dashboard_id': dashboard_id,
+                            'element_id': element['id'],
+                            'merge_result_id': element['merge_result_id'],
+                            'query_id': query_id,
+                        })
+                else:
+                    model, explore = element['model'], element['explore']
+                    if element['look_id']:
+                        look = self.looks.get(element['look_id'], {})
+                        model, explore = look.get('model'), look.get('explore')
+                    add(model, explore, 'dashboard_elements', {
+                        'dashboard_id': dashboard_id,
+                        'element_id': element['id'],
+                        'look_id': element['look_id'],
+                        'query_id': element['query_id'],
+                    })
+        for look_id, look in self.looks.items():
+            add(look['model'], look['explore'], 'looks', {'look_id': look_id, 'query_id': look['query_id']})
+
+    def targets(self, model: str, explore: str) -> dict:
+        '''
+        Returns {'dashboard_elements': [...], 'dashboard_filters': [...], 'merge_sources': [...], 'looks': [...]}
+        for everything on model / explore
+        '''
+        targets = self._by_explore.get((model, explore), {})
+        return {target_type: list(targets.get(target_type, [])) for target_type in TARGET_TYPES}
+
+    def dashboard_ids(self, model: str, explore: str) -> list:
+        '''
+        Dashboards with at least one element, filter or merge result source query on model / explore
+        '''
+        targets = self.targets(model, explore)
+        dashboard_ids = {target['dashboard_id'] for target_type in ['dashboard_elements', 'dashboard_filters', 'merge_sources']
+                         for target in targets[target_type]}
+        return sorted(dashboard_ids, key=_id_sort_key)
+
+    def look_ids(self, model: str, explore: str) -> list:
+        return sorted({target['look_id'] for target in self.targets(model, explore)['looks']}, key=_id_sort_key)
+
+    def refresh(self, sdk: looker_sdk.methods40.Looker40SDK, max_workers: int = 8) -> dict:
+        '''
+        Brings the index up to date, returns how many dashboards were read and removed and how many
+        looks were read
+        '''
+        listed = {
+            _to_id(dashboard.id): str(dashboard.updated_at)
+            for dashboard in iter_content(sdk, 'dashboards', ['id', 'updated_at'], page_size=PAGE_SIZE, deleted=False)
+        }
+        changed_ids = [dashboard_id for dashboard_id, updated_at in listed.items()
+                       if self.dashboards.get(dashboard_id, {}).get('updated_at') != updated_at]
+        removed_ids = set(self.dashboards) - set(listed)
+
+        def read_dashboard(dashboard_id):
+            try:
+                return _read_dashboard(sdk, dashboard_id, listed[dashboard_id])
+            except SDKError:
+                # deleted since it was listed
+                return None
+
+        for dashboard_id, dashboard, error in run_concurrently(read_dashboard, changed_ids, max_workers):
+            if error is not None:
+                raise error
+            if dashboard is None:
+                removed_ids.add(dashboard_id)
+            else:
+                self.dashboards[dashboard_id] = dashboard
+        for dashboard_id in removed_ids:
+            self.dashboards.pop(dashboard_id, None)
+
+        looks_read = self._refresh_looks(sdk, max_workers)
+        self._refresh_merge_queries(sdk, max_workers)
+        self._build()
+        return {'read': len(changed_ids), 'removed': len(removed_ids), 'looks_read': looks_read}
+
+    def _refresh_looks(self, sdk: looker_sdk.methods40.Looker40SDK, max_workers: int) -> int:
+        listed = {
+            _to_id(look.id): str(look.updated_at)
+            for look in iter_content(sdk, 'looks', ['id', 'updated_at'], page_size=PAGE_SIZE, deleted=False)
+        }
+        for look_id in set(self.looks) - set(listed):
+            del self.looks[look_id]
+        changed_ids = [look_id for look_id, updated_at in listed.items()
+                       if self.looks.get(look_id, {}).get('updated_at') != updated_at]
+
+        if len(changed_ids) > MAX_LOOK_READS:
+            for look in iter_content(sdk, 'looks', LOOK_FIELDS, page_size=PAGE_SIZE, deleted=False):
+                self.looks[_to_id(look.id)] = _look_entry(look)
+            return len(changed_ids)
+
+        def read_look(look_id):
+            try:
+                return _look_entry(sdk.look(look_id, fields=','.join(LOOK_FIELDS)))
+            except SDKError:
+                # deleted since it was listed
+                return None
+
+        for look_id, look, error in run_concurrently(read_look, changed_ids, max_workers):
+            if error is not None:
+                raise error
+            if look is None:
+                self.looks.pop(look_id, None)
+            else:
+                self.looks[look_id] = look
+        return len(changed_ids)
+
+    def _refresh_merge_queries(self, sdk: looker_sdk.methods40.Looker40SDK, max_workers: int) -> None:
+        merge_result_ids = {element['merge_result_id'] for dashboard in self.dashboards.values()
+                            for element in dashboard['elements'] if element['merge_result_id']}
+
+        def read_merge_query(merge_result_id):
+            merge_query = sdk.merge_query(merge_result_id, fields='source_queries')
+            return [_to_id(source_query.query_id) for source_query in merge_query.source_queries or []]
+
+        new_ids = merge_result_ids - set(self.merge_queries)
+        for merge_result_id, query_ids, error in run_concurrently(read_merge_query, new_ids, max_workers):
+            if error is not None:
+                raise error
+            self.merge_queries[merge_result_id] = query_ids
+        for merge_result_id in set(self.merge_queries) - merge_result_ids:
+            del self.merge_queries[merge_result_id]
+
+        query_ids = {query_id for query_ids in self.merge_queries.values() for query_id in query_ids}
+
+        def read_query(query_id):
+            query = sdk.query(query_id, fields='model,view')
+            return [query.model, query.view]
+
+        for query_id, explore, error in run_concurrently(read_query, query_ids - set(self.queries), max_workers):
+            if error is not None:
+                raise error
+            self.queries[query_id] = explore
+        for query_id in set(self.queries) - query_ids:
+            del self.queries[query_id]
+
+
+def _read_dashboard(sdk: looker_sdk.methods40.Looker40SDK, dashboard_id: str, updated_at: str) -> dict:
+    dashboard = sdk.dashboard(dashboard_id, fields=DASHBOARD_FIELDS)
+    elements = []
+    for element in dashboard.dashboard_elements or []:
+        if element.type == 'text':
+            continue
+        # look-linked elements get their model / explore from the look when the index is built
+        query = None if element.look_id else element.query
+        elements.append({
+            'id': _to_id(element.id),
+            'look_id': _to_id(element.look_id),
+            'query_id': _to_id(element.query_id),
+            'merge_result_id': _to_id(element.merge_result_id),
+            'model': query.model if query else None,
+            'explore': query.view if query else None,
+        })
+    return {
+        'title': dashboard.title,
+        'updated_at': updated_at,
+        'filters': [
+            {'id': _to_id(dashboard_filter.id), 'model': dashboard_filter.model, 'explore': dashboard_filter.explore}
+            for dashboard_filter in dashboard.dashboard_filters or []
+        ],
+        'elements': elements,
+    }
+
+
+@click.group()
+def cli() -> None:
+    pass
+
+
+@cli.command()
+@click.option('--index', 'index_path', default='explore_index.json', type=str)
+@click.option('--workers', default=8, type=int, help='Number of dashboards read at the same time.')
+def refresh(index_path: str, workers: int) -> None:
+    sdk = looker_sdk.init40()
+    index = ExploreIndex.load(index_path) if os.path.exists(index_path) else ExploreIndex()
+    counts = index.refresh(sdk, workers)
+    index.save(index_path)
+    click.echo(f"Read {counts['read']} dashboards and {counts['looks_read']} looks, "
+               f"removed {counts['removed']} dashboards, indexed {len(index.dashboards)} dashboards and {len(index.looks)} looks")
+
+
+@cli.command()
+@click.option('--index', 'index_path', default='explore_index.json', type=str)
+@click.option('--model', required=True, type=str)
+@click.option('--explore', required=True, type=str)
+def show(index_path: str, model: str, explore: str) -> None:
+    index = ExploreIndex.load(index_path)
+    for target_type, targets in index.targets(model, explore).items():
+        click.echo(f"{target_type}: {len(targets)}")
+    click.echo(f"Dashboards: {index.dashboard_ids(model, explore)}")
+    click.echo(f"Looks: {index.look_ids(model, explore)}")
+
+
+if __name__ == "__main__":
+    cli()
@@ -0,0 +1,360 @@
+'''
+Explore migrations in two phases. `plan` only reads from the instance and writes every intended change
+to a json-lines plan, `apply` makes the changes in the plan and checkpoints each one, so an interrupted
+run picks up where it stopped.
+
+    python explore_migration_plan.py plan --old-model m --old-explore e --new-model m2 --new-explore e2 \
+        --from-index explore_index.json --plan migration.jsonl
+    python explore_migration_plan.py apply --plan migration.jsonl --workers 8 --query-cache query_clones.jsonl
+
+Each plan line is one step:
+    {"step": 0, "op": "create_query", "ref": "query:<definition hash>", "body": {...}}
+    {"step": 5, "op": "update_dashboard_element", "id": "42", "body": {"query_id": {"ref": "query:<hash>"}}}
+{"ref": ...} stands in for the id of an object created by an earlier step. Steps run in phases, all
+create_query steps first, then create_merge_query, then the updates. create_query steps go through
+QueryCloneCache, the same as change_explore_dashboard / change_explore_look, so queries cloned by any of
+them are reused.
+'''
+
+import json
+import os
+import threading
+from typing import List, Optional
+
+import click
+import looker_sdk
+from looker_sdk import models as ml
+
+from bulk_api import RateLimitedSDK, RateLimiter, run_concurrently
+from explore_index import ExploreIndex
+from looker_session import mount_connection_pool
+from query_clone_cache import CLONED_QUERY_FIELDS, QueryCloneCache, query_definition, query_definition_hash
+
+
+PHASES = [
+    ['create_query'],
+    ['create_merge_query'],
+    ['update_dashboard_filter', 'update_dashboard_element', 'update_look'],
+]
+
+ELEMENT_FIELDS = 'id,type,look_id,query_id,merge_result_id,query,look(id,query_id,query)'
+MERGE_QUERY_FIELDS = 'column_limit,dynamic_fields,pivots,sorts,total,vis_config,source_queries'
+
+
+class _Planner:
+    '''
+    Collects the steps of a plan, each new query is planned once however many tiles / looks use it
+    '''
+    def __init__(self, sdk: looker_sdk.methods40.Looker40SDK, old_model: str, old_explore: str, new_model: str,
+                 new_explore: str):
+        self.sdk = sdk
+        self.old_model = old_model
+        self.old_explore = old_explore
+        self.new_model = new_model
+        self.new_explore = new_explore
+        self.steps = []
+        self._planned_refs = set()
+        self._planned_look_ids = set()
+        self._lock = threading.Lock()
+
+    def _add(self, step: dict) -> None:
+        with self._lock:
+            if step.get('ref') in self._planned_refs:
+                return
+            if step['op'] == 'update_look':
+                # looks can be on several dashboards
+                if step['id'] in self._planned_look_ids:
+                    return
+                self._planned_look_ids.add(step['id'])
+            if 'ref' in step:
+                self._planned_refs.add(step['ref'])
+            self.steps.append(step)
+
+    def _on_old_explore(self, query) -> bool:
+        return bool(query) and query.model == self.old_model and query.view == self.old_explore
+
+    def _clone_ref(self, query) -> dict:
+        ref = f'query:{query_definition_hash(query)}'
+        self._add({
+            'op': 'create_query',
+            'ref': ref,
+            'source_query_id': str(query.id),
+            'body': dict(query_definition(query), model=self.new_model, view=self.new_explore),
+        })
+        return {'ref': ref}
+
+    def plan_dashboard(self, dashboard_id: str) -> List[str]:
+        '''
+        Plans the changes to one dashboard, returns the messages to report
+        '''
+        filter_count = 0
+        for dashboard_filter in self.sdk.dashboard_dashboard_filters(dashboard_id, fields='id,model,explore'):
+            if dashboard_filter.model == self.old_model and dashboard_filter.explore == self.old_explore:
+                self._add({
+                    'op': 'update_dashboard_filter',
+                    'id': str(dashboard_filter.id),
+                    'dashboard_id': dashboard_id,
+                    'body': {'model': self.new_model, 'explore': self.new_explore},
+                })
+                filter_count += 1
+
+        tile_count = 0
+        for element in self.sdk.dashboard_dashboard_elements(dashboard_id, fields=ELEMENT_FIELDS):
+            if element.type == 'text':
+                continue
+            if element.look_id:
+                if element.look and self._on_old_explore(element.look.query):
+                    self._add({
+                        'op': 'update_look',
+                        'id': str(element.look_id),
+                        'dashboard_id': dashboard_id,
+                        'body': {'query_id': self._clone_ref(element.look.query)},
+                    })
+                    tile_count += 1
+            elif element.merge_result_id:
+                merge_query = self.sdk.merge_query(element.merge_result_id, fields=MERGE_QUERY_FIELDS)
+                source_queries = []
+                changed = False
+                for source_query in merge_query.source_queries or []:
+                    query_id = str(source_query.query_id)
+                    query = self.sdk.query(query_id)
+                    if self._on_old_explore(query):
+                        query_id = self._clone_ref(query)
+                        changed = True
+                    source_queries.append({
+                        'name': source_query.name,
+                        'query_id': query_id,
+                        'merge_fields': [
+                            {'field_name': merge_field.field_name, 'source_field_name': merge_field.source_field_name}
+                            for merge_field in source_query.merge_fields or []
+                        ],
+                    })
+                if changed:
+                    ref = f'merge_query:{element.id}'
+                    self._add({
+                        'op': 'create_merge_query',
+                        'ref': ref,
+                        'source_merge_result_id': str(element.merge_result_id),
+                        'body': {
+                            'column_limit': merge_query.column_limit,
+                            'dynamic_fields': merge_query.dynamic_fields,
+                            'pivots': merge_query.pivots,
+                            'sorts': merge_query.sorts,
+                            'total': merge_query.total,
+                            'vis_config': merge_query.vis_config,
+                            'source_queries': source_queries,
+                        },
+                    })
+                    self._add({
+                        'op': 'update_dashboard_element',
+                        'id': str(element.id),
+                        'dashboard_id': dashboard_id,
+                        'body': {'merge_result_id': {'ref': ref}},
+                    })
+                    tile_count += 1
+            elif self._on_old_explore(element.query):
+                self._add({
+                    'op': 'update_dashboard_element',
+                    'id': str(element.id),
+                    'dashboard_id': dashboard_id,
+                    'body': {'query_id': self._clone_ref(element.query)},
+                })
+                tile_count += 1
+        return [f"Dashboard ID {dashboard_id}: planned model/explore change of {filter_count} filters and {tile_count} tiles"]
+
+    def plan_look(self, look_id: str) -> List[str]:
+        look = self.sdk.look(look_id, fields='id,query')
+        if not self._on_old_explore(look.query):
+            return []
+        self._add({'op': 'update_look', 'id': str(look_id), 'body': {'query_id': self._clone_ref(look.query)}})
+        return [f"Look {look_id}: planned model/explore change"]
+
+    def sorted_steps(self) -> List[dict]:
+        '''
+        Steps in phase order, numbered
+        '''
+        phase_of = {op: i for i, ops in enumerate(PHASES) for op in ops}
+        steps = sorted(self.steps, key=lambda step: phase_of[step['op']])
+        return [dict(step=i, **step) for i, step in enumerate(steps)]
+
+
+def make_plan(sdk: looker_sdk.methods40.Looker40SDK, dashboard_ids: List[str], look_ids: List[str], old_model: str,
+              old_explore: str, new_model: str, new_explore: str, max_workers: int = 8) -> List[dict]:
+    '''
+    Works out every change a migration would make, without changing anything
+    '''
+    planner = _Planner(sdk, old_model, old_explore, new_model, new_explore)
+    for plan_content, ids in [(planner.plan_dashboard, dashboard_ids), (planner.plan_look, look_ids)]:
+        for content_id, messages, error in run_concurrently(plan_content, ids, max_workers):
+            if error is not None:
+                raise click.ClickException(f"Couldn't plan {content_id}: {error!r}")
+            for message in messages:
+                click.echo(message)
+    return planner.sorted_steps()
+
+
+def write_plan(steps: List[dict], path: str) -> None:
+    with open(path, 'w') as f:
+        for step in steps:
+            f.write(json.dumps(step) + '\n')
+
+
+def read_plan(path: str) -> List[dict]:
+    with open(path) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def _resolve(value, refs: dict):
+    '''
+    Swaps {"ref": ...} placeholders for the ids of the objects created for them
+    '''
+    if isinstance(value, dict) and set(value) == {'ref'}:
+        return refs[value['ref']]
+    return value
+
+
+def _query_caches(sdk: looker_sdk.methods40.Looker40SDK, steps: List[dict], query_cache_path: Optional[str]) -> dict:
+    '''
+    {(new model, new explore): QueryCloneCache} for the create_query steps of a plan
+    '''
+    targets = {(step['body']['model'], step['body']['view']) for step in steps if step['op'] == 'create_query'}
+    return {target: QueryCloneCache(sdk, *target, query_cache_path) for target in targets}
+
+
+def _run_step(sdk: looker_sdk.methods40.Looker40SDK, step: dict, refs: dict, query_caches: dict) -> Optional[str]:
+    '''
+    Makes one change, returns the id of the object it created, if any
+    '''
+    body = step['body']
+    if step['op'] == 'create_query':
+        # the planned definition stands in for the source query, so it isn't read again
+        query = ml.Query(model=body['model'], view=body['view'], id=step['source_query_id'],
+                         **{field: body.get(field) for field in CLONED_QUERY_FIELDS})
+        return query_caches[(body['model'], body['view'])].clone(step['source_query_id'], query)
+    if step['op'] == 'create_merge_query':
+        source_queries = [
+            ml.MergeQuerySourceQuery(
+                name=source_query['name'],
+                query_id=_resolve(source_query['query_id'], refs),
+                merge_fields=[ml.MergeFields(**merge_field) for merge_field in source_query['merge_fields']],
+            )
+            for source_query in body['source_queries']
+        ]
+        return str(sdk.create_merge_query(ml.WriteMergeQuery(**dict(body, source_queries=source_queries))).id)
+    body = {key: _resolve(value, refs) for key, value in body.items()}
+    if step['op'] == 'update_dashboard_filter':
+        sdk.update_dashboard_filter(step['id'], ml.WriteDashboardFilter(**body))
+    elif step['op'] == 'update_dashboard_element':
+        sdk.update_dashboard_element(step['id'], ml.WriteDashboardElement(**body))
+    elif step['op'] == 'update_look':
+        sdk.update_look(step['id'], ml.WriteLookWithQuery(**body))
+    else:
+        raise ValueError(f"Unknown step {step['op']}")
+    return None
+
+
+def apply_plan(sdk: looker_sdk.methods40.Looker40SDK, steps: List[dict], checkpoint_path: str,
+               max_workers: int = 8, query_cache_path: Optional[str] = None) -> List[dict]:
+    '''
+    Makes the changes in a plan, appending each finished step to the checkpoint file straight away.
+    Steps already in the checkpoint are skipped, so the same call resumes an interrupted run.
+    Queries are cloned through QueryCloneCache, with query_cache_path earlier clones are reused.
+
+    Returns the steps that failed, steps that depend on a failed create are failed too. Running
+    apply_plan again retries them.
+    '''
+    done = {}
+    if os.path.exists(checkpoint_path):
+        with open(checkpoint_path) as f:
+            for line in f:
+                checkpoint = json.loads(line)
+                done[checkpoint['step']] = checkpoint.get('id')
+    refs = {step['ref']: done[step['step']] for step in steps if 'ref' in step and step['step'] in done}
+    query_caches = _query_caches(sdk, steps, query_cache_path)
+    checkpoint_lock = threading.Lock()
+    failed = []
+
+    def run(step):
+        new_id = _run_step(sdk, step, refs, query_caches)
+        with checkpoint_lock:
+            with open(checkpoint_path, 'a') as f:
+                f.write(json.dumps({'step': step['step'], 'id': new_id}) + '\n')
+                f.flush()
+                os.fsync(f.fileno())
+        return new_id
+
+    for ops in PHASES:
+        pending = [step for step in steps if step['op'] in ops and step['step'] not in done]
+        done_count = 0
+        for step, new_id, error in run_concurrently(run, pending, max_workers):
+            if error is not None:
+                click.echo(f"Step {step['step']} {step['op']} {step.get('id', '')}: failed with {error!r}")
+                failed.append(step)
+                continue
+            done[step['step']] = new_id
+            if 'ref' in step:
+                refs[step['ref']] = new_id
+            done_count += 1
+        click.echo(f"{', '.join(ops)}: {done_count} of {len(pending)} remaining steps done")
+    if query_caches:
+        click.echo(f"Created {sum(cache.created_count for cache in query_caches.values())} new queries, "
+                   f"reused {sum(cache.reused_count for cache in query_caches.values())}")
+    return failed
+
+
+@click.group()
+def cli() -> None:
+    pass
+
+
+@cli.command()
+@click.option('--old-model', required=True, type=str)
+@click.option('--old-explore', required=True, type=str)
+@click.option('--new-model', required=True, type=str)
+@click.option('--new-explore', required=True, type=str)
+@click.option('--dashboards', default='', type=str, help='Comma separated dashboard ids.')
+@click.option('--looks', default='', type=str, help='Comma separated Look ids.')
+@click.option('--from-index', 'index_path', default=None, type=str,
+              help='Refresh this explore index and plan every dashboard and Look on the old model/explore in it.')
+@click.option('--plan', 'plan_path', default='migration_plan.jsonl', type=str)
+@click.option('--workers', default=8, type=int, help='Number of dashboards read at the same time.')
+def plan(old_model: str, old_explore: str, new_model: str, new_explore: str, dashboards: str, looks: str,
+         index_path: Optional[str], plan_path: str, workers: int) -> None:
+    sdk = looker_sdk.init40()
+    dashboard_ids = [dashboard_id for dashboard_id in dashboards.split(',') if dashboard_id]
+    look_ids = [look_id for look_id in looks.split(',') if look_id]
+    if index_path:
+        index = ExploreIndex.refreshed(index_path, sdk, workers)
+        dashboard_ids += index.dashboard_ids(old_model, old_explore)
+        look_ids += index.look_ids(old_model, old_explore)
+    steps = make_plan(sdk, list(dict.fromkeys(dashboard_ids)), list(dict.fromkeys(look_ids)), old_model, old_explore,
+                      new_model, new_explore, workers)
+    write_plan(steps, plan_path)
+    for ops in PHASES:
+        click.echo(f"{', '.join(ops)}: {len([step for step in steps if step['op'] in ops])} steps")
+    click.echo(f"Wrote plan to {plan_path}")
+
+
+@cli.command()
+@click.option('--plan', 'plan_path', default='migration_plan.jsonl', type=str)
+@click.option('--checkpoint', 'checkpoint_path', default=None, type=str,
+              help='Defaults to the plan path with .checkpoint added.')
+@click.option('--workers', default=8, type=int, help='Number of changes made at the same time.')
+@click.option('--rate-limit', default=None, type=float, help='Maximum API calls per second across all workers.')
+@click.option('--query-cache', 'query_cache_path', default=None, type=str,
+              help='File to keep cloned query ids in, so re-runs and other migrations reuse them.')
+def apply(plan_path: str, checkpoint_path: Optional[str], workers: int, rate_limit: Optional[float],
+          query_cache_path: Optional[str]) -> None:
+    sdk = looker_sdk.init40()
+    if workers > 10:
+        mount_connection_pool(sdk, workers)
+    api = RateLimitedSDK(sdk, RateLimiter(rate_limit)) if rate_limit else sdk
+    failed = apply_plan(api, read_plan(plan_path), checkpoint_path or f'{plan_path}.checkpoint', workers,
+                        query_cache_path)
+    if failed:
+        raise click.ClickException(f"{len(failed)} steps failed, run apply again to retry them")
+    click.echo("Plan applied")
+
+
+if __name__ == "__main__":
+    cli()
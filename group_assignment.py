@@ -0,0 +1,170 @@
+'''
+Idempotent bulk group assignment. Reads each group's current members once (ids only), works out the
+exact users to add and remove against the desired state, and applies only those changes in parallel,
+so running the same assignment again makes no changes.
+
+    python group_assignment.py sync --csv looker_users.csv --group-column Team --user-id-column id
+'''
+
+from typing import Dict, Iterable, List, Set, Tuple
+
+import click
+import looker_sdk
+import pandas as pd
+
+from bulk_api import AdaptiveRateLimiter, BackoffSDK, run_concurrently
+from looker_session import mount_connection_pool
+from sdk_listing import fetch_raw, fetch_raw_pages
+
+
+PAGE_SIZE = 1000
+
+
+def _to_id(value) -> str:
+    return str(int(value)) if isinstance(value, float) else str(value)
+
+
+def group_ids_by_name(sdk: looker_sdk.methods40.Looker40SDK) -> Dict[str, str]:
+    '''
+    {group name: group id} for every group, from one all_groups call
+    '''
+    return {group['name']: _to_id(group['id']) for group in fetch_raw(sdk, '/groups', ['id', 'name'])}
+
+
+def group_member_ids(sdk: looker_sdk.methods40.Looker40SDK, group_id: str) -> Set[str]:
+    '''
+    Ids of the users directly in the group, paging all_group_users with only the id requested. Also
+    safe on API 3.1 clients, where the listing may ignore limit / offset, see fetch_raw_pages.
+    '''
+    return {
+        _to_id(user['id'])
+        for page in fetch_raw_pages(sdk, f'/groups/{group_id}/users', ['id'], PAGE_SIZE, sorts='id')
+        for user in page
+    }
+
+
+def current_memberships(sdk: looker_sdk.methods40.Looker40SDK, group_ids: Iterable[str],
+                        max_workers: int = 8) -> Dict[str, Set[str]]:
+    memberships = {}
+    for group_id, member_ids, error in run_concurrently(lambda group_id: group_member_ids(sdk, group_id),
+                                                        set(group_ids), max_workers):
+        if error is not None:
+            raise error
+        memberships[group_id] = member_ids
+    return memberships
+
+
+def desired_memberships(df: pd.DataFrame, group_column: str, user_id_column: str = 'id',
+                        group_ids: Dict[str, str] = None) -> Dict[str, Set[str]]:
+    '''
+    {group id: user ids} from a DataFrame with one row per user and group, e.g. read from a csv.
+
+    group_ids: dict - group name -> id, when group_column holds group names. Rows with a group
+    that isn't in it raise a KeyError listing the unknown groups.
+    '''
+    rows = df[[group_column, user_id_column]].dropna()
+    groups = rows[group_column]
+    if group_ids is not None:
+        unknown = sorted(set(groups) - set(group_ids))
+        if unknown:
+            raise KeyError(f'Unknown groups: {unknown}')
+        groups = groups.map(group_ids)
+    desired = {}
+    for group_id, user_id in zip(groups, rows[user_id_column]):
+        desired.setdefault(_to_id(group_id), set()).add(_to_id(user_id))
+    return desired
+
+
+def plan_changes(current: Dict[str, Set[str]], desired: Dict[str, Set[str]] = None,
+                 unwanted: Dict[str, Set[str]] = None, exact: bool = False) -> List[Tuple[str, str, str]]:
+    '''
+    ('add' | 'remove', group_id, user_id) for every membership that has to change.
+
+    desired: dict - users that should be in each group, missing ones are added
+    unwanted: dict - users that shouldn't be in each group, present ones are removed
+    exact: bool - also remove members of the desired groups who aren't in desired
+    '''
+    changes = []
+    for group_id, user_ids in (desired or {}).items():
+        members = current.get(group_id, set())
+        changes += [('add', group_id, user_id) for user_id in sorted(user_ids - members, key=int)]
+        if exact:
+            changes += [('remove', group_id, user_id) for user_id in sorted(members - user_ids, key=int)]
+    for group_id, user_ids in (unwanted or {}).items():
+        members = current.get(group_id, set())
+        changes += [('remove', group_id, user_id) for user_id in sorted(user_ids & members, key=int)]
+    return changes
+
+
+def apply_changes(sdk: looker_sdk.methods40.Looker40SDK, changes: List[Tuple[str, str, str]], workers: int = 16,
+                  rate_limit: float = 20, dry_run: bool = False) -> dict:
+    '''
+    Applies the changes from plan_changes in parallel, returns the changes made and the ones that failed
+    '''
+    api = BackoffSDK(sdk, AdaptiveRateLimiter(rate_limit))
+    if workers > 10:
+        mount_connection_pool(sdk, workers)
+
+    def apply_one(change):
+        action, group_id, user_id = change
+        if dry_run:
+            return
+        if action == 'add':
+            api.add_group_user(group_id, {'user_id': user_id})
+        else:
+            api.delete_group_user(group_id, user_id)  # Note that this uses the user.id, not body!
+
+    result = {'added': [], 'removed': [], 'failed': []}
+    try:
+        for change, _, error in run_concurrently(apply_one, changes, workers):
+            action, group_id, user_id = change
+            if error is not None:
+                click.echo(f"Error on {action} user {user_id} in group {group_id}: {error}")
+                result['failed'].append(change)
+            else:
+                result['added' if action == 'add' else 'removed'].append((group_id, user_id))
+    finally:
+        api.detach()
+    return result
+
+
+def sync_group_users(sdk: looker_sdk.methods40.Looker40SDK, desired: Dict[str, Set[str]] = None,
+                     unwanted: Dict[str, Set[str]] = None, exact: bool = False, workers: int = 16,
+                     rate_limit: float = 20, dry_run: bool = False) -> dict:
+    '''
+    Reads the current members of the groups in desired / unwanted, then adds and removes only the users
+    that differ, see plan_changes
+    '''
+    group_ids = set(desired or {}) | set(unwanted or {})
+    current = current_memberships(sdk, group_ids, max_workers=min(workers, 8))
+    changes = plan_changes(current, desired, unwanted, exact)
+    click.echo(f"{len(group_ids)} groups read, {len(changes)} changes to make" + (" (Dry Run)" if dry_run else ""))
+    return apply_changes(sdk, changes, workers, rate_limit, dry_run)
+
+
+@click.group()
+def cli() -> None:
+    pass
+
+
+@cli.command()
+@click.option('--csv', 'csv_path', required=True, type=str, help='Csv with one row per user and group.')
+@click.option('--group-column', default='Team', type=str, help='Column with the group names.')
+@click.option('--user-id-column', default='id', type=str)
+@click.option('--exact', is_flag=True, default=False,
+              help='Also remove users from the groups in the csv when they are not listed for that group.')
+@click.option('--workers', default=16, type=int, help='Number of changes made at the same time.')
+@click.option('--rate-limit', default=20, type=float, help='Starting API calls per second, lowered when throttled.')
+@click.option('--dryrun', is_flag=True, default=False)
+def sync(csv_path: str, group_column: str, user_id_column: str, exact: bool, workers: int, rate_limit: float,
+         dryrun: bool) -> None:
+    sdk = looker_sdk.init40()
+    desired = desired_memberships(pd.read_csv(csv_path), group_column, user_id_column, group_ids_by_name(sdk))
+    result = sync_group_users(sdk, desired, exact=exact, workers=workers, rate_limit=rate_limit, dry_run=dryrun)
+    click.echo(f"Added {len(result['added'])}, removed {len(result['removed'])}")
+    if result['failed']:
+        click.echo(f"Failed: {result['failed']}")
+
+
+if __name__ == "__main__":
+    cli()
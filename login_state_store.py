@@ -0,0 +1,228 @@
+'''
+Local SQLite store of each user's last login and disabled flag, so finding the users who have been
+inactive for N days is an indexed query instead of a dump of every user.
+
+The API can't list users changed since a date, so refresh() only reads:
+- users newer than the newest one in the store, paging search_users by id descending
+- the ids of the disabled users, one projected listing
+- the stored users who could be inactive (enabled, last login before `recheck_days` ago, or never)
+  and the users enabled again, by id, to pick up logins since the last refresh and deleted users
+Users who logged in recently can only have logged in again since, so they aren't read.
+
+    python login_state_store.py refresh --store login_state.db
+    python login_state_store.py inactive --store login_state.db --days 180
+'''
+
+import datetime
+import sqlite3
+from typing import List
+
+import click
+import looker_sdk
+import pandas as pd
+
+from sdk_listing import fetch_raw
+from user_inventory import USER_FIELDS, fetch_users, users_df
+
+
+PAGE_SIZE = 1000
+# Users re-read per all_users(ids=...) call
+IDS_PER_CALL = 500
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS users (
+    id INTEGER PRIMARY KEY,
+    display_name TEXT,
+    email TEXT,
+    is_disabled INTEGER NOT NULL,
+    is_looker_employee INTEGER NOT NULL,
+    last_login_at TEXT,
+    refreshed_at TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS users_inactive ON users (is_disabled, is_looker_employee, last_login_at);
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+'''
+
+
+def _utc_iso(value) -> str:
+    # fixed width, so the timestamps compare correctly as text in SQLite
+    return None if pd.isna(value) else value.tz_convert('UTC').strftime('%Y-%m-%dT%H:%M:%S')
+
+
+class LoginStateStore:
+    '''
+    users table with one row per user: display name, email, disabled and Looker employee flags and the
+    latest login across all credentials (UTC, ISO 8601), indexed for inactive user queries
+    '''
+    def __init__(self, path: str = 'login_state.db'):
+        self.path = path
+        self.connection = sqlite3.connect(path)
+        self.connection.executescript(SCHEMA)
+
+    def close(self) -> None:
+        self.connection.close()
+
+    def _meta(self, key: str) -> str:
+        row = self.connection.execute('SELECT value FROM meta WHERE key = ?', (key,)).fetchone()
+        return row[0] if row else None
+
+    def _set_meta(self, key: str, value: str) -> None:
+        self.connection.execute('INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)', (key, value))
+
+    def last_refresh(self) -> str:
+        return self._meta('last_refresh')
+
+    def count(self) -> int:
+        return self.connection.execute('SELECT COUNT(*) FROM users').fetchone()[0]
+
+    def upsert(self, users: list) -> int:
+        '''
+        Stores users as returned by the API with user_inventory.USER_FIELDS
+        '''
+        if not users:
+            return 0
+        df = users_df(users)
+        now = datetime.datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%S')
+        rows = [
+            (int(user_id), display_name, None if pd.isna(email) else email, int(is_disabled),
+             int(is_looker_employee), _utc_iso(last_login), now)
+            for user_id, display_name, email, is_disabled, is_looker_employee, last_login in zip(
+                df.index, df['display_name'], df['email'], df['is_disabled'], df['is_looker_employee'],
+                df['last_login_date'])
+        ]
+        self.connection.executemany('INSERT OR REPLACE INTO users VALUES (?, ?, ?, ?, ?, ?, ?)', rows)
+        return len(rows)
+
+    def load_all(self, sdk: looker_sdk.methods40.Looker40SDK) -> dict:
+        '''
+        Replaces the store with a full read of every user, only needed the first time
+        '''
+        users = fetch_users(sdk, page_size=PAGE_SIZE)
+        with self.connection:
+            self.connection.execute('DELETE FROM users')
+            self.upsert(users)
+            self._set_meta('last_refresh', datetime.datetime.utcnow().isoformat())
+        return {'read': len(users), 'removed': 0}
+
+    def refresh(self, sdk: looker_sdk.methods40.Looker40SDK, recheck_days: int = 30) -> dict:
+        '''
+        Brings the store up to date, see the module docstring for what is read. Queries for fewer than
+        recheck_days days can miss users who logged in since the last refresh.
+        Returns the number of users read and removed.
+        '''
+        if self.last_refresh() is None:
+            return self.load_all(sdk)
+
+        max_id = self.connection.execute('SELECT MAX(id) FROM users').fetchone()[0] or 0
+        new_users = []
+        offset = 0
+        while True:
+            page = fetch_raw(sdk, '/users/search', USER_FIELDS, limit=PAGE_SIZE, offset=offset, sorts='id desc')
+            new_users.extend(user for user in page if int(user['id']) > max_id)
+            if len(page) < PAGE_SIZE or int(page[-1]['id']) <= max_id:
+                break
+            offset += PAGE_SIZE
+
+        disabled_ids = set()
+        offset = 0
+        while True:
+            page = fetch_raw(sdk, '/users/search', ['id'], is_disabled='true', limit=PAGE_SIZE, offset=offset,
+                             sorts='id')
+            disabled_ids.update(int(user['id']) for user in page)
+            if len(page) < PAGE_SIZE:
+                break
+            offset += PAGE_SIZE
+
+        stored_disabled = {row[0] for row in self.connection.execute('SELECT id FROM users WHERE is_disabled = 1')}
+        # users enabled again since the last refresh have a stale last login as well
+        recheck_ids = [row[0] for row in self.connection.execute(
+            'SELECT id FROM users WHERE is_disabled = 0 AND (last_login_at IS NULL OR last_login_at < ?)',
+            (_cutoff(recheck_days),))]
+        recheck_ids += sorted(stored_disabled - disabled_ids)
+        rechecked = []
+        for start in range(0, len(recheck_ids), IDS_PER_CALL):
+            batch = recheck_ids[start:start + IDS_PER_CALL]
+            rechecked.extend(fetch_raw(sdk, '/users', USER_FIELDS, ids=','.join(str(user_id) for user_id in batch)))
+        removed_ids = set(recheck_ids) - {int(user['id']) for user in rechecked}
+
+        with self.connection:
+            self.upsert(new_users + rechecked)
+            self.connection.executemany('DELETE FROM users WHERE id = ?', [(user_id,) for user_id in removed_ids])
+            self.connection.executemany('UPDATE users SET is_disabled = 1 WHERE id = ?',
+                                        [(user_id,) for user_id in disabled_ids - stored_disabled])
+            self._set_meta('last_refresh', datetime.datetime.utcnow().isoformat())
+        return {'read': len(new_users) + len(rechecked), 'removed': len(removed_ids)}
+
+    def inactive_users(self, days: int, include_never_logged_in: bool = False,
+                       include_looker_employees: bool = False) -> pd.DataFrame:
+        '''
+        Enabled users whose last login was before the day `days` days ago, indexed by id
+        '''
+        query = ('SELECT id, display_name, email, last_login_at FROM users '
+                 'WHERE is_disabled = 0 AND is_looker_employee IN ({employee}) AND {login} ORDER BY id')
+        login = 'last_login_at < ?'
+        if include_never_logged_in:
+            login = f'({login} OR last_login_at IS NULL)'
+        query = query.format(employee='0, 1' if include_looker_employees else '0', login=login)
+        df = pd.read_sql_query(query, self.connection, params=(_cutoff(days),), index_col='id')
+        df['last_login_at'] = pd.to_datetime(df['last_login_at'], utc=True)
+        return df
+
+    def inactive_user_ids(self, days: int, include_never_logged_in: bool = False) -> List[int]:
+        return list(self.inactive_users(days, include_never_logged_in).index)
+
+
+def _cutoff(days: int) -> str:
+    cutoff = (datetime.datetime.utcnow() - datetime.timedelta(days=days)).date()
+    return cutoff.strftime('%Y-%m-%dT%H:%M:%S')
+
+
+def refreshed_store(path: str, sdk: looker_sdk.methods40.Looker40SDK, recheck_days: int = 30) -> LoginStateStore:
+    '''
+    Opens the store at path, creating it if needed, and refreshes it
+    '''
+    store = LoginStateStore(path)
+    store.refresh(sdk, recheck_days)
+    return store
+
+
+@click.group()
+def cli() -> None:
+    pass
+
+
+@cli.command()
+@click.option('--store', 'store_path', default='login_state.db', type=str)
+@click.option('--recheck-days', default=30, type=int,
+              help='Re-read enabled users whose last login is older than this, the shortest --days you query.')
+@click.option('--full', is_flag=True, default=False, help='Read every user again instead of refreshing.')
+def refresh(store_path: str, recheck_days: int, full: bool) -> None:
+    sdk = looker_sdk.init40()
+    store = LoginStateStore(store_path)
+    counts = store.load_all(sdk) if full else store.refresh(sdk, recheck_days)
+    click.echo(f"Read {counts['read']} users, removed {counts['removed']}, {store.count()} users stored")
+    store.close()
+
+
+@cli.command()
+@click.option('--store', 'store_path', default='login_state.db', type=str)
+@click.option('--days', default=365, type=int, help='Days since the last login.')
+@click.option('--include-never-logged-in', is_flag=True, default=False)
+@click.option('--output', default=None, type=str, help='Write the users to this csv file instead of printing them.')
+def inactive(store_path: str, days: int, include_never_logged_in: bool, output: str) -> None:
+    store = LoginStateStore(store_path)
+    click.echo(f"Store last refreshed {store.last_refresh()}")
+    users = store.inactive_users(days, include_never_logged_in)
+    if output:
+        users.to_csv(output, index_label='user_id')
+        click.echo(f"Wrote {len(users)} users to {output}")
+    else:
+        click.echo(users.to_string())
+    store.close()
+
+
+if __name__ == "__main__":
+    cli()
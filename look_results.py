@@ -0,0 +1,102 @@
+'''
+Streams the results of a look row by row instead of loading the whole json result into memory.
+
+The look is run as csv and parsed while it downloads, so callers can start acting on the first rows
+before the last ones have arrived, and only the requested columns are kept for each row. The SDK's
+transport reads whole responses, so the download is made the way the transport makes its requests
+(on the client's session, with its authenticator and timeout) but kept open as a stream.
+
+    for row in stream_look_rows(sdk, look_id, columns=['ID'], types={'ID': int}, apply_vis=True):
+        ...
+'''
+
+import csv
+import io
+import time
+from typing import Callable, Dict, Iterator, List
+
+import looker_sdk
+from looker_sdk.error import SDKError
+from looker_sdk.rtl.requests_transport import NullAuth
+
+from bulk_api import RETRY_STATUSES, backoff_delay
+
+
+def _look_results_url(sdk: looker_sdk.methods40.Looker40SDK, look_id: str) -> str:
+    return f'{sdk.api_path.rstrip("/")}/looks/{look_id}/run/csv'
+
+
+def _open_look_results(sdk: looker_sdk.methods40.Looker40SDK, look_id: str, query_params: dict, retries: int):
+    '''
+    Starts the download on the client's session, so its verify_ssl, mounted connection pools and
+    response hooks (e.g. BackoffSDK's) apply, retrying 429 / 5xx answers like BackoffSDK does
+    '''
+    for attempt in range(retries + 1):
+        response = sdk.transport.session.request(
+            'GET',
+            _look_results_url(sdk, look_id),
+            auth=NullAuth(),
+            params=query_params,
+            headers=sdk.auth.authenticate({}),
+            timeout=sdk.transport.settings.timeout,
+            stream=True,
+        )
+        if response.ok:
+            return response
+        retry_after = response.headers.get('Retry-After')
+        if response.status_code not in RETRY_STATUSES or attempt == retries:
+            with response:
+                raise SDKError(response.text)
+        response.close()
+        time.sleep(backoff_delay(attempt, retry_after))
+
+
+def stream_look_rows(sdk: looker_sdk.methods40.Looker40SDK, look_id: str, columns: List[str] = None,
+                     types: Dict[str, Callable] = None, apply_vis: bool = False, limit: int = None,
+                     retries: int = 5) -> Iterator[dict]:
+    '''
+    Yields one dict per row of the look's results.
+
+    columns: list - header names to keep, everything else is dropped as it's read. The header names are
+    the column labels with apply_vis (e.g. 'ID') and the field names without it (e.g. 'users.id').
+    types: dict - column -> callable converting the csv text, e.g. {'ID': int}. Empty cells become None.
+    limit: int - row limit, the look's own limit is used when it isn't set
+    retries: int - times the run is retried when the server throttles it or fails with a 5xx
+    '''
+    query_params = {'apply_vis': str(apply_vis).lower()}
+    if limit is not None:
+        query_params['limit'] = str(limit)
+    with _open_look_results(sdk, look_id, query_params, retries) as response:
+        # read through the raw stream so quoted cells with line breaks are parsed as one row
+        response.raw.decode_content = True
+        # Looker's csv is utf-8, but text/csv without a charset would be decoded as ISO-8859-1 by requests.
+        # utf-8-sig also drops a byte order mark, so it doesn't end up in the first column name.
+        reader = csv.reader(io.TextIOWrapper(response.raw, encoding='utf-8-sig', newline=''))
+        header = next(reader, None)
+        if header is None:
+            return
+        if columns is None:
+            columns = header
+        missing = [column for column in columns if column not in header]
+        if missing:
+            raise ValueError(f'Look {look_id} has no columns {missing}, its columns are {header}')
+        positions = [header.index(column) for column in columns]
+        converters = [(types or {}).get(column, str) for column in columns]
+
+        for row in reader:
+            if not row:
+                continue
+            yield {
+                column: None if row[position] == '' else convert(row[position])
+                for column, position, convert in zip(columns, positions, converters)
+            }
+
+
+def look_column(sdk: looker_sdk.methods40.Looker40SDK, look_id: str, column: str, type: Callable = str,
+                apply_vis: bool = False) -> Iterator:
+    '''
+    Yields the non-empty values of a single column of the look's results
+    '''
+    for row in stream_look_rows(sdk, look_id, [column], {column: type}, apply_vis=apply_vis):
+        if row[column] is not None:
+            yield row[column]
@@ -0,0 +1,52 @@
+
+import os
+import threading
+
+import looker_sdk
+from requests.adapters import HTTPAdapter
+
+
+_sdks = {}
+_sdks_lock = threading.Lock()
+
+
+def get_sdk(config_file: str = 'looker.ini', section: str = None, api_version: str = '4.0', pool_maxsize: int = None):
+    '''
+    Returns the SDK client for (config_file, section, api_version), creating it the first time only.
+
+    Reusing the client reuses its keep-alive HTTP connection pool and its access token. The SDK's
+    auth session checks the token's expiry before every call and only logs in again once it has expired.
+
+    pool_maxsize: int - number of connections to keep open, set it to at least the number of threads
+    sharing the client (requests keeps 10 by default)
+    '''
+    key = (os.path.abspath(config_file), section, api_version)
+    with _sdks_lock:
+        if key not in _sdks:
+            if not os.path.exists(config_file):
+                raise Exception(f'Must have {config_file} file containing API keys in same directory as this script!')
+            init = looker_sdk.init31 if api_version == '3.1' else looker_sdk.init40
+            sdk = init(config_file, section)
+            if pool_maxsize:
+                mount_connection_pool(sdk, pool_maxsize)
+            _sdks[key] = sdk
+        return _sdks[key]
+
+
+def mount_connection_pool(sdk, pool_maxsize: int) -> None:
+    '''
+    Lets the client keep `pool_maxsize` connections open, so that many threads can share it
+    '''
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_maxsize)
+    sdk.transport.session.mount('https://', adapter)
+    sdk.transport.session.mount('http://', adapter)
+
+
+def close_all() -> None:
+    '''
+    Logs out of every client created by get_sdk and forgets them
+    '''
+    with _sdks_lock:
+        for sdk in _sdks.values():
+            sdk.auth.logout()
+        _sdks.clear()
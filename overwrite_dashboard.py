@@ -1,117 +1,275 @@
 from __future__ import absolute_import
 
+import json
 import looker_sdk
-from looker_sdk.sdk.api31.models import WriteDashboardElement, WriteCreateDashboardFilter, WriteDashboardLayout,\
-        WriteDashboardLayoutComponent, WriteDashboard
+from looker_sdk.rtl.model import EXPLICIT_NULL
+from looker_sdk.sdk.api31.models import WriteDashboardElement, WriteCreateDashboardFilter, WriteDashboardFilter,\
+        WriteDashboardLayout, WriteDashboardLayoutComponent, WriteDashboard
 import click
+from typing import Callable, List, Optional, Tuple
+
+from bulk_api import run_concurrently
+from dashboard_snapshot import snapshot_before_change
+from looker_session import mount_connection_pool
 
 
 sdk = looker_sdk.init40()
 
 
-def _overwrite_existing_dashboard(orig_dashboard_id: str, new_dashboard_id: str, is_dryrun: bool) -> None:
+# Fields compared to tell whether two elements / filters / layout components are the same
+ELEMENT_CONTENT_FIELDS = ['type', 'title', 'title_hidden', 'title_text', 'subtitle_text', 'body_text', 'note_display',
+                          'note_state', 'note_text', 'refresh_interval', 'look_id', 'query_id', 'merge_result_id']
+FILTER_CONTENT_FIELDS = ['name', 'title', 'type', 'default_value', 'model', 'explore', 'dimension', 'row',
+                         'listens_to_filters', 'allow_multiple_values', 'required', 'ui_config']
+LAYOUT_COMPONENT_FIELDS = ['row', 'column', 'width', 'height']
+# Element fields cleared on the original element when the new element doesn't set them
+ELEMENT_CLEARED_FIELDS = ['body_text', 'look_id', 'merge_result_id', 'note_display', 'note_state', 'note_text',
+                          'query_id', 'refresh_interval', 'subtitle_text', 'title', 'title_text']
+
+
+def _to_json(value):
+    return vars(value) if hasattr(value, '__dict__') else str(value)
+
+
+def _content(obj, fields: List[str]) -> str:
+    """ Comparable json of the given fields of an SDK object. """
+    return json.dumps({field: getattr(obj, field, None) for field in fields}, sort_keys=True, default=_to_json)
+
+
+def _element_content(element) -> str:
+    """ Content of an element, including which dashboard filters its queries listen to. """
+    filterables = element.result_maker.filterables if element.result_maker else None
+    return _content(element, ELEMENT_CONTENT_FIELDS) + json.dumps(filterables, sort_keys=True, default=_to_json)
+
+
+def _source_kind(element) -> str:
+    """ What an element shows: a look, a merge result, a query, or nothing (text tiles and the like). """
+    if element.look_id:
+        return 'look'
+    if element.merge_result_id:
+        return 'merge_result'
+    if element.query_id:
+        return 'query'
+    return 'text'
+
+
+def _match_elements(orig_elements: list, new_elements: list) -> Tuple[list, list, list]:
+    """ Pairs up the elements of the original and the new dashboard, so paired elements can be updated in place.
+    Identical elements are paired first, then elements with the same type, source kind and title, then with the same
+    type and source kind. Elements are never paired across source kinds (e.g. a look tile and a query tile), those are
+    deleted and recreated instead.
+    Returns ([(original element, new element)], new elements to create, original elements to delete). """
+    pairs = []
+    unmatched_orig = list(orig_elements)
+    unmatched_new = list(new_elements)
+    for key in [_element_content,
+                lambda element: (element.type, _source_kind(element), element.title),
+                lambda element: (element.type, _source_kind(element))]:
+        orig_by_key = {}
+        for orig_element in unmatched_orig:
+            orig_by_key.setdefault(key(orig_element), []).append(orig_element)
+        still_unmatched_new = []
+        for new_element in unmatched_new:
+            candidates = orig_by_key.get(key(new_element))
+            if candidates:
+                pairs.append((candidates.pop(0), new_element))
+            else:
+                still_unmatched_new.append(new_element)
+        unmatched_new = still_unmatched_new
+        paired_ids = {orig_element.id for orig_element, _ in pairs}
+        unmatched_orig = [orig_element for orig_element in unmatched_orig if orig_element.id not in paired_ids]
+    return pairs, unmatched_new, unmatched_orig
+
+
+def _or_null(value):
+    return EXPLICIT_NULL if value is None else value
+
+
+def _write_element_obj(new_element, orig_dashboard_id: str, clear_unset: bool = False) -> WriteDashboardElement:
+    """ clear_unset: sends an explicit null for the ELEMENT_CLEARED_FIELDS the new element doesn't set, so updating an
+    existing element in place doesn't keep e.g. its old note or subtitle """
+    write_element_obj = WriteDashboardElement(
+        body_text=new_element.body_text,
+        dashboard_id=orig_dashboard_id,
+        look=new_element.look,
+        look_id=new_element.look_id,
+        merge_result_id=new_element.merge_result_id,
+        note_display=new_element.note_display,
+        note_state=new_element.note_state,
+        note_text=new_element.note_text,
+        query=new_element.query,
+        query_id=new_element.query_id,
+        refresh_interval=new_element.refresh_interval,
+        result_maker=new_element.result_maker,
+        result_maker_id=new_element.result_maker_id,
+        subtitle_text=new_element.subtitle_text,
+        title=new_element.title,
+        title_hidden=new_element.title_hidden,
+        title_text=new_element.title_text,
+        type=new_element.type
+    )
+    if clear_unset:
+        for field in ELEMENT_CLEARED_FIELDS:
+            setattr(write_element_obj, field, _or_null(getattr(write_element_obj, field)))
+    return write_element_obj
+
+
+def _run_phase(fn: Callable, items: list, workers: int) -> List[tuple]:
+    """ Calls fn on every item, `workers` at a time, fn returns (value, message to report). Returns [(item, value)] in
+    the order of items. Stops the overwrite if anything failed, so nothing is deleted after a failed create. """
+    results = []
+    failure_count = 0
+    for item, result, error in run_concurrently(fn, items, workers):
+        if error is not None:
+            click.echo(f"Failed with {error!r}")
+            failure_count += 1
+            continue
+        value, message = result
+        if message:
+            click.echo(message)
+        results.append((item, value))
+    if failure_count:
+        raise click.ClickException(f"{failure_count} changes failed, "
+                                   f"the original dashboard was only partly overwritten")
+    return results
+
+
+def _overwrite_existing_dashboard(orig_dashboard_id: str, new_dashboard_id: str, is_dryrun: bool,
+                                  workers: int = 8) -> None:
     """ Function that takes a new dashboard, and completely overwrites another (original) dashboard. Used when a new
     dashboard is created to replace an existing dashboard, but using a new Dashboard ID (URL) is not feasible. New
-    dashboard will be deleted. """
+    dashboard will be deleted.
+
+    Only the differences are written: filters are matched by name and elements by content (see _match_elements),
+    matches are updated in place if they differ, and only the rest is created or deleted. Obsolete elements and
+    filters are deleted last, so the dashboard is never left without its tiles.
+
+    Within each step (filters, elements, layout components, deletes) the writes are independent, so they're made
+    `workers` at a time. """
 
     click.echo(f"Replacing Dashboard {orig_dashboard_id} with Dashboard {new_dashboard_id}")
 
+    if workers > 10:
+        # requests only keeps 10 connections open by default
+        mount_connection_pool(sdk, workers)
+
     orig_dashboard = sdk.dashboard(orig_dashboard_id)
     new_dashboard = sdk.dashboard(new_dashboard_id)
 
-    # Clear out the original dashboard
-    for element in orig_dashboard.dashboard_elements:
-        if is_dryrun:
-            click.echo(f"Deleting dashboard element {element.id} from Dashboard {orig_dashboard_id}")
-        else:
-            sdk.delete_dashboard_element(element.id)
-            click.echo(f"Original dashboard element with ID {element.id} deleted")
+    # apply filters, matched by name since elements listen to filters by name
+    orig_filters_by_name = {
+        dashboard_filter.name: dashboard_filter for dashboard_filter in orig_dashboard.dashboard_filters
+    }
+    new_filter_names = {new_filter.name for new_filter in new_dashboard.dashboard_filters}
 
-    for dashboard_filter in orig_dashboard.dashboard_filters:
-        if is_dryrun:
-            click.echo(f"Deleting dashboard filter {dashboard_filter.id} from Dashboard {orig_dashboard_id}")
-        else:
-            sdk.delete_dashboard_filter(dashboard_filter.id)
-            click.echo(f"Original dashboard filter with ID {dashboard_filter.id} deleted")
-
-    # apply filters
-    for new_filter in new_dashboard.dashboard_filters:
-        write_filter_obj = WriteCreateDashboardFilter(
-            dashboard_id=orig_dashboard_id,
-            name=new_filter.name,
-            title=new_filter.title,
-            type=new_filter.type,
-            default_value=new_filter.default_value,
-            model=new_filter.model,
-            explore=new_filter.explore,
-            dimension=new_filter.dimension,
-            row=new_filter.row,
-            listens_to_filters=new_filter.listens_to_filters,
-            allow_multiple_values=new_filter.allow_multiple_values,
-            required=new_filter.required,
-            ui_config=new_filter.ui_config
-        )
-        if is_dryrun:
-            click.echo(f"Updating Dashboard {orig_dashboard_id} to include {write_filter_obj}")
-        else:
+    def apply_filter(new_filter):
+        orig_filter = orig_filters_by_name.get(new_filter.name)
+        filter_fields = {field: getattr(new_filter, field) for field in FILTER_CONTENT_FIELDS}
+        if orig_filter is None:
+            write_filter_obj = WriteCreateDashboardFilter(dashboard_id=orig_dashboard_id, **filter_fields)
+            if is_dryrun:
+                return None, f"Updating Dashboard {orig_dashboard_id} to include {write_filter_obj}"
             newly_created_filter = sdk.create_dashboard_filter(write_filter_obj)
-            click.echo(f"New dashboard filter with ID {newly_created_filter.id} applied")
-
-    # apply dashboard elements
-    new_element_id_list = []
-    for new_element in new_dashboard.dashboard_elements:
-        write_element_obj = WriteDashboardElement(
-            body_text=new_element.body_text,
-            dashboard_id=orig_dashboard_id,
-            look=new_element.look,
-            look_id=new_element.look_id,
-            merge_result_id=new_element.merge_result_id,
-            note_display=new_element.note_display,
-            note_state=new_element.note_state,
-            note_text=new_element.note_text,
-            query=new_element.query,
-            query_id=new_element.query_id,
-            refresh_interval=new_element.refresh_interval,
-            result_maker=new_element.result_maker,
-            result_maker_id=new_element.result_maker_id,
-            subtitle_text=new_element.subtitle_text,
-            title=new_element.title,
-            title_hidden=new_element.title_hidden,
-            title_text=new_element.title_text,
-            type=new_element.type
-        )
+            return None, f"New dashboard filter with ID {newly_created_filter.id} applied"
+        # send explicit nulls, so e.g. a default value the new filter doesn't have is cleared
+        write_filter_obj = WriteDashboardFilter(**{field: _or_null(value) for field, value in filter_fields.items()})
         if is_dryrun:
-            click.echo(f"Updating Dashboard {orig_dashboard_id} to include new element with title {new_element.title}")
-        else:
-            newly_created_element = sdk.create_dashboard_element(write_element_obj)
-            new_element_id_list.append(newly_created_element.id)
-            click.echo(f"New dashboard element with ID {newly_created_element.id} applied")
+            return None, f"Updating dashboard filter {orig_filter.id} to {write_filter_obj}"
+        sdk.update_dashboard_filter(orig_filter.id, write_filter_obj)
+        return None, f"Original dashboard filter with ID {orig_filter.id} updated"
+
+    filters_to_apply = [
+        new_filter for new_filter in new_dashboard.dashboard_filters
+        if new_filter.name not in orig_filters_by_name
+        or (_content(orig_filters_by_name[new_filter.name], FILTER_CONTENT_FIELDS)
+            != _content(new_filter, FILTER_CONTENT_FIELDS))
+    ]
+    _run_phase(apply_filter, filters_to_apply, workers)
+
+    # apply dashboard elements, keeping track of which original element each new element ends up as
+    pairs, elements_to_create, elements_to_delete = _match_elements(orig_dashboard.dashboard_elements,
+                                                                     new_dashboard.dashboard_elements)
+    element_id_map = {new_element.id: orig_element.id for orig_element, new_element in pairs}
+
+    def apply_element(new_element):
+        orig_element_id = element_id_map.get(new_element.id)
+        write_element_obj = _write_element_obj(new_element, orig_dashboard_id, clear_unset=orig_element_id is not None)
+        if orig_element_id is not None:
+            if is_dryrun:
+                return orig_element_id, (f"Updating dashboard element {orig_element_id} to the element with title "
+                                         f"{new_element.title}")
+            sdk.update_dashboard_element(orig_element_id, write_element_obj)
+            return orig_element_id, f"Original dashboard element with ID {orig_element_id} updated"
+        if is_dryrun:
+            return None, f"Updating Dashboard {orig_dashboard_id} to include new element with title {new_element.title}"
+        newly_created_element = sdk.create_dashboard_element(write_element_obj)
+        return newly_created_element.id, f"New dashboard element with ID {newly_created_element.id} applied"
+
+    elements_to_apply = [
+        new_element for orig_element, new_element in pairs
+        if _element_content(orig_element) != _element_content(new_element)
+    ] + elements_to_create
+    for new_element, orig_element_id in _run_phase(apply_element, elements_to_apply, workers):
+        element_id_map[new_element.id] = orig_element_id
 
     # get updated original dashboard, to get layouts of the newly added elements
-    orig_dashboard_updated = sdk.dashboard(orig_dashboard_id)
+    orig_dashboard_updated = orig_dashboard
+    if elements_to_create and not is_dryrun:
+        orig_dashboard_updated = sdk.dashboard(orig_dashboard_id)
 
     new_layout = new_dashboard.dashboard_layouts[0]
     orig_layout = orig_dashboard_updated.dashboard_layouts[0]
 
-    # have to skip for dryrun
-    if not is_dryrun:
-        # apply dashboard component (tile) layouts
-        for i in range(len(new_layout.dashboard_layout_components)):
-            new_layout_component = new_layout.dashboard_layout_components[i]
-            orig_layout_component = orig_layout.dashboard_layout_components[i]
-            write_layout_component_obj = WriteDashboardLayoutComponent(
-                dashboard_layout_id=orig_layout.id,
-                dashboard_element_id=new_element_id_list[i],
-                row=new_layout_component.row,
-                column=new_layout_component.column,
-                width=new_layout_component.width,
-                height=new_layout_component.height
-            )
-            newly_created_dashboard_layout_component = sdk.update_dashboard_layout_component(
-                orig_layout_component.id, write_layout_component_obj)
-            click.echo(f"New dashboard layout component with ID {newly_created_dashboard_layout_component.id} applied")
-    else:
-        click.echo("Applied dashboard component layouts")
+    # apply dashboard component (tile) layouts, by the element each component belongs to rather than by position
+    orig_components_by_element_id = {
+        component.dashboard_element_id: component for component in orig_layout.dashboard_layout_components
+    }
+    layout_component_writes = []
+    for new_layout_component in new_layout.dashboard_layout_components:
+        orig_layout_component = orig_components_by_element_id.get(
+            element_id_map.get(new_layout_component.dashboard_element_id))
+        if orig_layout_component is None:
+            # elements that are only created on an actual run
+            continue
+        if (_content(orig_layout_component, LAYOUT_COMPONENT_FIELDS)
+                == _content(new_layout_component, LAYOUT_COMPONENT_FIELDS)):
+            continue
+        layout_component_writes.append((orig_layout_component.id, WriteDashboardLayoutComponent(
+            dashboard_layout_id=orig_layout.id,
+            dashboard_element_id=orig_layout_component.dashboard_element_id,
+            row=new_layout_component.row,
+            column=new_layout_component.column,
+            width=new_layout_component.width,
+            height=new_layout_component.height
+        )))
+
+    def apply_layout_component(layout_component_write):
+        if is_dryrun:
+            return None, None
+        newly_created_dashboard_layout_component = sdk.update_dashboard_layout_component(*layout_component_write)
+        return None, f"New dashboard layout component with ID {newly_created_dashboard_layout_component.id} applied"
+
+    _run_phase(apply_layout_component, layout_component_writes, workers)
+    if is_dryrun:
+        click.echo(f"Applied {len(layout_component_writes)} dashboard component layouts")
+
+    # clear out what the new dashboard doesn't have
+    def delete(element_or_filter):
+        kind, item_id = element_or_filter
+        if is_dryrun:
+            return None, f"Deleting dashboard {kind} {item_id} from Dashboard {orig_dashboard_id}"
+        if kind == 'element':
+            sdk.delete_dashboard_element(item_id)
+        else:
+            sdk.delete_dashboard_filter(item_id)
+        return None, f"Original dashboard {kind} with ID {item_id} deleted"
+
+    _run_phase(delete, [('element', element.id) for element in elements_to_delete] + [
+        ('filter', dashboard_filter.id) for dashboard_filter in orig_dashboard.dashboard_filters
+        if dashboard_filter.name not in new_filter_names
+    ], workers)
+
+    click.echo(f"Elements: {len(pairs)} matched, {len(elements_to_create)} created, {len(elements_to_delete)} deleted")
 
     # apply dashboard layout
     write_layout_obj = WriteDashboardLayout(
@@ -180,11 +338,18 @@ def cli() -> None:
 @click.option('--original_dashboard_id', required=True, type=str)
 @click.option('--new_dashboard_id', required=True, type=str)
 @click.option('--dryrun', is_flag=True, default=False)
-def overwrite_existing_dashboard(original_dashboard_id: str, new_dashboard_id: str, dryrun: bool) -> None:
+@click.option('--workers', default=8, type=int, help='Number of changes made at the same time.')
+@click.option('--snapshot', 'snapshot_store', default=None, type=str,
+              help='Snapshot both dashboards into this store first, see dashboard_snapshot.py.')
+def overwrite_existing_dashboard(original_dashboard_id: str, new_dashboard_id: str, dryrun: bool, workers: int,
+                                 snapshot_store: Optional[str]) -> None:
+    if snapshot_store and not dryrun:
+        snapshot_before_change(snapshot_store, sdk, [original_dashboard_id, new_dashboard_id])
     _overwrite_existing_dashboard(
         orig_dashboard_id=original_dashboard_id,
         new_dashboard_id=new_dashboard_id,
-        is_dryrun=dryrun
+        is_dryrun=dryrun,
+        workers=workers
     )
 
 
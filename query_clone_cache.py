@@ -0,0 +1,142 @@
+from __future__ import absolute_import
+
+import hashlib
+import json
+import os
+import threading
+from typing import Optional
+
+import looker_sdk
+from looker_sdk import models as ml
+
+
+# Query attributes copied over when a query is cloned onto a new model / explore
+CLONED_QUERY_FIELDS = [
+    'fields', 'pivots', 'fill_fields', 'filters', 'filter_expression', 'sorts', 'limit', 'column_limit', 'total',
+    'row_total', 'subtotals', 'vis_config', 'filter_config', 'visible_ui_sections', 'dynamic_fields', 'query_timezone'
+]
+
+
+def query_definition(query: ml.Query) -> dict:
+    """Everything that is copied when a query is cloned."""
+    return {field: query[field] for field in CLONED_QUERY_FIELDS}
+
+
+def write_query_body(query: ml.Query, new_model: str, new_explore: str) -> ml.WriteQuery:
+    """Copy of a query on a new model and explore, assumes view and field names are the same."""
+    return ml.WriteQuery(
+        model=new_model,
+        view=new_explore,
+        **query_definition(query)
+    )
+
+
+def query_definition_hash(query: ml.Query) -> str:
+    """Hash of everything that is copied when a query is cloned, identical queries get the same hash."""
+    return hashlib.sha256(json.dumps(query_definition(query), sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+
+class QueryCloneCache:
+    """Clones each distinct query onto the new model / explore only once per run.
+
+    Clones are looked up by source query id first, then by a hash of the query definition, so tiles that share a
+    query, or have identical queries, reuse the same new query. With a path, every clone is appended to a json-lines
+    file and loaded again on the next run, so re-runs and resumed runs don't create the same queries again.
+
+    The cache can be shared by threads, a query that is being cloned by one thread is waited for by the others
+    instead of being cloned twice.
+
+    With dry_run nothing is created or written to the file, clone() returns a stand-in id for each new query.
+    """
+
+    def __init__(self, sdk: looker_sdk.methods40.Looker40SDK, new_model: str, new_explore: str,
+                 path: Optional[str] = None, dry_run: bool = False) -> None:
+        self.sdk = sdk
+        self.new_model = new_model
+        self.new_explore = new_explore
+        self.path = path
+        self.dry_run = dry_run
+        self.by_query_id = {}
+        self.by_definition = {}
+        self.created_count = 0
+        self.reused_count = 0
+        self._lock = threading.Lock()
+        # (cache name, key) -> Event set once the thread cloning it is done
+        self._in_flight = {}
+
+        if path and os.path.exists(path):
+            with open(path) as f:
+                for line in f:
+                    clone = json.loads(line)
+                    if clone['new_model'] == new_model and clone['new_explore'] == new_explore:
+                        self.by_query_id[clone['source_query_id']] = clone['new_query_id']
+                        self.by_definition[clone['definition_hash']] = clone['new_query_id']
+
+    def cached(self, query_id: str) -> Optional[str]:
+        """The id of the clone of query_id, if it has been cloned already."""
+        return self.by_query_id.get(str(query_id))
+
+    def clone(self, query_id: str, query: Optional[ml.Query] = None) -> str:
+        """Returns the id of a copy of the query on the new model / explore, creating it only if needed.
+
+        query is only fetched when it isn't passed in and the query id hasn't been cloned before.
+        """
+        query_id = str(query_id)
+        new_query_id = self._get_or_claim('by_query_id', query_id)
+        if new_query_id is not None:
+            return new_query_id
+
+        try:
+            if query is None:
+                query = self.sdk.query(query_id)
+            definition_hash = query_definition_hash(query)
+            new_query_id = self._get_or_claim('by_definition', definition_hash)
+            if new_query_id is None:
+                try:
+                    if self.dry_run:
+                        new_query_id = f'new query from {query_id}'
+                    else:
+                        new_query_id = str(self.sdk.create_query(write_query_body(query, self.new_model, self.new_explore)).id)
+                    with self._lock:
+                        self.created_count += 1
+                    self._record(query_id, definition_hash, new_query_id)
+                finally:
+                    self._release('by_definition', definition_hash)
+            else:
+                self._record(query_id, definition_hash, new_query_id)
+        finally:
+            self._release('by_query_id', query_id)
+        return new_query_id
+
+    def _get_or_claim(self, cache_name: str, key: str) -> Optional[str]:
+        """Returns the cached clone for key, or None once this thread is the one that has to create it."""
+        while True:
+            with self._lock:
+                cache = getattr(self, cache_name)
+                if key in cache:
+                    self.reused_count += 1
+                    return cache[key]
+                in_flight = self._in_flight.get((cache_name, key))
+                if in_flight is None:
+                    self._in_flight[(cache_name, key)] = threading.Event()
+                    return None
+            # another thread is cloning it, use its clone, or take over if it failed
+            in_flight.wait()
+
+    def _release(self, cache_name: str, key: str) -> None:
+        with self._lock:
+            self._in_flight.pop((cache_name, key)).set()
+
+    def _record(self, query_id: str, definition_hash: str, new_query_id: str) -> None:
+        with self._lock:
+            self.by_query_id[query_id] = new_query_id
+            self.by_definition[definition_hash] = new_query_id
+            if self.path and not self.dry_run:
+                with open(self.path, 'a') as f:
+                    f.write(json.dumps({
+                        'new_model': self.new_model,
+                        'new_explore': self.new_explore,
+                        'source_query_id': query_id,
+                        'definition_hash': definition_hash,
+                        'new_query_id': new_query_id,
+                    }) + '\n')
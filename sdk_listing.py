@@ -0,0 +1,130 @@
+
+import functools
+import json
+import looker_sdk
+import pandas as pd
+
+# orjson decodes large responses several times faster, fall back to json if it isn't installed
+try:
+    import orjson
+    _json_loads = orjson.loads
+except ImportError:
+    _json_loads = json.loads
+
+
+# Columns that are always strings get the compact pandas string dtype instead of object
+STRING_FIELDS = {'title', 'name', 'email', 'display_name', 'description'}
+
+
+def iter_content(sdk: looker_sdk.methods40.Looker40SDK, content_type: str, fields: list = ['id', 'title'], page_size: int = None, sorts: str = 'id', **search_params):
+    '''
+    Yields the items of any content type with all_<type> / search_<type> SDK methods, e.g. dashboards,
+    looks or users, requesting only `fields` from the API.
+
+    content_type: str - plural name used by the SDK methods, e.g. 'dashboards', 'looks' or 'users'
+    page_size: int - page through search_<type> instead of making one all_<type> call.
+    Note that search_dashboards doesn't return LookML dashboards.
+    search_params - extra filters for search_<type>, e.g. deleted or is_disabled, only used with page_size
+    '''
+    if page_size is None:
+        yield from getattr(sdk, f'all_{content_type}')(fields=','.join(fields))
+        return
+
+    search = getattr(sdk, f'search_{content_type}')
+    offset = 0
+    while True:
+        page = search(fields=','.join(fields), limit=page_size, offset=offset, sorts=sorts, **search_params)
+        yield from page
+        if len(page) < page_size:
+            return
+        offset += page_size
+
+
+def fetch_raw(sdk: looker_sdk.methods40.Looker40SDK, path: str, fields: list = None, **query_params) -> list:
+    '''
+    Read-only GET that decodes the json response directly, skipping the SDK's model structuring.
+    Only use it for bulk listings whose results are flattened straight away.
+
+    path: str - API path of a listing, e.g. '/users' or f'/groups/{group_id}/users'
+    '''
+    if fields:
+        query_params['fields'] = ','.join(fields)
+    return _json_loads(sdk.get(path, str, query_params))
+
+
+def fetch_raw_pages(sdk: looker_sdk.methods40.Looker40SDK, path: str, fields: list, page_size: int, **query_params):
+    '''
+    Yields the pages of a limit / offset listing with fetch_raw, `fields` has to include 'id'.
+
+    Stops on a short page, and also on a page without any new ids, which is what an endpoint that
+    ignores limit / offset (e.g. some listings on API 3.1) returns every time. Records already seen
+    on an earlier page are left out.
+    '''
+    seen_ids = set()
+    offset = 0
+    while True:
+        page = fetch_raw(sdk, path, fields, limit=page_size, offset=offset, **query_params)
+        new_records = [record for record in page if str(record['id']) not in seen_ids]
+        if not new_records:
+            return
+        seen_ids.update(str(record['id']) for record in new_records)
+        yield new_records
+        if len(page) < page_size:
+            return
+        offset += page_size
+
+
+@functools.lru_cache(maxsize=None)
+def record_type(fields: tuple) -> type:
+    '''
+    A lightweight __slots__ class with one attribute per field, created once per set of fields
+    '''
+    def __init__(self, *values):
+        for field, value in zip(fields, values):
+            setattr(self, field, value)
+
+    def __repr__(self):
+        return 'Record(' + ', '.join(f'{field}={getattr(self, field)!r}' for field in fields) + ')'
+
+    return type('Record', (), {
+        '__slots__': fields,
+        '__init__': __init__,
+        '__repr__': __repr__,
+        '__getitem__': lambda self, field: getattr(self, field),
+    })
+
+
+def fetch_records(sdk: looker_sdk.methods40.Looker40SDK, path: str, fields: list, **query_params) -> list:
+    '''
+    Same as fetch_raw, but returns one __slots__ record per item, with attribute access like SDK models
+    '''
+    Record = record_type(tuple(fields))
+    return [Record(*[item.get(field) for field in fields]) for item in fetch_raw(sdk, path, fields, **query_params)]
+
+
+def fetch_columns(sdk: looker_sdk.methods40.Looker40SDK, path: str, fields: list, **query_params) -> dict:
+    '''
+    Same as fetch_raw, but returns {field: list of values}, ready for pd.DataFrame
+    '''
+    items = fetch_raw(sdk, path, fields, **query_params)
+    return {field: [item.get(field) for item in items] for field in fields}
+
+
+def content_df(sdk: looker_sdk.methods40.Looker40SDK, content_type: str, fields: list = ['id', 'title'], page_size: int = None, raw: bool = False) -> pd.DataFrame:
+    '''
+    Builds a DataFrame with one column per field straight from iter_content, without
+    keeping the SDK objects around
+
+    raw: bool - decode the json with fetch_columns instead of building SDK models, ignores page_size
+    '''
+    if raw:
+        columns = fetch_columns(sdk, f'/{content_type}', fields)
+    else:
+        columns = {field: [] for field in fields}
+        for item in iter_content(sdk, content_type, fields, page_size):
+            for field in fields:
+                columns[field].append(getattr(item, field, None))
+    return pd.DataFrame({
+        field: pd.array(values, dtype='string') if field in STRING_FIELDS else values
+        for field, values in columns.items()
+    })
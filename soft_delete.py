@@ -0,0 +1,238 @@
+'''
+Soft deletes looks and dashboards (moves them to the trash folder) in parallel, and restores them again.
+
+Every item that is deleted or restored is appended to a json-lines undo log straight away, so a run that
+stops half way can be resumed (items the log already has as deleted, and that are still deleted in Looker,
+are skipped) or rolled back. Items are read from the look and sent to Looker BATCH_SIZE at a time.
+
+    python soft_delete.py delete --look-id 99999 --undo-log soft_delete_undo.jsonl
+    python soft_delete.py restore --undo-log soft_delete_undo.jsonl --run <run id>
+'''
+
+import datetime
+import itertools
+import json
+import os
+import threading
+import uuid
+from typing import Iterable, Iterator, List, Set, Tuple
+
+import click
+import looker_sdk
+
+from bulk_api import AdaptiveRateLimiter, BackoffSDK, run_concurrently
+from look_results import stream_look_rows
+from looker_session import mount_connection_pool
+
+
+# Items are sent to the thread pool this many at a time, with progress reported after each batch
+BATCH_SIZE = 1000
+CONTENT_ID_COLUMN = 'content_usage.content_id'
+CONTENT_TYPE_COLUMN = 'content_usage.content_type'
+CONTENT_TYPES = ['look', 'dashboard']
+
+
+class UndoLog:
+    '''
+    Append-only json-lines log of the soft deletes and restores, one line per item, shared by threads
+    '''
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+
+    def append(self, run: str, action: str, content_type: str, content_id: str) -> None:
+        line = json.dumps({
+            'run': run,
+            'action': action,
+            'content_type': content_type,
+            'content_id': content_id,
+            'at': datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        })
+        with self._lock:
+            with open(self.path, 'a') as f:
+                f.write(line + '\n')
+
+    def entries(self) -> List[dict]:
+        if not os.path.exists(self.path):
+            return []
+        with open(self.path) as f:
+            return [json.loads(line) for line in f if line.strip()]
+
+    def deleted(self, run: str = None) -> List[Tuple[str, str]]:
+        '''
+        (content_type, content_id) of every item that is still soft deleted according to the log,
+        only the ones deleted by `run` if it's given
+        '''
+        latest = {}
+        for entry in self.entries():
+            key = (entry['content_type'], entry['content_id'])
+            if entry['action'] == 'soft_delete' and (run is None or entry['run'] == run):
+                latest[key] = entry
+            elif entry['action'] == 'restore':
+                latest.pop(key, None)
+        return list(latest)
+
+    def runs(self) -> List[str]:
+        return sorted({entry['run'] for entry in self.entries()})
+
+
+def _new_run_id() -> str:
+    # sorts by start time, the suffix keeps runs started in the same second apart
+    return f"{datetime.datetime.now(datetime.timezone.utc):%Y%m%dT%H%M%S}-{uuid.uuid4().hex[:8]}"
+
+
+def _set_deleted(api, content_type: str, content_id: str, deleted: bool) -> None:
+    body = {'deleted': deleted}
+    if content_type == 'look':
+        api.update_look(content_id, body, fields='id')
+    elif content_type == 'dashboard':
+        api.update_dashboard(content_id, body, fields='id')
+    else:
+        raise ValueError(f'Unknown content type {content_type}')
+
+
+def _is_deleted(api, content_type: str, content_id: str) -> bool:
+    if content_type == 'look':
+        return bool(api.look(content_id, fields='deleted').deleted)
+    elif content_type == 'dashboard':
+        return bool(api.dashboard(content_id, fields='deleted').deleted)
+    else:
+        raise ValueError(f'Unknown content type {content_type}')
+
+
+def _apply(sdk, items: Iterable[Tuple[str, str]], action: str, undo_log: UndoLog, run: str,
+           workers: int, rate_limit: float, dry_run: bool, recheck: Set[Tuple[str, str]] = frozenset()) -> dict:
+    '''
+    Sets the deleted flag of the items, BATCH_SIZE at a time so `items` can be a stream.
+
+    recheck: items the undo log has as already done, they're skipped unless Looker says otherwise
+    (e.g. someone restored them by hand)
+    '''
+    deleted = action == 'soft_delete'
+    api = BackoffSDK(sdk, AdaptiveRateLimiter(rate_limit))
+    if workers > 10:
+        mount_connection_pool(sdk, workers)
+
+    def apply_one(item) -> bool:
+        content_type, content_id = item
+        if item in recheck and _is_deleted(api, content_type, content_id) == deleted:
+            return False
+        if not dry_run:
+            _set_deleted(api, content_type, content_id, deleted)
+            undo_log.append(run, action, content_type, content_id)
+        return True
+
+    items = iter(items)
+    processed, done, skipped, failed = 0, 0, 0, []
+    try:
+        for batch in iter(lambda: list(itertools.islice(items, BATCH_SIZE)), []):
+            for (content_type, content_id), applied, error in run_concurrently(apply_one, batch, workers):
+                if error is not None:
+                    click.echo(f'Error on {content_type} with ID {content_id}: {error}')
+                    failed.append((content_type, content_id))
+                elif applied:
+                    done += 1
+                else:
+                    skipped += 1
+            processed += len(batch)
+            click.echo(f'{processed} processed' + (' (Dry Run)' if dry_run else ''))
+    finally:
+        api.detach()
+    if skipped:
+        click.echo(f'Skipped {skipped} items that are already {"deleted" if deleted else "restored"}')
+    return {'run': run, 'done': done, 'failed': failed}
+
+
+def soft_delete(sdk, items: Iterable[Tuple[str, str]], undo_log_path: str, workers: int = 16,
+                rate_limit: float = 20, dry_run: bool = False) -> dict:
+    '''
+    Soft deletes (content_type, content_id) items, content_type being 'look' or 'dashboard'.
+
+    `items` can be a stream (e.g. unused_content), it's read BATCH_SIZE items at a time. Items of any
+    other content type are skipped with a warning, as are items listed twice. Items the undo log already
+    has as deleted are skipped if they're still deleted in Looker, and deleted again if someone restored
+    them by hand. rate_limit is the starting number of calls per
+    second, it's lowered automatically while Looker answers with 429 / 5xx. Returns the run id, the number
+    of items deleted and the (content_type, content_id) that failed.
+    '''
+    undo_log = UndoLog(undo_log_path)
+    unknown_types = set()
+    seen = set()
+
+    def pending() -> Iterator[Tuple[str, str]]:
+        for content_type, content_id in items:
+            item = (content_type, str(content_id))
+            if content_type not in CONTENT_TYPES:
+                if content_type not in unknown_types:
+                    click.echo(f'Skipping items of unknown content type {content_type}')
+                    unknown_types.add(content_type)
+            elif item not in seen:
+                seen.add(item)
+                yield item
+
+    return _apply(sdk, pending(), 'soft_delete', undo_log, _new_run_id(), workers, rate_limit, dry_run,
+                  recheck=set(undo_log.deleted()))
+
+
+def restore(sdk, undo_log_path: str, run: str = None, workers: int = 16, rate_limit: float = 20,
+            dry_run: bool = False) -> dict:
+    '''
+    Restores everything the undo log has as deleted, or only what `run` deleted
+    '''
+    undo_log = UndoLog(undo_log_path)
+    items = undo_log.deleted(run)
+    return _apply(sdk, items, 'restore', undo_log, _new_run_id(), workers, rate_limit, dry_run)
+
+
+def unused_content(sdk, look_id: str) -> Iterator[Tuple[str, str]]:
+    '''
+    Yields (content_type, content_id) of the items returned by an unused content look on the Content Usage
+    explore, as the look's results are read
+    '''
+    for row in stream_look_rows(sdk, look_id, columns=[CONTENT_TYPE_COLUMN, CONTENT_ID_COLUMN]):
+        yield row[CONTENT_TYPE_COLUMN], row[CONTENT_ID_COLUMN]
+
+
+@click.group()
+def cli() -> None:
+    pass
+
+
+@cli.command()
+@click.option('--look-id', required=True, type=str, help='Look returning the unused content.')
+@click.option('--undo-log', default='soft_delete_undo.jsonl', type=str)
+@click.option('--workers', default=16, type=int, help='Number of items deleted at the same time.')
+@click.option('--rate-limit', default=20, type=float, help='Starting API calls per second, lowered when throttled.')
+@click.option('--dryrun', is_flag=True, default=False)
+def delete(look_id: str, undo_log: str, workers: int, rate_limit: float, dryrun: bool) -> None:
+    sdk = looker_sdk.init40()
+    result = soft_delete(sdk, unused_content(sdk, look_id), undo_log, workers, rate_limit, dryrun)
+    click.echo(f"Run {result['run']}: deleted {result['done']}")
+    if result['failed']:
+        click.echo(f"Failed: {result['failed']}")
+
+
+@cli.command('restore')
+@click.option('--undo-log', default='soft_delete_undo.jsonl', type=str)
+@click.option('--run', default=None, type=str, help='Only restore what this run deleted, everything when not set.')
+@click.option('--workers', default=16, type=int, help='Number of items restored at the same time.')
+@click.option('--rate-limit', default=20, type=float, help='Starting API calls per second, lowered when throttled.')
+@click.option('--dryrun', is_flag=True, default=False)
+def restore_command(undo_log: str, run: str, workers: int, rate_limit: float, dryrun: bool) -> None:
+    sdk = looker_sdk.init40()
+    result = restore(sdk, undo_log, run, workers, rate_limit, dryrun)
+    click.echo(f"Run {result['run']}: restored {result['done']}")
+    if result['failed']:
+        click.echo(f"Failed: {result['failed']}")
+
+
+@cli.command('runs')
+@click.option('--undo-log', default='soft_delete_undo.jsonl', type=str)
+def runs_command(undo_log: str) -> None:
+    log = UndoLog(undo_log)
+    for run in log.runs():
+        click.echo(f"{run}: {len(log.deleted(run))} still deleted")
+
+
+if __name__ == "__main__":
+    cli()
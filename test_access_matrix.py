@@ -0,0 +1,130 @@
+'''
+Checks AccessMatrix against AccessEvaluator on a small in-memory snapshot, no Looker instance needed.
+
+    python -m pytest test_access_matrix.py
+'''
+
+import pandas as pd
+import pytest
+
+from access_evaluator import AccessEvaluator
+from access_matrix import AccessMatrix
+
+
+SNAPSHOT = {
+    'folders': {
+        'f1': {'parent_id': None, 'content_metadata_id': 'c1'},
+        'f2': {'parent_id': 'f1', 'content_metadata_id': 'c2'},
+        'f3': {'parent_id': 'f1', 'content_metadata_id': 'c3'},
+    },
+    'content_metadata': {
+        'c1': {'parent_id': None, 'inherits': False},
+        'c2': {'parent_id': 'c1', 'inherits': True},
+        'c3': {'parent_id': 'c1', 'inherits': False},
+    },
+    # f1 and f2 are open to All Users, f3 only to group 10 and to user 7 directly
+    'content_metadata_access': {
+        'c1': {'group_ids': ['1'], 'user_ids': []},
+        'c3': {'group_ids': ['10'], 'user_ids': ['7']},
+    },
+    # group 12 is nested in group 10
+    'group_parents': {'12': ['10']},
+    'roles': {
+        'viewer': {'permissions': ['see_looks', 'see_user_dashboards'], 'models': ['m'], 'group_ids': ['1']},
+        'admin': {'permissions': ['administer'], 'models': None, 'group_ids': []},
+    },
+    # user 8 is an admin through a role given to them directly
+    'user_role_ids': {'8': ['admin']},
+    'dashboards': {
+        '1': {'title': 'open', 'folder_id': 'f1'},
+        '2': {'title': 'inherits open', 'folder_id': 'f2'},
+        '3': {'title': 'restricted', 'folder_id': 'f3'},
+        'm::lookml': {'title': 'lookml', 'folder_id': None},
+    },
+    'looks': {
+        '9': {'title': 'on m', 'folder_id': 'f3', 'model': 'm'},
+        '8': {'title': 'on other', 'folder_id': 'f3', 'model': 'other'},
+        '6': {'title': 'no model', 'folder_id': 'f3', 'model': None},
+    },
+}
+
+USERS = {
+    '5': {'email': 'nested@example.com', 'group_ids': ['12']},
+    '6': {'email': 'member@example.com', 'group_ids': ['10']},
+    '7': {'email': 'direct_folder@example.com', 'group_ids': []},
+    '8': {'email': 'direct_admin@example.com', 'group_ids': ['12']},
+    '9': {'email': 'everyone@example.com', 'group_ids': []},
+}
+
+
+@pytest.fixture
+def evaluator():
+    return AccessEvaluator(SNAPSHOT)
+
+
+@pytest.fixture
+def matrix(evaluator):
+    return AccessMatrix(evaluator, USERS)
+
+
+def _changes(df: pd.DataFrame, user_id: str) -> dict:
+    '''
+    {'dashboards': {'missing': set, 'new': set}, 'looks': ...} for one user, like AccessEvaluator.what_if
+    '''
+    user_df = df[df['user_id'] == user_id]
+    return {
+        content_type: {
+            missing_or_new: set(user_df[(user_df['content_type'] == content_type)
+                                        & (user_df['missing_or_new'] == missing_or_new)]['id'])
+            for missing_or_new in ['missing', 'new']
+        }
+        for content_type in ['dashboards', 'looks']
+    }
+
+
+def test_user_content_matches_evaluator(evaluator, matrix):
+    for user_id, user in USERS.items():
+        assert matrix.user_content(user_id) == evaluator.visible_content(user['group_ids'], user_id), user_id
+
+
+def test_direct_access_splits_rows(matrix):
+    # same groups, but 8 has a direct role
+    assert matrix.user_row_keys['5'] != matrix.user_row_keys['8']
+    # no groups, but 7 has a direct folder
+    assert matrix.user_row_keys['7'] != matrix.user_row_keys['9']
+
+
+def test_look_without_model_needs_see_looks_on_any_model(matrix):
+    assert '6' in matrix.user_content('5')['looks']
+    assert '8' not in matrix.user_content('5')['looks']
+
+
+def test_what_if_matches_evaluator(evaluator, matrix):
+    for group_ids_to_add, group_ids_to_remove in [(['10'], []), ([], ['10']), ([], ['12']), (['12'], ['10'])]:
+        df = matrix.what_if(group_ids_to_add, group_ids_to_remove)
+        for user_id, user in USERS.items():
+            expected = evaluator.what_if(user['group_ids'], group_ids_to_add, group_ids_to_remove, user_id=user_id)
+            assert _changes(df, user_id) == expected, (group_ids_to_add, group_ids_to_remove, user_id)
+
+
+def test_retire_group(matrix):
+    df = matrix.retire_group('10')
+    lost = {'dashboards': {'missing': {'3'}, 'new': set()}, 'looks': {'missing': {'6', '9'}, 'new': set()}}
+    # members of 10 and of 12, which is nested in it
+    assert _changes(df, '5') == lost
+    assert _changes(df, '6') == lost
+    # direct folder access and a direct admin role don't depend on the group
+    assert df[df['user_id'].isin(['7', '8', '9'])].empty
+    assert set(df['missing_or_new']) == {'missing'}
+    assert list(df.columns) == ['id', 'title', 'content_type', 'user_id', 'user_email', 'missing_or_new']
+
+
+def test_save_load_round_trip(matrix, tmp_path):
+    path = str(tmp_path / 'matrix.json.gz')
+    matrix.save(path)
+    loaded = AccessMatrix.load(path)
+    assert loaded.rows == matrix.rows
+    assert loaded.user_row_keys == matrix.user_row_keys
+    for user_id in USERS:
+        assert loaded.user_content(user_id) == matrix.user_content(user_id)
+    pd.testing.assert_frame_equal(loaded.retire_group('10'), matrix.retire_group('10'))
@@ -0,0 +1,93 @@
+'''
+Builds a DataFrame of every Looker user with their last login, email and Looker employee flag, and
+finds the users that haven't logged in for a number of days.
+
+Users are fetched as raw json with only the fields used here, their credentials are flattened in a
+single json_normalize pass and the derived columns are computed column-wise.
+
+    user_df = build_user_inventory(sdk)
+    inactive = find_inactive_users(user_df, days=365)
+'''
+
+import datetime
+
+import looker_sdk
+import pandas as pd
+
+from sdk_listing import fetch_raw
+
+
+# Every credential type that records a login, each becomes credentials_<type>_email / _logged_in_at columns
+CREDENTIAL_TYPES = ['credentials_email', 'credentials_looker_openid', 'credentials_saml', 'credentials_google',
+                    'credentials_ldap', 'credentials_oidc']
+# Emails are taken from these credentials, the same ones the inactive users notebook used
+EMAIL_COLUMNS = ['credentials_email_email', 'credentials_looker_openid_email', 'credentials_saml_email']
+LOGGED_IN_COLUMNS = [f'{credential_type}_logged_in_at' for credential_type in CREDENTIAL_TYPES]
+USER_FIELDS = ['id', 'display_name', 'is_disabled', 'presumed_looker_employee', 'verified_looker_employee'] + [
+    f'{credential_type}(email,logged_in_at)' for credential_type in CREDENTIAL_TYPES
+]
+
+
+def fetch_users(sdk: looker_sdk.methods40.Looker40SDK, fields: list = USER_FIELDS, page_size: int = None) -> list:
+    '''
+    All users as plain dicts, with only `fields` requested from the API
+
+    page_size: int - page through /users/search instead of making one /users call
+    '''
+    if page_size is None:
+        return fetch_raw(sdk, '/users', fields)
+    users = []
+    offset = 0
+    while True:
+        page = fetch_raw(sdk, '/users/search', fields, limit=page_size, offset=offset, sorts='id')
+        users.extend(page)
+        if len(page) < page_size:
+            return users
+        offset += page_size
+
+
+def users_df(users: list) -> pd.DataFrame:
+    '''
+    One row per user indexed by id, with nested credentials flattened to credentials_<type>_<field>
+    columns and last_login_date, is_looker_employee and email added
+    '''
+    df = pd.json_normalize(users, sep='_')
+    # users without any credentials of a type leave a column of nulls named after the type
+    df = df.drop(columns=[column for column in CREDENTIAL_TYPES if column in df.columns])
+    df = df.reindex(columns=df.columns.union(EMAIL_COLUMNS + LOGGED_IN_COLUMNS, sort=False))
+
+    df['id'] = df['id'].astype(int)
+    df = df.set_index('id').sort_index()
+
+    for column in LOGGED_IN_COLUMNS:
+        df[column] = pd.to_datetime(df[column], utc=True)
+    df['last_login_date'] = df[LOGGED_IN_COLUMNS].max(axis=1)
+    df['is_looker_employee'] = (df['presumed_looker_employee'].fillna(False).astype(bool)
+                                | df['verified_looker_employee'].fillna(False).astype(bool))
+    df['is_disabled'] = df['is_disabled'].fillna(False).astype(bool)
+    # the alphabetically first email across the credentials, like the notebook's min over the email columns,
+    # reduced pairwise since a row-wise min over string columns runs per row
+    email = df[EMAIL_COLUMNS[0]].fillna('~')
+    for column in EMAIL_COLUMNS[1:]:
+        other = df[column].fillna('~')
+        email = email.where(email <= other, other)
+    df['email'] = email.where(email != '~')
+    return df
+
+
+def build_user_inventory(sdk: looker_sdk.methods40.Looker40SDK, page_size: int = None) -> pd.DataFrame:
+    return users_df(fetch_users(sdk, page_size=page_size))
+
+
+def find_inactive_users(user_df: pd.DataFrame, days: int = 365, now: datetime.datetime = None) -> pd.DataFrame:
+    '''
+    display_name and last_login_date of the enabled, non Looker employee users whose last login was
+    before the day `days` days ago. Users who have never logged in aren't included.
+    '''
+    now = now or datetime.datetime.utcnow()
+    cutoff = pd.Timestamp(now - datetime.timedelta(days=days), tz='UTC').normalize()
+    return user_df[
+        ~user_df['is_looker_employee']
+        & ~user_df['is_disabled']
+        & (user_df['last_login_date'] < cutoff)
+    ][['display_name', 'last_login_date']]